@@ -27,14 +27,30 @@
 
 import queue
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from typing import Any, Callable
-import movelladot_pc_sdk as mdda
 from collections import OrderedDict
 
-from datastructures import TimestampAlignedFifoBuffer
+import numpy as np
+
+from datastructures import IMU_PACKET_DTYPE, AdaptiveStaleTimeout, PacketRing, TimestampAlignedRingBuffer
+from metrics import DataQualityMetrics, format_metrics
+from resampling import ResampledAlignedRingBuffer
+from shm import SharedSnapshotWriter
+from tracing import LatencyTracer
 from user_settings import *
 from time import perf_counter
 
+if movella_backend == "simulator":
+  import MovellaSimulator as mdda
+else:
+  import movelladot_pc_sdk as mdda
+
+# Rate of the DOTs' sampleTimeFine clock, exact, unlike the rounded sampling period in ticks times the rate.
+DOT_TICKS_PER_S = 10000
+# Put in the reconnect queue when a device is lost, for the supervisor to restart the scan off the SDK's callback thread.
+_SCAN_FOR_LOST_DEVICES = object()
+
 
 class DotDataCallback(mdda.XsDotCallback):
   def __init__(self,
@@ -50,10 +66,12 @@ class DotDataCallback(mdda.XsDotCallback):
 class DotConnectivityCallback(mdda.XsDotCallback):
   def __init__(self,
                on_advertisement_found: Callable,
-               on_device_disconnected: Callable):
+               on_device_disconnected: Callable,
+               on_error: Callable):
     super().__init__()
     self._on_advertisement_found = on_advertisement_found
     self._on_device_disconnected = on_device_disconnected
+    self._on_error = on_error
 
 
   def onAdvertisementFound(self, port_info):
@@ -66,7 +84,7 @@ class DotConnectivityCallback(mdda.XsDotCallback):
 
 
   def onError(self, result, error):
-    print(error)
+    self._on_error(result, error)
 
 
 class MovellaFacade:
@@ -76,17 +94,55 @@ class MovellaFacade:
                sampling_rate_hz: int,
                is_get_orientation: bool,
                is_sync_devices: bool,
-               timesteps_before_stale: int = 100) -> None:
+               timesteps_before_stale: int = 100,
+               stale_quantile: float | None = None, # NOTE: adapt `timesteps_before_stale` to this quantile of the packet lags of each device, None to keep it fixed
+               stale_bounds: tuple[int, int] = (2, 100), # NOTE: min and max of the adapted `timesteps_before_stale`
+               packet_ring_capacity: int = 1024, # NOTE: per device, packets beyond it are dropped and counted
+               buffer_capacity: int = 1024, # NOTE: timesteps of aligned snapshots held, at least `timesteps_before_stale`
+               max_gap_emitted: int | None = None, # NOTE: gaps without any device longer than this many timesteps are skipped, None to emit all
+               delivery: str = "fifo", # NOTE: "fifo" for every snapshot with `get_snapshot`, "latest" for the freshest with `get_latest_snapshot`, or "both"
+               alignment: str = "counter", # NOTE: "counter" rounds synced `sampleTimeFine` onto counters, "resample" interpolates unsynced devices onto a host-time grid
+               is_trace_latency: bool = False,
+               trace_summary_period_s: float | None = 10.0, # NOTE: None to only print the latency summary on cleanup
+               setup_attempts: int = 3, # NOTE: per device, connecting and configuring is retried for that device only
+               device_setup_timeout_s: float = 30.0, # NOTE: per device, from its advertisement to being configured
+               discovery_timeout_s: float | None = None, # NOTE: time to wait for all advertisements, None to wait forever
+               is_reconnect: bool = True, # NOTE: reconnect devices lost mid-session in the background, while the others keep streaming
+               shared_memory_name: str | None = None, # NOTE: also publish snapshots for local processes to a shared-memory ring of this name, None to not
+               shared_memory_capacity: int = 256) -> None: # NOTE: frames in the shared-memory ring, readers lagging further skip the oldest
     self._is_all_discovered_queue = queue.Queue(maxsize=1)
     self._device_mapping = device_mapping
+    self._setup_attempts = setup_attempts
+    self._device_setup_timeout_s = device_setup_timeout_s
+    self._discovery_timeout_s = discovery_timeout_s
+    self._setup_lock = threading.Lock()
+    self._setup_futures: OrderedDict[str, Future] = OrderedDict()
+    # Set once `initialize` gives up on the devices still being set up, so their workers stop before registering them.
+    self._setup_stop_event = threading.Event()
+    self._is_discovering = False
     self._discovered_devices = list()
+    # Devices lost after streaming started, and those of them handed to the reconnect supervisor, guarded by `_setup_lock`.
+    self._is_reconnect = is_reconnect
+    self._is_streaming = False
+    self._lost_device_ids: set[str] = set()
+    self._reconnecting_device_ids: set[str] = set()
+    self._reconnect_queue: queue.Queue = queue.Queue()
     self._connected_devices: OrderedDict[str, Any] = OrderedDict([(v, None) for v in device_mapping.values()])
-    sampling_period = round(1/sampling_rate_hz * 10000)
-    self._buffer = TimestampAlignedFifoBuffer(keys=device_mapping.values(),
-                                              timesteps_before_stale=timesteps_before_stale,
-                                              sampling_period=sampling_period,
-                                              num_bits_timestamp=32)
-    self._packet_queue = queue.Queue()
+    if delivery not in ("fifo", "latest", "both"):
+      raise ValueError("Unknown delivery %s."%delivery)
+    if alignment not in ("counter", "resample"):
+      raise ValueError("Unknown alignment %s."%alignment)
+    self._sampling_period = round(1/sampling_rate_hz * DOT_TICKS_PER_S)
+    # Per-device data-quality counters, shared by the alignment buffer and the SDK callbacks.
+    self._metrics = DataQualityMetrics(keys=device_mapping.values())
+    # One ring per device, so each is written by a single SDK callback thread, whichever way the SDK dispatches them.
+    self._device_index = OrderedDict([(device_id, i) for i, device_id in enumerate(device_mapping.values())])
+    self._packet_rings = [PacketRing(capacity=packet_ring_capacity, dtype=IMU_PACKET_DTYPE)
+                          for _ in self._device_index]
+    # Set by the SDK callbacks after a push, wakes the funnel thread waiting on empty rings.
+    self._packet_event = threading.Event()
+    self._no_quaternion = np.full(4, np.nan, dtype=np.float32)
+    self._packet_funneling_thread: threading.Thread | None = None
     self._master_device_id = device_mapping[master_device]
     self._sampling_rate_hz = sampling_rate_hz
     self._is_get_orientation = is_get_orientation
@@ -96,6 +152,77 @@ class MovellaFacade:
     # XsPayloadMode_CompleteQuaternion  - Quaternion, Free acceleration, Timestamp
     # XsPayloadMode_RateQuantitieswMag  - 9DOF IMU data, Timestamp
     self._payload_mode = mdda.XsPayloadMode_CustomMode4 if is_get_orientation else mdda.XsPayloadMode_RateQuantitieswMag
+    self._init_alignment(timesteps_before_stale=timesteps_before_stale,
+                         stale_quantile=stale_quantile,
+                         stale_bounds=stale_bounds,
+                         buffer_capacity=buffer_capacity,
+                         max_gap_emitted=max_gap_emitted,
+                         delivery=delivery,
+                         alignment=alignment,
+                         is_trace_latency=is_trace_latency,
+                         trace_summary_period_s=trace_summary_period_s,
+                         shared_memory_name=shared_memory_name,
+                         shared_memory_capacity=shared_memory_capacity)
+
+
+  # Sets up the alignment of the funnelled packets and its readers: stale timeout, buffer, tracer and shared-memory writer.
+  def _init_alignment(self,
+                      timesteps_before_stale: int,
+                      stale_quantile: float | None,
+                      stale_bounds: tuple[int, int],
+                      buffer_capacity: int,
+                      max_gap_emitted: int | None,
+                      delivery: str,
+                      alignment: str,
+                      is_trace_latency: bool,
+                      trace_summary_period_s: float | None,
+                      shared_memory_name: str | None,
+                      shared_memory_capacity: int) -> None:
+    # Starts from `timesteps_before_stale`, then waits for late devices as long as their recent lags call for (see `AdaptiveStaleTimeout`).
+    self._stale_timeout = AdaptiveStaleTimeout(num_keys=len(self._device_mapping),
+                                               timesteps_before_stale=timesteps_before_stale,
+                                               quantile=stale_quantile,
+                                               min_timesteps=stale_bounds[0],
+                                               max_timesteps=stale_bounds[1]) if stale_quantile is not None else None
+    # Snapshots are rows of `IMU_PACKET_DTYPE` records, one per device in order of `device_mapping`.
+    #   Without sync, each device clock is estimated against the host and its samples resampled (see `resampling.py`).
+    if alignment == "counter":
+      self._buffer = TimestampAlignedRingBuffer(keys=self._device_mapping.values(),
+                                                timesteps_before_stale=timesteps_before_stale,
+                                                num_channels=None,
+                                                sampling_period=self._sampling_period,
+                                                num_bits_timestamp=32,
+                                                capacity=buffer_capacity,
+                                                dtype=IMU_PACKET_DTYPE,
+                                                metrics=self._metrics,
+                                                is_fifo=delivery != "latest",
+                                                max_gap_emitted=max_gap_emitted,
+                                                stale_timeout=self._stale_timeout)
+    else:
+      self._buffer = ResampledAlignedRingBuffer(keys=self._device_mapping.values(),
+                                                timesteps_before_stale=timesteps_before_stale,
+                                                sampling_rate_hz=self._sampling_rate_hz,
+                                                ticks_per_s=DOT_TICKS_PER_S,
+                                                num_bits_timestamp=32,
+                                                capacity=buffer_capacity,
+                                                metrics=self._metrics,
+                                                is_fifo=delivery != "latest",
+                                                max_gap_emitted=max_gap_emitted,
+                                                stale_timeout=self._stale_timeout)
+    # Per-stage, per-device latency histograms from the SDK callback to `sendto` (see `tracing.py`).
+    self._tracer = LatencyTracer(device_ids=list(self._device_index),
+                                 ticks_per_s=DOT_TICKS_PER_S,
+                                 summary_period_s=trace_summary_period_s) if is_trace_latency else None
+    # Only the reader feeding the sender and `trace_sent` is traced: with both, the latest-only one, the FIFO one records.
+    self._is_trace_fifo = delivery == "fifo"
+    # Every snapshot with data is also copied into a shared-memory ring by the funnel thread (see `shm.py`).
+    self._shared_writer = SharedSnapshotWriter(name=shared_memory_name,
+                                               device_ids=list(self._device_index),
+                                               sampling_rate_hz=self._sampling_rate_hz,
+                                               capacity=shared_memory_capacity) if shared_memory_name is not None else None
+    self._buffer_capacity = buffer_capacity
+    self._shared_memory_capacity = shared_memory_capacity
+    self._counter_shared = 0
 
 
   def initialize(self) -> bool:
@@ -105,62 +232,89 @@ class MovellaFacade:
     if self._manager is None:
       return False
 
+    # Each mapped device is connected and configured on its own worker as soon as it advertises,
+    #   while the scan continues for the others.
+    #   Mid-session, only devices lost while streaming are handed to the reconnect supervisor, once until it is done with them.
     def on_advertisement_found(port_info) -> None:
       if not port_info.isBluetooth(): return
-      self._discovered_devices.append(port_info)
-      if len(self._discovered_devices) == len(self._device_mapping): self._is_all_discovered_queue.put(True)
+      device_id: str = str(port_info.deviceId())
+      with self._setup_lock:
+        if not self._is_discovering:
+          if device_id in self._lost_device_ids and device_id not in self._reconnecting_device_ids:
+            self._reconnecting_device_ids.add(device_id)
+            self._reconnect_queue.put(port_info)
+          return
+        if device_id not in self._device_index or device_id in self._setup_futures: return
+        self._discovered_devices.append(port_info)
+        self._setup_futures[device_id] = self._setup_executor.submit(self._setup_device, port_info)
+        if len(self._discovered_devices) == len(self._device_mapping): self._is_all_discovered_queue.put(True)
       print("discovered %s"%port_info.bluetoothAddress(), flush=True)
 
+    # Runs on the SDK thread: only copies the raw fields into the device's preallocated ring, to keep the callback short.
+    #   The SDK hands out empty vectors for fields missing from a packet, such packets are counted and dropped.
     def on_packet_received(toa_s, device, packet):
-      device_id: str = str(device.deviceId())
+      device_index = self._device_index[str(device.deviceId())]
       acc = packet.calibratedAcceleration()
       gyr = packet.calibratedGyroscopeData()
       mag = packet.calibratedMagneticField()
-      timestamp_fine = packet.sampleTimeFine()
-      data = {
-        "device_id":            device_id,
-        "acc":                  acc,
-        "gyr":                  gyr,
-        "mag":                  mag,
-        "toa_s":                toa_s,
-        "timestamp_fine":       timestamp_fine,
-      }
-      if self._is_get_orientation: data["quaternion"] = packet.orientationQuaternion()
-      self._packet_queue.put({"key": device_id, "data": data, "timestamp": timestamp_fine})
+      quaternion = packet.orientationQuaternion() if self._is_get_orientation else self._no_quaternion
+      if not (acc.size and gyr.size and mag.size and quaternion.size):
+        self._metrics.count("rejected", device_index)
+        return
+      self._packet_rings[device_index].push(device_index, packet.sampleTimeFine(), toa_s, acc, gyr, mag, quaternion)
+      # NOTE: `is_set` skips the Event's lock while the funnel thread is still busy with earlier packets.
+      if not self._packet_event.is_set():
+        self._packet_event.set()
 
     def on_device_disconnected(device):
       device_id: str = str(device.deviceId())
       print("%s disconnected"%device_id)
-      self._connected_devices[device_id] = None
+      self._metrics.count("disconnects", self._device_index[device_id])
+      # Only record the loss, the supervisor scans for the lost device again while the others keep streaming.
+      with self._setup_lock:
+        self._connected_devices[device_id] = None
+        if self._is_streaming and self._is_reconnect and device_id not in self._lost_device_ids:
+          self._lost_device_ids.add(device_id)
+          self._reconnect_queue.put(_SCAN_FOR_LOST_DEVICES)
+
+    def on_error(result, error):
+      self._metrics.count_total("sdk_errors")
+      self._metrics.logger.log(("sdk_error", result), "SDK error %s: %s", result, error)
 
     # Attach callback handler to connection manager
     self._conn_callback = DotConnectivityCallback(on_advertisement_found=on_advertisement_found,
-                                                  on_device_disconnected=on_device_disconnected)
+                                                  on_device_disconnected=on_device_disconnected,
+                                                  on_error=on_error)
     self._manager.addXsDotCallbackHandler(self._conn_callback)
 
-    # Start a scan and wait until we have found all devices
+    # Start a scan and wait until we have found all devices, connecting them concurrently meanwhile.
+    self._setup_executor = ThreadPoolExecutor(max_workers=len(self._device_mapping), thread_name_prefix="dot_setup")
+    self._setup_stop_event.clear()
+    self._is_all_discovered_queue = queue.Queue(maxsize=1)
+    self._is_discovering = True
     self._manager.enableDeviceDetection()
-    self._is_all_discovered_queue.get()
+    try:
+      is_all_discovered = self._is_all_discovered_queue.get(timeout=self._discovery_timeout_s)
+    except queue.Empty:
+      is_all_discovered = False
     self._manager.disableDeviceDetection()
-
-    for port_info in self._discovered_devices:
-      if not self._manager.openPort(port_info): 
-        print("failed to connect to %s"%port_info.bluetoothAddress(), flush=True)
-        return False
-      device = self._manager.device(port_info.deviceId())
-      device_id: str = str(port_info.deviceId())
-      self._connected_devices[device_id] = device
-      print("connected to %s"%port_info.bluetoothAddress(), flush=True)
-
-    # Make sure all connected devices have the same filter profile and output rate
-    for device_id, device in self._connected_devices.items():
-      # NOTE: getAvailableFilterProfiles suggests different low-pass setup for different activities:
-      #         'General' - general human daily activities.
-      #         'Dynamic' - high-pace activities (e.g. sprints).
-      if not device.setOnboardFilterProfile("General"):
-        return False
-      if not device.setOutputRate(self._sampling_rate_hz):
-        return False
+    with self._setup_lock:
+      self._is_discovering = False
+      setup_futures = list(self._setup_futures.items())
+    _, not_done = wait([future for _, future in setup_futures], timeout=self._device_setup_timeout_s)
+    # Workers still connecting give up after their current SDK call, which can not be interrupted.
+    #   Waiting for them ensures no device is registered or left with an open port behind the caller's back.
+    if not is_all_discovered or not_done:
+      with self._setup_lock:
+        self._setup_stop_event.set()
+    self._setup_executor.shutdown(wait=True, cancel_futures=True)
+    if not is_all_discovered:
+      print("not discovered %s"%", ".join(device_id for device_id in self._device_index if device_id not in self._setup_futures), flush=True)
+      return False
+    failed_device_ids = [device_id for device_id, future in setup_futures if future in not_done or not future.result()]
+    if failed_device_ids:
+      print("failed to set up %s"%", ".join(failed_device_ids), flush=True)
+      return False
 
     # Call facade sync function, not directly the backend manager proxy
     if self._is_sync_devices:
@@ -179,32 +333,209 @@ class MovellaFacade:
     if not self._stream():
       return False
 
-    # Funnels packets from the background thread-facing interleaved Queue of async packets, 
-    #   into aligned Deque datastructure.
-    def funnel_packets(packet_queue: queue.Queue, timeout: float = 5.0):
+    # Funnels packets from the SDK-facing per-device rings of async packets, 
+    #   into aligned ring datastructure. Waits for the SDK callbacks to signal new packets,
+    #   checking the rings and the `timeout` every `poll_period_s` at the latest.
+    def funnel_packets(timeout: float = 5.0, poll_period_s: float = 0.1):
+      t_last_packet = perf_counter()
       while True:
-        try:
-          next_packet = packet_queue.get(timeout=timeout)
-          self._buffer.plop(**next_packet)
-        except queue.Empty:
+        # Cleared before draining, so a packet pushed after the drain sets it again and is not waited out.
+        self._packet_event.clear()
+        next_packets = self._drain_packet_rings()
+        if next_packets is not None:
+          t_last_packet = perf_counter()
+          self._on_packets(next_packets, t_last_packet)
+        elif perf_counter() - t_last_packet > timeout and not self._lost_device_ids:
           print("No more packets from Movella SDK, flush buffers into the output Queue.")
-          self._buffer.flush()
+          self._flush_packets()
           break
+        else:
+          self._packet_event.wait(timeout=poll_period_s)
 
-    self._packet_funneling_thread = threading.Thread(target=funnel_packets, args=(self._packet_queue,))
+    self._packet_funneling_thread = threading.Thread(target=funnel_packets)
 
     self._data_callback = DotDataCallback(on_packet_received=on_packet_received)
     self._manager.addXsDotCallbackHandler(self._data_callback)
     self._packet_funneling_thread.start()
 
+    self._reconnect_thread = threading.Thread(target=self._supervise_reconnects, name="dot_reconnect")
+    with self._setup_lock:
+      self._is_streaming = True
+    self._reconnect_thread.start()
+
     return True
 
 
+  # Connects a discovered device and sets the same filter profile and output rate on it, runs on a setup worker.
+  #   Retries only this device, closing its port in between, until success, `setup_attempts` or the per-device timeout.
+  #   The timeout and `_setup_stop_event` are checked after every SDK call, a device past either is closed instead of registered.
+  def _setup_device(self, port_info) -> bool:
+    device_id: str = str(port_info.deviceId())
+    t_deadline_s = perf_counter() + self._device_setup_timeout_s
+    for attempt in range(self._setup_attempts):
+      if attempt:
+        self._manager.closePort(port_info)
+      if self._setup_stop_event.is_set() or perf_counter() >= t_deadline_s:
+        return False
+      if attempt:
+        print("retrying %s, %d attempts left"%(port_info.bluetoothAddress(), self._setup_attempts - attempt), flush=True)
+      if not self._manager.openPort(port_info):
+        print("failed to connect to %s"%port_info.bluetoothAddress(), flush=True)
+        continue
+      device = self._manager.device(port_info.deviceId())
+      print("connected to %s"%port_info.bluetoothAddress(), flush=True)
+      # NOTE: getAvailableFilterProfiles suggests different low-pass setup for different activities:
+      #         'General' - general human daily activities.
+      #         'Dynamic' - high-pace activities (e.g. sprints).
+      if not device.setOnboardFilterProfile("General") or not device.setOutputRate(self._sampling_rate_hz):
+        print("failed to configure %s: %s"%(port_info.bluetoothAddress(), device.lastResultText()), flush=True)
+        continue
+      with self._setup_lock:
+        if not self._setup_stop_event.is_set() and perf_counter() < t_deadline_s:
+          self._connected_devices[device_id] = device
+          return True
+      break
+    self._manager.closePort(port_info)
+    return False
+
+
+  # Background supervisor: reconnects each device lost mid-session as it advertises again, one at a time,
+  #   because syncing involves the master. Failed devices stay lost and are picked up on their next advertisement.
+  #   Also restarts the scan for devices reported lost by the SDK callbacks. Runs until `cleanup` puts None in the queue.
+  def _supervise_reconnects(self) -> None:
+    while (port_info := self._reconnect_queue.get()) is not None:
+      if not self._is_streaming:
+        continue
+      if port_info is _SCAN_FOR_LOST_DEVICES:
+        with self._setup_lock:
+          if self._is_streaming and self._lost_device_ids:
+            self._manager.enableDeviceDetection()
+        continue
+      device_id: str = str(port_info.deviceId())
+      is_reconnected = self._reconnect_device(port_info)
+      if is_reconnected:
+        self._metrics.count("reconnects", self._device_index[device_id])
+        print("reconnected %s"%port_info.bluetoothAddress(), flush=True)
+      else:
+        print("failed to reconnect %s, waiting for its next advertisement"%port_info.bluetoothAddress(), flush=True)
+      with self._setup_lock:
+        self._reconnecting_device_ids.discard(device_id)
+        if is_reconnected:
+          self._lost_device_ids.discard(device_id)
+        if not self._is_streaming:
+          continue
+        # Restarting the scan reports the devices still lost again, stop it once none are.
+        self._manager.disableDeviceDetection()
+        if self._lost_device_ids:
+          self._manager.enableDeviceDetection()
+
+
+  # Connects and configures a lost device like at startup, and re-anchors it in the alignment buffer before it streams,
+  #   so its samples land on the running counter.
+  def _reconnect_device(self, port_info) -> bool:
+    device_id: str = str(port_info.deviceId())
+    if not self._setup_device(port_info):
+      return False
+    # NOTE: a reconnected DOT has lost its sync, but the DOTs can not be synced while the others are measuring,
+    #         and a failed sync would stop it for all of them. Its sampleTimeFine is unrelated to the others' instead,
+    #         the re-anchor maps its first packet to the reference's latest counter and follows its own ticks from there,
+    #         so it only drifts by its clock error (tens of ppm) until the next session is synced.
+    self._reanchor(device_id)
+    device = self._connected_devices[device_id]
+    if device is None or not device.startMeasurement(self._payload_mode):
+      self._manager.closePort(port_info)
+      return False
+    return True
+
+
+  # Sink of the funnel thread for the packets drained from the rings, aligns them into the buffer.
+  def _on_packets(self, records: np.ndarray, t_s: float) -> None:
+    if self._tracer is not None:
+      self._tracer.record_dequeue(records, t_s)
+    self._buffer.plop_array(key_indices=records["device"],
+                            data=records,
+                            timestamps=records["timestamp_fine"])
+    if self._shared_writer is not None:
+      self._publish_shared()
+
+
+  # Called by the funnel thread once the SDK stopped producing packets.
+  def _flush_packets(self) -> None:
+    self._buffer.flush()
+    if self._shared_writer is not None:
+      self._publish_shared()
+
+
+  # Copies rows emitted since the last call into the shared-memory ring, skipping those without any data.
+  #   Only the last rows that both rings hold are kept if the buffer emitted more at once.
+  def _publish_shared(self) -> None:
+    num_emitted = self._buffer.num_emitted
+    first_counter = max(self._counter_shared, num_emitted - min(self._buffer_capacity, self._shared_memory_capacity))
+    for counter in range(first_counter, num_emitted):
+      records, is_valid = self._buffer.peek(counter, copy=False)
+      if is_valid.any():
+        self._shared_writer.publish(counter, records, is_valid)
+    self._counter_shared = num_emitted
+
+
+  # Aligns the next packet of a reconnected device to the running counter again.
+  def _reanchor(self, device_id: str) -> None:
+    self._buffer.reanchor(device_id)
+
+
+  # Takes everything the SDK callbacks produced since the last call, interleaved back in order of arrival.
+  def _drain_packet_rings(self) -> np.ndarray | None:
+    batches = [records for ring in self._packet_rings if (records := ring.pop_many()) is not None]
+    if not batches:
+      return None
+    if len(batches) == 1:
+      return batches[0]
+    records = np.concatenate(batches)
+    return records[np.argsort(records["toa_s"], kind="stable")]
+
+
+  # Number of packets dropped per device because the funnel thread fell a full ring behind the SDK callbacks.
+  def get_num_overflows(self) -> dict[str, int]:
+    return OrderedDict([(device_id, ring.num_overflows) for device_id, ring in zip(self._device_index, self._packet_rings)])
+
+
+  # Data-quality counters and effective packet rate per device (see `metrics.DEVICE_METRICS`), with ring overflows,
+  #   plus totals such as SDK errors. Cheap to call on demand from the operator loop.
+  def get_metrics(self) -> dict[str, Any]:
+    snapshot = self._metrics.get_snapshot()
+    for device_id, num_overflows in self.get_num_overflows().items():
+      snapshot["devices"][device_id]["overflows"] = num_overflows
+    if self._stale_timeout is not None:
+      snapshot["stale_timeout"] = self.get_stale_timeout()
+    return snapshot
+
+
+  # Current adapted `timesteps_before_stale` and what it trades off: the longest a snapshot waits for a missing device
+  #   and the fraction of recent packets of each device that arrive too late for it. None if the timeout is fixed.
+  def get_stale_timeout(self) -> dict[str, Any] | None:
+    if self._stale_timeout is None:
+      return None
+    tradeoff = self._stale_timeout.tradeoff()
+    return {
+      "timesteps_before_stale": tradeoff["timesteps_before_stale"],
+      "quantile": tradeoff["quantile"],
+      "max_wait_s": tradeoff["max_wait_timesteps"] / self._sampling_rate_hz,
+      "late_fractions": OrderedDict(zip(self._device_index, tradeoff["late_fractions"])),
+    }
+
+
+  def format_metrics(self) -> str:
+    return format_metrics(self.get_metrics())
+
+
   def _sync(self, attempts=1) -> bool:
     # NOTE: Syncing may not work on some devices due to poor BT drivers.
+    master_device = self._connected_devices[self._master_device_id]
+    if master_device is None:
+      return False
     while attempts > 0:
       print(f"{attempts} attempts left to sync DOTs.")
-      if self._manager.startSync(self._connected_devices[self._master_device_id].bluetoothAddress()):
+      if self._manager.startSync(master_device.bluetoothAddress()):
         return True
       else:
         attempts -= 1
@@ -228,24 +559,71 @@ class MovellaFacade:
     return True
 
 
-  def get_snapshot(self) -> dict[str, dict | None] | None:
-    return self._buffer.yeet()
+  # Oldest aligned snapshot as (counter, records of all devices, validity mask), None if timed out.
+  def get_snapshot(self) -> tuple[int, np.ndarray, np.ndarray] | None:
+    snapshot = self._buffer.yeet()
+    if snapshot is not None and self._tracer is not None and self._is_trace_fifo:
+      self._tracer.record_snapshot(snapshot, t_emit_s=self._buffer.emit_time(snapshot[0]), t_s=perf_counter())
+    return snapshot
+
+
+  # Freshest aligned snapshot not returned yet, as (counter, records of all devices, validity mask, number of snapshots skipped),
+  #   None if timed out. Older snapshots are dropped, so a stalled consumer resumes with current data instead of a backlog.
+  def get_latest_snapshot(self) -> tuple[int, np.ndarray, np.ndarray, int] | None:
+    snapshot = self._buffer.yeet_latest()
+    if snapshot is not None and self._tracer is not None and not self._is_trace_fifo:
+      self._tracer.record_snapshot(snapshot, t_emit_s=self._buffer.emit_time(snapshot[0]), t_s=perf_counter())
+    return snapshot
+
+
+  # Marks the snapshot as handed to the socket, last stage of the latency trace.
+  def trace_sent(self, snapshot: tuple[int, np.ndarray, np.ndarray]) -> None:
+    if self._tracer is not None:
+      self._tracer.record_send(snapshot, t_s=perf_counter())
+
+
+  # Latencies per stage and device since the start, None if not tracing.
+  def get_latency_summary(self) -> dict[str, dict[str, dict[str, float]]] | None:
+    return self._tracer.summary() if self._tracer is not None else None
 
 
   def cleanup(self) -> None:
+    # Stop reconnecting first, so no device starts streaming again while the others are stopped.
+    with self._setup_lock:
+      self._setup_stop_event.set()
+      is_streaming = self._is_streaming
+      self._is_streaming = False
+      self._lost_device_ids = set()
+      self._reconnecting_device_ids = set()
+    if is_streaming:
+      self._manager.disableDeviceDetection()
+      self._reconnect_queue.put(None)
+      self._reconnect_thread.join()
+      self._reconnect_queue = queue.Queue()
+    port_infos = {str(port_info.deviceId()): port_info for port_info in self._discovered_devices}
     for device_id, device in self._connected_devices.items():
       if device is not None:
         if not device.stopMeasurement():
           print("Failed to stop measurement.")
+        # Set up by an `initialize` that failed, free the port for the next attempt.
+        if not is_streaming and device_id in port_infos:
+          self._manager.closePort(port_infos[device_id])
         # if not device.disableLogging():
         #   print("Failed to disable logging.")
-        self._connected_devices[device_id] = None
+        with self._setup_lock:
+          self._connected_devices[device_id] = None
     self._is_more = False
     self._discovered_devices = list()
+    self._setup_futures = OrderedDict()
+    if self._tracer is not None:
+      print(self._tracer.format_summary(), flush=True)
     if self._is_sync_devices:
       self._manager.stopSync()
 
 
   def close(self) -> None:
     self._manager.close()
-    self._packet_funneling_thread.join()
+    if self._packet_funneling_thread is not None:
+      self._packet_funneling_thread.join()
+    if self._shared_writer is not None:
+      self._shared_writer.close()
@@ -0,0 +1,532 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+# Seeded local stand-in for the subset of `movelladot_pc_sdk` used by `MovellaHandler`.
+#   Mimics `XsDotConnectionManager` and `XsDotCallback` closely enough for `MovellaFacade` to run unmodified:
+#   N virtual DOTs advertise, connect, sync, stream at the configured output rate and disconnect,
+#   with `sampleTimeFine` wrapping around at 32 bits, per-device clock offset and drift, BLE delivery jitter,
+#   bursts after radio stalls and dropped packets.
+#   Select with `MOVELLA_BACKEND=simulator` (see `user_settings.py`) and set parameters with `configure(...)`
+#   before creating the `MovellaFacade`.
+
+import heapq
+import threading
+from typing import Any
+from collections import OrderedDict
+from time import perf_counter, sleep
+
+import numpy as np
+
+
+# Subset of the SDK enumerations referenced by the facade.
+XDS_Initial = 0
+XDS_Connected = 1
+XDS_Measurement = 2
+XDS_Destructing = 3
+
+XsPayloadMode_RateQuantitieswMag = 0
+XsPayloadMode_CompleteQuaternion = 1
+XsPayloadMode_CustomMode4 = 2
+XsPayloadMode_CustomMode5 = 3
+
+XRM_Heading = 0
+
+_PAYLOAD_MODES_WITH_QUATERNION = (XsPayloadMode_CompleteQuaternion, XsPayloadMode_CustomMode4, XsPayloadMode_CustomMode5)
+_OUTPUT_RATES_HZ = (1, 4, 10, 12, 15, 20, 30, 60, 120)
+_FILTER_PROFILES = ("General", "Dynamic")
+
+_DEFAULT_SETTINGS = {
+  "device_ids": None,               # serial numbers to advertise, generated from `num_devices` if None
+  "num_devices": 5,
+  "seed": 0,                        # drives every random draw of the simulation, same seed -> same session
+  "timestamp_hz": 10000,            # NOTE: matches the sampleTimeFine resolution assumed by `MovellaFacade`
+  "start_ticks": None,              # shared on-sensor clock value at start, random if None (set close to 2**32 to test wraparound)
+  "clock_offset_s": 5.0,            # max per-device clock offset of unsynced devices, uniform in [-x, x]
+  "clock_drift_ppm": 20.0,          # max per-device clock drift of unsynced devices, uniform in [-x, x]
+  "latency_s": 0.010,               # fixed part of the BLE delivery latency
+  "jitter_s": 0.005,                # mean of the exponentially distributed extra delivery latency
+  "burst_probability": 0.0,         # chance per sample that the radio stalls and then delivers held packets at once
+  "burst_duration_s": (0.1, 0.5),   # range of the stall duration
+  "drop_probability": 0.0,          # chance per sample that the packet never arrives
+  "empty_probability": 0.0,         # chance per sample that the packet arrives with empty data vectors, as the SDK reports missing fields
+  "disconnect_rate_hz": 0.0,        # expected disconnects per second per streaming device
+  "reconnect_delay_s": 2.0,         # time a disconnected device takes to advertise again
+  "advertisement_delay_s": 0.5,     # max time for a device to be discovered after detection is enabled
+  "connect_delay_s": 0.0,           # duration of a (blocking) `openPort` call
+  "connect_failure_probability": 0.0,
+  "sync_failure_probability": 0.0,
+  "speed": 1.0,                     # multiple of real time, 0 to run as fast as possible (load testing)
+}
+_settings = dict(_DEFAULT_SETTINGS)
+
+
+# Updates parameters used by every `XsDotConnectionManager` created afterwards.
+def configure(**kwargs) -> None:
+  unknown = set(kwargs) - set(_DEFAULT_SETTINGS)
+  if unknown:
+    raise TypeError("Unknown simulator settings: %s"%", ".join(sorted(unknown)))
+  _settings.update(kwargs)
+
+
+# Parameters used by `XsDotConnectionManager`s created now, e.g. to configure the simulator of another process alike.
+def get_settings() -> dict[str, Any]:
+  return dict(_settings)
+
+
+# Restores the default parameters.
+def reset() -> None:
+  _settings.clear()
+  _settings.update(_DEFAULT_SETTINGS)
+
+
+class XsDotCallback:
+  def onAdvertisementFound(self, port_info) -> None:
+    pass
+
+
+  def onDeviceStateChanged(self, device, new_state, old_state) -> None:
+    pass
+
+
+  def onLiveDataAvailable(self, device, packet) -> None:
+    pass
+
+
+  def onError(self, result, error) -> None:
+    pass
+
+
+class XsPortInfo:
+  def __init__(self, device_id: str, bluetooth_address: str):
+    self._device_id = device_id
+    self._bluetooth_address = bluetooth_address
+
+
+  def isBluetooth(self) -> bool:
+    return True
+
+
+  def deviceId(self) -> str:
+    return self._device_id
+
+
+  def bluetoothAddress(self) -> str:
+    return self._bluetooth_address
+
+
+class XsDataPacket:
+  def __init__(self,
+               sample_time_fine: int,
+               acc: np.ndarray,
+               gyr: np.ndarray,
+               mag: np.ndarray,
+               quaternion: np.ndarray | None):
+    self._sample_time_fine = sample_time_fine
+    self._acc = acc
+    self._gyr = gyr
+    self._mag = mag
+    self._quaternion = quaternion
+
+
+  def sampleTimeFine(self) -> int:
+    return self._sample_time_fine
+
+
+  def calibratedAcceleration(self) -> np.ndarray:
+    return self._acc
+
+
+  def calibratedGyroscopeData(self) -> np.ndarray:
+    return self._gyr
+
+
+  def calibratedMagneticField(self) -> np.ndarray:
+    return self._mag
+
+
+  def orientationQuaternion(self) -> np.ndarray:
+    return self._quaternion if self._quaternion is not None else np.empty(0)
+
+
+class XsDotDevice:
+  def __init__(self,
+               manager: "XsDotConnectionManager",
+               index: int,
+               device_id: str,
+               rng: np.random.Generator):
+    self._manager = manager
+    self._device_id = device_id
+    self._bluetooth_address = "D4:22:CD:00:%02X:%02X"%(index // 256, index % 256)
+    self._port_info = XsPortInfo(device_id, self._bluetooth_address)
+    self._rng = rng
+    self._last_result_text = ""
+    self._state = XDS_Initial
+    self._is_advertising = True
+    self._output_rate = 60
+    self._filter_profile = "General"
+    self._payload_mode = XsPayloadMode_RateQuantitieswMag
+    self._unsync()
+    # Static random mounting orientation, sensor readings are the world reference vectors rotated into the sensor frame.
+    quaternion = rng.standard_normal(4)
+    self._quaternion = quaternion / np.linalg.norm(quaternion)
+    rotation = _quaternion_to_rotation_matrix(self._quaternion)
+    self._gravity = rotation.T @ np.array([0.0, 0.0, 9.81])
+    self._magnetic_field = rotation.T @ np.array([0.4, 0.0, -0.9])
+    self._motion_axis = rotation.T @ np.array([0.0, 1.0, 0.0])
+    # Streaming state, `_generation` invalidates events scheduled before the last stop/disconnect.
+    self._generation = 0
+    self._sample_id = 0
+    self._t_start = 0.0
+    self._t_last_delivery = 0.0
+    self._t_hold_until = 0.0
+
+
+  # Unsynced device clocks start apart and tick at slightly different rates, a reconnected device has lost its sync.
+  def _unsync(self) -> None:
+    settings = self._manager._settings
+    self._clock_offset_s = self._rng.uniform(-1, 1) * settings["clock_offset_s"]
+    self._clock_drift = self._rng.uniform(-1, 1) * settings["clock_drift_ppm"] * 1e-6
+
+
+  def deviceId(self) -> str:
+    return self._device_id
+
+
+  def bluetoothAddress(self) -> str:
+    return self._bluetooth_address
+
+
+  def portInfo(self) -> XsPortInfo:
+    return self._port_info
+
+
+  def lastResultText(self) -> str:
+    return self._last_result_text
+
+
+  def setOnboardFilterProfile(self, profile: str) -> bool:
+    if self._state == XDS_Initial or profile not in _FILTER_PROFILES:
+      self._last_result_text = "Invalid filter profile or device not connected."
+      return False
+    self._filter_profile = profile
+    return True
+
+
+  def setOutputRate(self, rate_hz: int) -> bool:
+    if self._state == XDS_Initial or rate_hz not in _OUTPUT_RATES_HZ:
+      self._last_result_text = "Invalid output rate or device not connected."
+      return False
+    self._output_rate = rate_hz
+    return True
+
+
+  def startMeasurement(self, payload_mode: int) -> bool:
+    if self._state != XDS_Connected:
+      self._last_result_text = "Device not connected or already measuring."
+      return False
+    self._payload_mode = payload_mode
+    with self._manager._cv:
+      self._manager._start_streaming(self)
+    return True
+
+
+  def stopMeasurement(self) -> bool:
+    if self._state != XDS_Measurement:
+      self._last_result_text = "Device is not measuring."
+      return False
+    with self._manager._cv:
+      self._manager._stop_streaming(self)
+    return True
+
+
+  def resetOrientation(self, reset_mode: int) -> bool:
+    return self._state != XDS_Initial
+
+
+  def setLogOptions(self, log_options: Any) -> bool:
+    return True
+
+
+  def enableLogging(self, file_name: str) -> bool:
+    self._last_result_text = "On-device logging is not simulated."
+    return False
+
+
+  def disableLogging(self) -> bool:
+    return True
+
+
+  # Clock reading of the device at simulation time `t`, wraps around at 32 bits like the DOT sampleTimeFine.
+  def _sample_time_fine(self, t: float) -> int:
+    settings = self._manager._settings
+    return int(round(self._manager._start_ticks + (t * (1 + self._clock_drift) + self._clock_offset_s) * settings["timestamp_hz"])) % 2**32
+
+
+  def _make_packet(self, t: float, is_empty: bool) -> XsDataPacket:
+    if is_empty:
+      return XsDataPacket(sample_time_fine=self._sample_time_fine(t), acc=np.empty(0), gyr=np.empty(0), mag=np.empty(0), quaternion=None)
+    noise = self._rng.standard_normal(9)
+    sway = np.sin(2 * np.pi * 0.8 * t)
+    acc = self._gravity + 0.5 * sway * self._motion_axis + 0.05 * noise[0:3]
+    gyr = 30.0 * sway * self._motion_axis + 0.5 * noise[3:6]
+    mag = self._magnetic_field + 0.01 * noise[6:9]
+    quaternion = self._quaternion.copy() if self._payload_mode in _PAYLOAD_MODES_WITH_QUATERNION else None
+    return XsDataPacket(sample_time_fine=self._sample_time_fine(t), acc=acc, gyr=gyr, mag=mag, quaternion=quaternion)
+
+
+class XsDotConnectionManager:
+  def __init__(self):
+    self._settings = dict(_settings)
+    settings = self._settings
+    seed_sequence = np.random.SeedSequence(settings["seed"])
+    self._rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+    device_ids = settings["device_ids"]
+    if device_ids is None:
+      device_ids = ["D0751M000%07X"%i for i in range(settings["num_devices"])]
+    device_rngs = [np.random.default_rng(s) for s in seed_sequence.spawn(len(device_ids))]
+    self._start_ticks = int(self._rng.integers(0, 2**32)) if settings["start_ticks"] is None else settings["start_ticks"]
+    self._devices: OrderedDict[str, XsDotDevice] = OrderedDict(
+      [(device_id, XsDotDevice(manager=self, index=i, device_id=device_id, rng=rng))
+       for i, (device_id, rng) in enumerate(zip(device_ids, device_rngs))])
+    self._handlers: list[XsDotCallback] = list()
+    self._is_detecting = False
+    # Time-ordered events of the simulation, processed by a single background thread like the SDK's callback thread.
+    self._events: list[tuple[float, int, Any, tuple]] = list()
+    self._event_id = 0
+    self._cv = threading.Condition()
+    self._is_running = True
+    self._t_origin = perf_counter()
+    self._t_virtual = 0.0
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+
+  def addXsDotCallbackHandler(self, handler: XsDotCallback) -> None:
+    with self._cv:
+      self._handlers.append(handler)
+
+
+  def removeXsDotCallbackHandler(self, handler: XsDotCallback) -> None:
+    with self._cv:
+      self._handlers.remove(handler)
+
+
+  def enableDeviceDetection(self) -> bool:
+    with self._cv:
+      self._is_detecting = True
+      now = self._now()
+      for device in self._devices.values():
+        if device._state == XDS_Initial and device._is_advertising:
+          self._schedule(now + self._rng.uniform(0, self._settings["advertisement_delay_s"]), self._advertise, device)
+    return True
+
+
+  def disableDeviceDetection(self) -> None:
+    with self._cv:
+      self._is_detecting = False
+
+
+  def openPort(self, port_info: XsPortInfo) -> bool:
+    device = self._devices.get(port_info.deviceId())
+    if device is None:
+      return False
+    if self._settings["speed"] > 0 and self._settings["connect_delay_s"] > 0:
+      sleep(self._settings["connect_delay_s"] / self._settings["speed"])
+    with self._cv:
+      if device._state != XDS_Initial or self._rng.random() < self._settings["connect_failure_probability"]:
+        return False
+      device._state = XDS_Connected
+      device._is_advertising = False
+    return True
+
+
+  def closePort(self, port_info: XsPortInfo) -> None:
+    device = self._devices.get(port_info.deviceId())
+    if device is not None:
+      with self._cv:
+        self._disconnect(device)
+
+
+  def device(self, device_id: str) -> XsDotDevice | None:
+    device = self._devices.get(device_id)
+    return device if device is not None and device._state != XDS_Initial else None
+
+
+  # Successful sync aligns the clocks of all connected devices to the master (given by its address).
+  #   Like the DOTs, fails while any device is measuring.
+  def startSync(self, master_address: str) -> bool:
+    with self._cv:
+      connected = [device for device in self._devices.values() if device._state != XDS_Initial]
+      if any(device._state == XDS_Measurement for device in connected):
+        return False
+      if not any(device._bluetooth_address == master_address for device in connected):
+        return False
+      if self._rng.random() < self._settings["sync_failure_probability"]:
+        return False
+      for device in connected:
+        device._clock_offset_s = 0.0
+        device._clock_drift = 0.0
+    return True
+
+
+  def stopSync(self) -> bool:
+    return True
+
+
+  def close(self) -> None:
+    with self._cv:
+      self._is_running = False
+      self._cv.notify()
+    self._thread.join()
+
+
+  def _now(self) -> float:
+    if self._settings["speed"] > 0:
+      return (perf_counter() - self._t_origin) * self._settings["speed"]
+    return self._t_virtual
+
+
+  # NOTE: must be called with `_cv` held.
+  def _schedule(self, t: float, fn, *args) -> None:
+    self._event_id += 1
+    heapq.heappush(self._events, (t, self._event_id, fn, args))
+    self._cv.notify()
+
+
+  def _run(self) -> None:
+    speed = self._settings["speed"]
+    while True:
+      with self._cv:
+        while self._is_running:
+          if not self._events:
+            self._cv.wait()
+          elif speed > 0 and (delay := (self._events[0][0] - self._now()) / speed) > 0:
+            self._cv.wait(timeout=delay)
+          else:
+            break
+        if not self._is_running:
+          return
+        t, _, fn, args = heapq.heappop(self._events)
+        self._t_virtual = max(self._t_virtual, t)
+        handlers = tuple(self._handlers)
+        notification = fn(t, *args)
+      # User callbacks run outside of the lock, they are allowed to call back into the manager.
+      if notification is not None:
+        method_name, method_args = notification
+        for handler in handlers:
+          getattr(handler, method_name)(*method_args)
+
+
+  # Event handlers return the callback to invoke on the registered handlers, if any.
+  def _advertise(self, t: float, device: XsDotDevice) -> tuple[str, tuple] | None:
+    if not self._is_detecting or device._state != XDS_Initial or not device._is_advertising:
+      return None
+    return ("onAdvertisementFound", (device._port_info,))
+
+
+  def _readvertise(self, t: float, device: XsDotDevice) -> tuple[str, tuple] | None:
+    device._is_advertising = True
+    return self._advertise(t, device)
+
+
+  # NOTE: must be called with `_cv` held.
+  def _start_streaming(self, device: XsDotDevice) -> None:
+    device._state = XDS_Measurement
+    device._generation += 1
+    device._sample_id = 0
+    # Devices sample on a shared grid of the output rate, like synced DOTs, also when one starts later than the others.
+    device._t_start = np.ceil(self._now() * device._output_rate) / device._output_rate
+    device._t_last_delivery = device._t_start
+    device._t_hold_until = device._t_start
+    self._schedule_next_sample(device)
+
+
+  # NOTE: must be called with `_cv` held.
+  def _stop_streaming(self, device: XsDotDevice) -> None:
+    device._state = XDS_Connected
+    device._generation += 1
+
+
+  # NOTE: must be called with `_cv` held.
+  def _disconnect(self, device: XsDotDevice) -> tuple[str, tuple] | None:
+    if device._state == XDS_Initial:
+      return None
+    old_state = device._state
+    device._state = XDS_Initial
+    device._generation += 1
+    device._unsync()
+    self._schedule(self._now() + self._settings["reconnect_delay_s"], self._readvertise, device)
+    return ("onDeviceStateChanged", (device, XDS_Destructing, old_state))
+
+
+  def _on_disconnect(self, t: float, device: XsDotDevice, generation: int) -> tuple[str, tuple] | None:
+    if generation != device._generation:
+      return None
+    return self._disconnect(device)
+
+
+  # NOTE: must be called with `_cv` held.
+  def _schedule_next_sample(self, device: XsDotDevice) -> None:
+    settings = self._settings
+    rng = device._rng
+    t_sample = device._t_start + device._sample_id / device._output_rate
+    if settings["disconnect_rate_hz"] > 0 and rng.random() < settings["disconnect_rate_hz"] / device._output_rate:
+      self._schedule(t_sample, self._on_disconnect, device, device._generation)
+      return
+    # A radio stall holds back every sample generated until it ends, which then arrive as a burst.
+    if settings["burst_probability"] > 0 and rng.random() < settings["burst_probability"]:
+      device._t_hold_until = max(device._t_hold_until, t_sample + rng.uniform(*settings["burst_duration_s"]))
+    latency = settings["latency_s"] + (rng.exponential(settings["jitter_s"]) if settings["jitter_s"] > 0 else 0.0)
+    # BLE notifications of one device arrive in order.
+    t_delivery = max(max(t_sample, device._t_hold_until) + latency, device._t_last_delivery)
+    device._t_last_delivery = t_delivery
+    is_dropped = settings["drop_probability"] > 0 and rng.random() < settings["drop_probability"]
+    is_empty = settings["empty_probability"] > 0 and rng.random() < settings["empty_probability"]
+    self._schedule(t_delivery, self._deliver_sample, device, device._generation, t_sample, is_dropped, is_empty)
+    device._sample_id += 1
+
+
+  def _deliver_sample(self,
+                      t: float,
+                      device: XsDotDevice,
+                      generation: int,
+                      t_sample: float,
+                      is_dropped: bool,
+                      is_empty: bool) -> tuple[str, tuple] | None:
+    if generation != device._generation:
+      return None
+    self._schedule_next_sample(device)
+    if is_dropped:
+      return None
+    return ("onLiveDataAvailable", (device, device._make_packet(t_sample, is_empty)))
+
+
+def _quaternion_to_rotation_matrix(q: np.ndarray) -> np.ndarray:
+  w, x, y, z = q
+  return np.array([[1 - 2*(y*y + z*z), 2*(x*y - w*z),     2*(x*z + w*y)],
+                   [2*(x*y + w*z),     1 - 2*(x*x + z*z), 2*(y*z - w*x)],
+                   [2*(x*z - w*y),     2*(y*z + w*x),     1 - 2*(x*x + y*y)]])
@@ -0,0 +1,170 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import numpy as np
+
+
+# Orientation of every tracker estimated on the host from acc/gyr/mag, so quaternions need not be streamed over BLE.
+#   Mahony-style complementary filter: the gyroscope rate is integrated, corrected by the cross products between the measured
+#   and the estimated directions of gravity and of magnetic north, proportional (`kp`) and integral (`ki`).
+#   All trackers are updated together with one set of NumPy operations per snapshot.
+#   Quaternions are (w, x, y, z), rotating sensor frame vectors into the earth frame (z up, x along magnetic north),
+#   the same as `orientationQuaternion` of the DOTs.
+#   Trackers missing from a snapshot keep their state and output NaN, ones without a valid magnetometer reading are corrected
+#   from the accelerometer only (heading then drifts with the gyroscope bias), and after a gap longer than `max_gap_s`
+#   (or on the first reading, and the first with the magnetometer) the orientation is set directly from the accelerometer and magnetometer.
+class MahonyAHRS:
+  def __init__(self,
+               num_trackers: int,
+               sampling_rate_hz: float, # NOTE: rate of the snapshot counter, the time step is derived from counter differences
+               kp: float = 1.0, # NOTE: higher trusts the accelerometer and magnetometer more, converges faster but passes more motion noise
+               ki: float = 0.0, # NOTE: > 0 estimates the gyroscope bias
+               max_gap_s: float = 1.0,
+               is_gyr_deg_s: bool = True): # NOTE: DOTs report deg/s
+    self._sampling_period_s = 1.0 / sampling_rate_hz
+    self._kp = kp
+    self._ki = ki
+    self._max_gap_s = max_gap_s
+    self._gyr_scale = np.pi / 180.0 if is_gyr_deg_s else 1.0
+    self._quaternions = np.zeros((num_trackers, 4), dtype=np.float64)
+    self._bias_integral = np.zeros((num_trackers, 3), dtype=np.float64)
+    self._last_counters = np.full(num_trackers, -1, dtype=np.int64)
+    self._is_initialized = np.zeros(num_trackers, dtype=bool)
+    self._is_heading_initialized = np.zeros(num_trackers, dtype=bool)
+    self._output = np.full((num_trackers, 4), np.nan, dtype=np.float32)
+
+
+  @property
+  def quaternions(self) -> np.ndarray:
+    return self._output
+
+
+  def reset(self) -> None:
+    self._bias_integral.fill(0)
+    self._last_counters.fill(-1)
+    self._is_initialized.fill(False)
+    self._is_heading_initialized.fill(False)
+    self._output.fill(np.nan)
+
+
+  # Same from a snapshot (counter, `IMU_PACKET_DTYPE` records, validity mask, ...) of `MovellaFacade`.
+  def update_snapshot(self, snapshot: tuple) -> np.ndarray:
+    counter, records, is_valid = snapshot[:3]
+    return self.update(counter=counter, acc=records["acc"], gyr=records["gyr"], mag=records["mag"], is_valid=is_valid)
+
+
+  # Advances the trackers valid in the snapshot to `counter`, returns the (num_trackers, 4) float32 quaternions,
+  #   NaN for trackers not in the snapshot. The returned array is reused by the next call.
+  def update(self,
+             counter: int,
+             acc: np.ndarray,
+             gyr: np.ndarray,
+             mag: np.ndarray,
+             is_valid: np.ndarray) -> np.ndarray:
+    acc = np.asarray(acc, dtype=np.float64)
+    gyr = np.asarray(gyr, dtype=np.float64) * self._gyr_scale
+    mag = np.asarray(mag, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+      acc_norm = np.sqrt(np.einsum("ij,ij->i", acc, acc))
+      mag_norm = np.sqrt(np.einsum("ij,ij->i", mag, mag))
+      is_valid = is_valid & np.isfinite(gyr).all(axis=1) & (acc_norm > 0)
+      is_mag = is_valid & (mag_norm > 0)
+      acc = acc / acc_norm[:, None]
+      mag = np.where(is_mag[:, None], mag / mag_norm[:, None], 0.0)
+      dt_s = (counter - self._last_counters) * self._sampling_period_s
+      # Also sets the heading of trackers initialized without a magnetometer reading, once one arrives.
+      is_reset = is_valid & (~self._is_initialized | (dt_s > self._max_gap_s) | (dt_s <= 0) | (is_mag & ~self._is_heading_initialized))
+      is_update = is_valid & ~is_reset
+
+      q = self._quaternions
+      q0, q1, q2, q3 = q.T
+      # Estimated up and north in the sensor frame (rows of the rotation matrix), against the measured gravity and horizontal
+      #   magnetic field. Heading is corrected from the horizontal part alone, normalized, so its gain does not shrink with the
+      #   field's inclination and magnetic disturbances do not tilt the estimate.
+      up = np.stack([2*(q1*q3 - q0*q2), 2*(q2*q3 + q0*q1), 1 - 2*(q1*q1 + q2*q2)], axis=1)
+      north = np.stack([1 - 2*(q2*q2 + q3*q3), 2*(q1*q2 - q0*q3), 2*(q1*q3 + q0*q2)], axis=1)
+      mag_horizontal = mag - np.einsum("ij,ij->i", mag, up)[:, None] * up
+      mag_horizontal_norm = np.sqrt(np.einsum("ij,ij->i", mag_horizontal, mag_horizontal))
+      is_heading = is_mag & (mag_horizontal_norm > 1e-3)
+      mag_horizontal = np.where(is_heading[:, None], mag_horizontal / mag_horizontal_norm[:, None], 0.0)
+      error = _cross(acc, up) + _cross(mag_horizontal, north)
+      if self._ki > 0:
+        self._bias_integral += np.where(is_update[:, None], self._ki * error * dt_s[:, None], 0.0)
+        gyr = gyr + self._bias_integral
+      gyr = gyr + self._kp * error
+
+      # q += 1/2 q x (0, gyr) dt, then renormalized.
+      half_dt = 0.5 * dt_s
+      gx, gy, gz = (gyr * half_dt[:, None]).T
+      q_next = np.stack([q0 - q1*gx - q2*gy - q3*gz,
+                         q1 + q0*gx + q2*gz - q3*gy,
+                         q2 + q0*gy - q1*gz + q3*gx,
+                         q3 + q0*gz + q1*gy - q2*gx], axis=1)
+      q_next /= np.sqrt(np.einsum("ij,ij->i", q_next, q_next))[:, None]
+
+      if is_reset.any():
+        q_next[is_reset] = _quaternions_from_acc_mag(acc=acc[is_reset], mag=mag[is_reset], is_mag=is_mag[is_reset])
+    self._quaternions = np.where((is_update | is_reset)[:, None], q_next, q)
+    self._bias_integral[is_reset] = 0
+    self._last_counters[is_valid] = counter
+    self._is_initialized |= is_reset
+    self._is_heading_initialized = np.where(is_reset, is_mag, self._is_heading_initialized | is_mag)
+    self._output[:] = self._quaternions
+    self._output[~is_valid] = np.nan
+    return self._output
+
+
+# Row-wise cross product of (N, 3) arrays, cheaper than `np.cross` for a handful of rows.
+def _cross(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+  ax, ay, az = a.T
+  bx, by, bz = b.T
+  return np.stack([ay*bz - az*by, az*bx - ax*bz, ax*by - ay*bx], axis=1)
+
+
+# Orientation with gravity along the normalized `acc` and north along the horizontal part of the normalized `mag`,
+#   heading 0 where `is_mag` is False.
+def _quaternions_from_acc_mag(acc: np.ndarray, mag: np.ndarray, is_mag: np.ndarray) -> np.ndarray:
+  # Rows of the rotation matrix are the earth axes expressed in the sensor frame.
+  up = acc
+  north = np.where(is_mag[:, None], mag, np.array([1.0, 0.0, 0.0]))
+  north = north - np.einsum("ij,ij->i", north, up)[:, None] * up
+  # Sensor x (nearly) vertical without a magnetometer reading, take sensor y as north instead.
+  is_degenerate = np.einsum("ij,ij->i", north, north) < 1e-6
+  north = np.where(is_degenerate[:, None], np.array([0.0, 1.0, 0.0]) - up[:, 1:2] * up, north)
+  north /= np.sqrt(np.einsum("ij,ij->i", north, north))[:, None]
+  west = _cross(up, north)
+  rotation = np.stack([north, west, up], axis=1)
+  # Symmetric matrix of 4 q_i q_j from the rotation matrix, its row with the largest diagonal is the best-conditioned multiple of q.
+  (r00, r01, r02), (r10, r11, r12), (r20, r21, r22) = rotation.transpose(1, 2, 0)
+  products = np.stack([np.stack([1 + r00 + r11 + r22, r21 - r12,           r02 - r20,           r10 - r01], axis=1),
+                       np.stack([r21 - r12,           1 + r00 - r11 - r22, r01 + r10,           r02 + r20], axis=1),
+                       np.stack([r02 - r20,           r01 + r10,           1 - r00 + r11 - r22, r12 + r21], axis=1),
+                       np.stack([r10 - r01,           r02 + r20,           r12 + r21,           1 - r00 - r11 + r22], axis=1)], axis=1)
+  rows = np.argmax(np.diagonal(products, axis1=1, axis2=2), axis=1)
+  q = products[np.arange(len(rows)), rows]
+  q = q * np.where(q[:, :1] < 0, -1.0, 1.0)
+  return q / np.sqrt(np.einsum("ij,ij->i", q, q))[:, None]
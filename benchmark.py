@@ -0,0 +1,425 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+# Reproducible benchmarks of the alignment and sending hot paths on synthetic DOT streams, saved as JSON to compare runs:
+#   python benchmark.py                                        # full suite, to benchmark_<time>.json
+#   python benchmark.py --quick --output before.json           # shorter workloads
+#   python benchmark.py --compare before.json                  # flag regressions against an earlier run, exits with 1 if any
+#   python benchmark.py --scenario 40dev_120hz_stress --repeat 5
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import tracemalloc
+from dataclasses import asdict, dataclass
+from time import perf_counter, process_time, strftime
+from typing import Any, Callable
+
+import numpy as np
+
+from datastructures import IMU_PACKET_DTYPE, TimestampAlignedFifoBuffer, TimestampAlignedRingBuffer, TimestampToCounterConverter
+from metrics import DataQualityMetrics
+from protocol import ENCODING_FLOAT32, ENCODING_INT16, ENCODING_SMALLEST_THREE, WIRE_FORMAT_V1
+from sender import SnapshotSender
+
+
+BENCHMARK_VERSION = 1
+_TICKS_PER_S = 10000
+_POLL_PERIOD_S = 0.001 # NOTE: packets arriving within one poll of the funnel thread are handed to the ring buffer together
+
+
+# Synthetic stream of synced DOTs, see `make_workload`.
+@dataclass
+class Workload:
+  name: str
+  num_devices: int
+  sampling_rate_hz: int
+  duration_s: float = 30.0
+  latency_s: float = 0.010 # NOTE: fixed part of the delivery latency
+  jitter_s: float = 0.005 # NOTE: mean of the exponentially distributed extra delivery latency
+  burst_probability: float = 0.0 # NOTE: chance per sample that the radio of the device stalls, then delivers the held packets at once
+  burst_duration_s: tuple[float, float] = (0.1, 0.5)
+  drop_probability: float = 0.0 # NOTE: chance per packet to be lost
+  num_dropouts: int = 0 # NOTE: periods per device out of range, without any packets
+  dropout_duration_s: tuple[float, float] = (1.0, 3.0)
+  start_ticks: int = 0 # NOTE: close to 2**32 for the sampleTimeFine of all devices to wrap around during the stream
+  seed: int = 0
+
+
+# Scenarios spanning 5 to 40 DOTs at 30 to 120 Hz, each stressing a different path of the alignment.
+SCENARIOS = [
+  Workload(name="5dev_60hz_clean", num_devices=5, sampling_rate_hz=60, jitter_s=0.002),
+  Workload(name="5dev_120hz_bursts", num_devices=5, sampling_rate_hz=120, burst_probability=0.001),
+  Workload(name="10dev_60hz_wrap", num_devices=10, sampling_rate_hz=60, start_ticks=2**32 - 10 * _TICKS_PER_S),
+  Workload(name="20dev_60hz_dropouts", num_devices=20, sampling_rate_hz=60, drop_probability=0.01, num_dropouts=2),
+  Workload(name="40dev_30hz_jitter", num_devices=40, sampling_rate_hz=30, jitter_s=0.02),
+  Workload(name="40dev_120hz_stress", num_devices=40, sampling_rate_hz=120, jitter_s=0.01, burst_probability=0.0005,
+           drop_probability=0.005, num_dropouts=1, start_ticks=2**32 - 15 * _TICKS_PER_S),
+]
+# Metrics where higher is better for `compare`, the others are costs except the counts ("num_...") which are not compared.
+_HIGHER_IS_BETTER = ("packets_per_s", "snapshots_per_s")
+
+
+# `IMU_PACKET_DTYPE` records of all devices in order of arrival, with `toa_s` the arrival time from the start of the stream.
+#   Devices sample on a shared grid (synced) and deliver in order, as over BLE.
+def make_workload(workload: Workload) -> np.ndarray:
+  rng = np.random.default_rng(workload.seed)
+  num_samples = int(workload.duration_s * workload.sampling_rate_hz)
+  t_sample_s = np.arange(num_samples) / workload.sampling_rate_hz
+  ticks = (workload.start_ticks + np.round(t_sample_s * _TICKS_PER_S).astype(np.int64)) % 2**32
+  devices = []
+  for device in range(workload.num_devices):
+    # A stall holds back every sample until it ends, overlapping stalls hold until the last one ends.
+    hold_until_s = np.where(rng.random(num_samples) < workload.burst_probability,
+                            t_sample_s + rng.uniform(*workload.burst_duration_s, size=num_samples),
+                            -np.inf)
+    hold_until_s = np.maximum.accumulate(hold_until_s)
+    t_delivery_s = np.maximum(t_sample_s, hold_until_s) + workload.latency_s + rng.exponential(workload.jitter_s, size=num_samples)
+    t_delivery_s = np.maximum.accumulate(t_delivery_s)
+    is_kept = rng.random(num_samples) >= workload.drop_probability
+    for _ in range(workload.num_dropouts):
+      t_start_s = rng.uniform(0, workload.duration_s)
+      is_kept &= (t_sample_s < t_start_s) | (t_sample_s >= t_start_s + rng.uniform(*workload.dropout_duration_s))
+    records = np.zeros(int(is_kept.sum()), dtype=IMU_PACKET_DTYPE)
+    records["device"] = device
+    records["timestamp_fine"] = ticks[is_kept]
+    records["toa_s"] = t_delivery_s[is_kept]
+    records["acc"] = rng.standard_normal((len(records), 3)) + [0.0, 0.0, 9.81]
+    records["gyr"] = rng.standard_normal((len(records), 3))
+    records["mag"] = rng.standard_normal((len(records), 3))
+    records["quaternion"] = [1.0, 0.0, 0.0, 0.0]
+    devices.append(records)
+  records = np.concatenate(devices)
+  return records[np.argsort(records["toa_s"], kind="stable")]
+
+
+# Slices of packets arriving within the same poll of the funnel thread.
+def _poll_batches(records: np.ndarray) -> list[slice]:
+  polls = np.floor(records["toa_s"] / _POLL_PERIOD_S).astype(np.int64)
+  bounds = np.flatnonzero(np.diff(polls)) + 1
+  starts = np.concatenate(([0], bounds))
+  ends = np.concatenate((bounds, [len(records)]))
+  return [slice(start, end) for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def _device_ids(workload: Workload) -> list[str]:
+  return ["D%02d"%i for i in range(workload.num_devices)]
+
+
+# Warnings of the buffers (late packets, timeouts on an empty buffer) would flood the output, they are counted in their metrics.
+def _metrics(workload: Workload) -> DataQualityMetrics:
+  return DataQualityMetrics(keys=_device_ids(workload), log_period_s=float("inf"))
+
+
+def _percentile(values: list[float] | np.ndarray, q: float) -> float | None:
+  return float(np.percentile(values, q)) if len(values) else None
+
+
+# Runs `fn(records)` `repeat` times and keeps the fastest, then once more under `tracemalloc` for its peak memory.
+#   `fn` returns the number of items processed and extra results of the run.
+def _measure(fn: Callable[[], tuple[int, dict[str, Any]]], repeat: int, unit: str = "packets") -> dict[str, Any]:
+  best: dict[str, Any] | None = None
+  for _ in range(repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+      t_wall_s = perf_counter()
+      t_cpu_s = process_time()
+      num_items, extra = fn()
+      t_cpu_s = process_time() - t_cpu_s
+      t_wall_s = perf_counter() - t_wall_s
+    if best is None or t_cpu_s < best["cpu_s"]:
+      best = {"cpu_s": t_cpu_s, "wall_s": t_wall_s, "num_items": num_items, **extra}
+  with contextlib.redirect_stdout(io.StringIO()):
+    tracemalloc.start()
+    fn()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+  return {
+    unit + "_per_s": best["num_items"] / best["wall_s"] if best["wall_s"] > 0 else None,
+    "cpu_us_per_" + unit[:-1]: best["cpu_s"] / best["num_items"] * 1e6 if best["num_items"] else None,
+    "peak_memory_bytes": peak_bytes,
+    **{k: v for k, v in best.items() if k not in ("cpu_s", "wall_s", "num_items")},
+  }
+
+
+def bench_converter_scalar(workload: Workload, records: np.ndarray) -> tuple[int, dict[str, Any]]:
+  converter = TimestampToCounterConverter(keys=_device_ids(workload),
+                                          sampling_period=round(_TICKS_PER_S / workload.sampling_rate_hz),
+                                          num_bits_timestamp=32)
+  keys = _device_ids(workload)
+  num_rejected = 0
+  for key_index, timestamp in zip(records["device"].tolist(), records["timestamp_fine"].tolist()):
+    num_rejected += converter.counter_from_timestamp(keys[key_index], timestamp) is None
+  return len(records), {"num_rejected": num_rejected}
+
+
+def bench_converter_batch(workload: Workload, records: np.ndarray, batches: list[slice]) -> tuple[int, dict[str, Any]]:
+  converter = TimestampToCounterConverter(keys=_device_ids(workload),
+                                          sampling_period=round(_TICKS_PER_S / workload.sampling_rate_hz),
+                                          num_bits_timestamp=32)
+  num_rejected = 0
+  for batch in batches:
+    num_rejected += converter.counters_from_batch(key_indices=records["device"][batch],
+                                                  timestamps=records["timestamp_fine"][batch]).count(None)
+  return len(records), {"num_rejected": num_rejected}
+
+
+# Per-packet `plop` of dicts and draining every snapshot with `yeet` after each packet, then `flush`.
+#   Latencies: from the `plop` of a packet to the `yeet` of its snapshot (processing time of the replay), and in stream time
+#   from its arrival to the arrival of the packet that released its snapshot (the wait for the other devices).
+def bench_fifo(workload: Workload, records: np.ndarray) -> tuple[int, dict[str, Any]]:
+  metrics = _metrics(workload)
+  buffer = TimestampAlignedFifoBuffer(keys=_device_ids(workload),
+                                      timesteps_before_stale=10,
+                                      sampling_period=round(_TICKS_PER_S / workload.sampling_rate_hz),
+                                      num_bits_timestamp=32,
+                                      metrics=metrics)
+  keys = _device_ids(workload)
+  toa_s = records["toa_s"].tolist()
+  t_plop_s = [0.0] * len(records)
+  latencies_s, release_delays_s = [], []
+  num_snapshots = 0
+
+  def drain(t_release_s: float) -> int:
+    num_yeeted = 0
+    while (snapshot := buffer.yeet(timeout=0)) is not None:
+      t_yeet_s = perf_counter()
+      for data in snapshot.values():
+        if data is not None:
+          latencies_s.append(t_yeet_s - t_plop_s[data["index"]])
+          release_delays_s.append(t_release_s - toa_s[data["index"]])
+      num_yeeted += 1
+    return num_yeeted
+
+  for index, (key_index, timestamp) in enumerate(zip(records["device"].tolist(), records["timestamp_fine"].tolist())):
+    t_plop_s[index] = perf_counter()
+    buffer.plop(key=keys[key_index], data={"index": index}, timestamp=timestamp)
+    num_snapshots += drain(toa_s[index])
+  buffer.flush()
+  num_snapshots += drain(toa_s[-1])
+  return len(records), _latency_results(latencies_s, release_delays_s, num_snapshots, metrics)
+
+
+# As the funnel thread of `MovellaFacade`: `plop_array` of each poll's packets, draining every snapshot with `yeet` after each.
+def bench_ring(workload: Workload, records: np.ndarray, batches: list[slice]) -> tuple[int, dict[str, Any]]:
+  metrics = _metrics(workload)
+  buffer = TimestampAlignedRingBuffer(keys=_device_ids(workload),
+                                      timesteps_before_stale=10,
+                                      num_channels=None,
+                                      sampling_period=round(_TICKS_PER_S / workload.sampling_rate_hz),
+                                      num_bits_timestamp=32,
+                                      dtype=IMU_PACKET_DTYPE,
+                                      metrics=metrics)
+  # Arrival times are unique per packet, they identify it in the snapshots.
+  #   NOTE: contiguous, `searchsorted` would otherwise copy the strided field of all records on every snapshot.
+  toa_s = np.ascontiguousarray(records["toa_s"])
+  t_plop_s = np.zeros(len(records), dtype=np.float64)
+  latencies_s, release_delays_s = [], []
+  num_snapshots = 0
+
+  def drain(t_release_s: float) -> int:
+    num_yeeted = 0
+    while (snapshot := buffer.yeet(timeout=0, copy=False)) is not None:
+      t_yeet_s = perf_counter()
+      _, data, is_valid = snapshot
+      indices = np.searchsorted(toa_s, data["toa_s"][is_valid])
+      latencies_s.extend((t_yeet_s - t_plop_s[indices]).tolist())
+      release_delays_s.extend((t_release_s - toa_s[indices]).tolist())
+      num_yeeted += 1
+    return num_yeeted
+
+  for batch in batches:
+    t_plop_s[batch] = perf_counter()
+    buffer.plop_array(key_indices=records["device"][batch], data=records[batch], timestamps=records["timestamp_fine"][batch])
+    num_snapshots += drain(float(toa_s[batch.stop - 1]))
+  buffer.flush()
+  num_snapshots += drain(float(toa_s[-1]))
+  return len(records), _latency_results(latencies_s, release_delays_s, num_snapshots, metrics)
+
+
+def _latency_results(latencies_s: list[float], release_delays_s: list[float], num_snapshots: int, metrics: DataQualityMetrics) -> dict[str, Any]:
+  devices = metrics.get_snapshot()["devices"].values()
+  return {
+    "num_snapshots": num_snapshots,
+    "plop_to_yeet_p50_us": _scale(_percentile(latencies_s, 50), 1e6),
+    "plop_to_yeet_p99_us": _scale(_percentile(latencies_s, 99), 1e6),
+    "release_delay_p99_ms": _scale(_percentile(release_delays_s, 99), 1e3),
+    "num_late": sum(device["late"] for device in devices),
+    "num_padded": sum(device["padded"] for device in devices),
+  }
+
+
+def _scale(value: float | None, factor: float) -> float | None:
+  return value * factor if value is not None else None
+
+
+# The payload path of `main.py` per snapshot: encoding with `SnapshotSender` and `sendto` over loopback, to a socket that never reads.
+def bench_payload(workload: Workload, snapshots: list[tuple[int, np.ndarray, np.ndarray]], encoding: str, quaternion_encoding: str | None) -> tuple[int, dict[str, Any]]:
+  sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sink.bind(("127.0.0.1", 0))
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    sender = SnapshotSender(sock=sock,
+                            address=sink.getsockname(),
+                            num_trackers=workload.num_devices,
+                            wire_format=WIRE_FORMAT_V1,
+                            encoding=encoding,
+                            quaternion_encoding=quaternion_encoding)
+    num_bytes = 0
+    for snapshot in snapshots:
+      try:
+        num_bytes = sender.send(snapshot)
+      except BlockingIOError:
+        pass
+  finally:
+    sock.close()
+    sink.close()
+  return len(snapshots), {"packet_bytes": num_bytes}
+
+
+# Every benchmark on one workload.
+def run_scenario(workload: Workload, repeat: int) -> dict[str, Any]:
+  records = make_workload(workload)
+  batches = _poll_batches(records)
+  print("%s: %d packets in %d polls."%(workload.name, len(records), len(batches)), flush=True)
+  results = {
+    "converter_scalar": _measure(lambda: bench_converter_scalar(workload, records), repeat),
+    "converter_batch": _measure(lambda: bench_converter_batch(workload, records, batches), repeat),
+    "fifo_buffer": _measure(lambda: bench_fifo(workload, records), repeat),
+    "ring_buffer": _measure(lambda: bench_ring(workload, records, batches), repeat),
+  }
+  # Snapshots for the payload path, as the ring buffer delivers them.
+  buffer = TimestampAlignedRingBuffer(keys=_device_ids(workload),
+                                      timesteps_before_stale=10,
+                                      num_channels=None,
+                                      sampling_period=round(_TICKS_PER_S / workload.sampling_rate_hz),
+                                      num_bits_timestamp=32,
+                                      capacity=len(records) // workload.num_devices + 1024,
+                                      dtype=IMU_PACKET_DTYPE,
+                                      metrics=_metrics(workload))
+  with contextlib.redirect_stdout(io.StringIO()):
+    buffer.plop_array(key_indices=records["device"], data=records, timestamps=records["timestamp_fine"])
+    buffer.flush()
+    snapshots = list(iter(lambda: buffer.yeet(timeout=0), None))
+  for name, encoding, quaternion_encoding in (("payload_float32", ENCODING_FLOAT32, None),
+                                              ("payload_int16_quaternions", ENCODING_INT16, ENCODING_SMALLEST_THREE)):
+    results[name] = _measure(lambda: bench_payload(workload, snapshots, encoding, quaternion_encoding), repeat, unit="snapshots")
+  for name, result in results.items():
+    print("  %-26s %s"%(name, ", ".join("%s %s"%(k, _format_value(v)) for k, v in result.items())), flush=True)
+  return scenario_result(workload, len(records), results)
+
+
+# Results of one scenario as saved, the workload in its JSON form (tuples as lists) so runs compare equal after reloading.
+def scenario_result(workload: Workload, num_packets: int, benchmarks: dict[str, dict[str, Any]]) -> dict[str, Any]:
+  return {"workload": _as_json(asdict(workload)), "num_packets": num_packets, "benchmarks": benchmarks}
+
+
+def _as_json(value: Any) -> Any:
+  return json.loads(json.dumps(value))
+
+
+def _format_value(value: Any) -> str:
+  return "%.3g"%value if isinstance(value, float) else str(value)
+
+
+def _git_commit() -> str | None:
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+# Relative changes of throughput, CPU, latency and memory against a baseline run, for benchmarks of scenarios in both.
+#   Returns the (scenario, benchmark, metric, baseline, current) that got worse by more than `tolerance`.
+def compare(baseline: dict[str, Any], current: dict[str, Any], tolerance: float) -> list[tuple[str, str, str, float, float]]:
+  regressions = []
+  baseline_scenarios = {scenario["workload"]["name"]: scenario for scenario in baseline["scenarios"]}
+  for scenario in current["scenarios"]:
+    name = scenario["workload"]["name"]
+    if name not in baseline_scenarios or _as_json(baseline_scenarios[name]["workload"]) != _as_json(scenario["workload"]):
+      continue
+    for benchmark, results in scenario["benchmarks"].items():
+      baseline_results = baseline_scenarios[name]["benchmarks"].get(benchmark, {})
+      for metric, value in results.items():
+        baseline_value = baseline_results.get(metric)
+        if metric.startswith("num_") or not _is_number(value) or not _is_number(baseline_value) or baseline_value <= 0:
+          continue
+        change = value / baseline_value - 1
+        if (change < -tolerance) if metric in _HIGHER_IS_BETTER else (change > tolerance):
+          regressions.append((name, benchmark, metric, baseline_value, value))
+  return regressions
+
+
+def _is_number(value: Any) -> bool:
+  return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark the alignment and sending hot paths on synthetic DOT streams.")
+  parser.add_argument("--output", default=None, help="JSON file for the results, benchmark_<time>.json if not given")
+  parser.add_argument("--scenario", action="append", choices=[workload.name for workload in SCENARIOS], default=None,
+                      help="scenario to run, repeat the option for several, all if not given")
+  parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the fastest is kept")
+  parser.add_argument("--quick", action="store_true", help="5 s streams instead of 30 s, for a smoke test")
+  parser.add_argument("--compare", default=None, help="earlier results to flag regressions against")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+  args = parser.parse_args()
+
+  scenarios = [workload for workload in SCENARIOS if args.scenario is None or workload.name in args.scenario]
+  if args.quick:
+    for workload in scenarios:
+      workload.duration_s = 5.0
+  results = {
+    "version": BENCHMARK_VERSION,
+    "created": strftime("%Y-%m-%dT%H:%M:%S"),
+    "git_commit": _git_commit(),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "platform": platform.platform(),
+    "processor": platform.processor(),
+    "repeat": args.repeat,
+    "scenarios": [run_scenario(workload, args.repeat) for workload in scenarios],
+  }
+  output = args.output if args.output is not None else "benchmark_%s.json"%strftime("%Y%m%d_%H%M%S")
+  with open(output, "w") as f:
+    json.dump(results, f, indent=2)
+  print("Saved results to %s."%output, flush=True)
+
+  if args.compare is not None:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    regressions = compare(baseline, results, args.tolerance)
+    for name, benchmark, metric, baseline_value, value in regressions:
+      print("REGRESSION %s %s %s: %.4g -> %.4g (%+.0f%%)"%(name, benchmark, metric, baseline_value, value, (value / baseline_value - 1) * 100), flush=True)
+    print("%d regressions against %s."%(len(regressions), args.compare), flush=True)
+    if regressions:
+      raise SystemExit(1)
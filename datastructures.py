@@ -26,16 +26,43 @@
 # ############
 
 from abc import ABC, abstractmethod
-import queue
+import threading
+from time import perf_counter
 from typing import Any, Callable, Iterable 
 from collections import OrderedDict, deque
 
+import numpy as np
+
+from metrics import DataQualityMetrics
+
+
+# Bursts of at least this many packets are converted to counters with NumPy instead of one by one,
+#   below it the fixed cost of grouping per key outweighs the per-packet loop (measured crossover around 200).
+MIN_BATCH_SIZE_VECTORIZED = 256
+
+# Compact record of one IMU sample, used end to end from the SDK callback to the aligned snapshots,
+#   with the device stored as its index in the device mapping. Quaternion is NaN if orientation is not streamed.
+IMU_PACKET_DTYPE = np.dtype([
+  ("device",          np.uint8),
+  ("timestamp_fine",  np.uint32),
+  ("toa_s",           np.float64),
+  ("acc",             np.float32, (3,)),
+  ("gyr",             np.float32, (3,)),
+  ("mag",             np.float32, (3,)),
+  ("quaternion",      np.float32, (4,)),
+])
+
 
 class BufferInterface(ABC):
   @abstractmethod
   def plop(self, key: str, data: dict) -> None:
     pass
 
+  # Bulk variant taking the keyword arguments of `plop` for each packet, override to amortize per-packet overhead.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    for packet in packets:
+      self.plop(**packet)
+
   @abstractmethod
   def yeet(self) -> Any:
     pass
@@ -49,9 +76,16 @@ class TimestampToCounterConverter:
     self._sampling_period = sampling_period
     self._timestamp_limit: int = 2**num_bits_timestamp
     self._counter_from_timestamp_fn: Callable = self._foo
-    self._first_timestamps = OrderedDict([(k, None) for k in keys])
-    self._previous_timestamps = OrderedDict([(k, None) for k in keys])
-    self._counters = OrderedDict([(k, None) for k in keys])
+    self._keys = list(keys)
+    self._first_timestamps = OrderedDict([(k, None) for k in self._keys])
+    self._previous_timestamps = OrderedDict([(k, None) for k in self._keys])
+    self._counters = OrderedDict([(k, None) for k in self._keys])
+    self._key_index = {k: i for i, k in enumerate(self._keys)}
+    self._num_started_keys = 0 # Keys with a reference reading, replaces scanning all previous timestamps per sample.
+    # Keys to re-anchor on their next sample, with the key to anchor to (None for the most advanced other one).
+    #   Requested from any thread, moved to `_reanchor_references` and applied only by the converting thread.
+    self._reanchor_requests: dict = dict()
+    self._reanchor_references: dict = dict()
 
 
   # Sets the start time according to the first received packet and switches
@@ -59,11 +93,12 @@ class TimestampToCounterConverter:
   def _foo(self, key, timestamp) -> int | None:
     # The sample is the very first in the buffer -> use as reference timestamp.
     #   Will return 0 start counter at the end of the function.
-    if not any([v is not None for v in self._previous_timestamps.values()]):
+    if not self._num_started_keys:
       self._start_time = timestamp
       self._first_timestamps[key] = timestamp
       self._previous_timestamps[key] = timestamp
       self._counters[key] = 0
+      self._num_started_keys += 1
     # If it's not the very first packet, but first reading for this device.
     #   Record if the capture was during or after the start reference.
     #   NOTE: style is more verbose to preserve clarity.
@@ -74,12 +109,14 @@ class TimestampToCounterConverter:
         self._first_timestamps[key] = timestamp
         self._previous_timestamps[key] = timestamp
         self._counters[key] = round(((timestamp - self._start_time) % self._timestamp_limit)/ self._sampling_period)
+        self._num_started_keys += 1
       # Measurement taken after the overflow of the on-sensor clock and effectively after the reference measurement.
       #   Will return 0 start counter at the end of the function.
       elif ((timestamp - self._start_time) % self._timestamp_limit) < (self._start_time - timestamp):
         self._first_timestamps[key] = timestamp
         self._previous_timestamps[key] = timestamp
         self._counters[key] = round(((timestamp - self._start_time) % self._timestamp_limit)/ self._sampling_period)
+        self._num_started_keys += 1
       # Otherwise it's a stale measurement to be discarded to ensure alignment. 
       else:
         return None
@@ -87,7 +124,7 @@ class TimestampToCounterConverter:
     else:
       self._bar(key=key, timestamp=timestamp)
     # Switch the function call to the monotone routine once all crossed the start reference time.
-    if all([v is not None for v in self._previous_timestamps.values()]):
+    if self._num_started_keys == len(self._keys):
       self._counter_from_timestamp_fn = self._bar
     return self._counters[key]
 
@@ -104,64 +141,439 @@ class TimestampToCounterConverter:
     return self._counters[key]
 
 
+  # Places the next sample of `key` at the latest sample of `reference_key` instead of after its own previous one,
+  #   for a device whose clock restarted while the others kept streaming (e.g. reconnected mid-session, without a sync).
+  #   Safe to call from another thread than the one converting timestamps.
+  def reanchor(self, key, reference_key=None) -> None:
+    self._reanchor_requests[key] = reference_key
+
+
+  # Counter of a single sample, honoring pending re-anchor requests.
+  def counter_from_timestamp(self, key, timestamp) -> int | None:
+    if (self._reanchor_requests or self._reanchor_references) and self._take_reanchor_requests():
+      return self._baz(key=key, timestamp=timestamp)
+    return self._counter_from_timestamp_fn(key, timestamp)
+
+
+  # Moves requests made by other threads into the converting thread's state, returns whether any key awaits re-anchoring.
+  def _take_reanchor_requests(self) -> bool:
+    while self._reanchor_requests:
+      key, reference_key = self._reanchor_requests.popitem()
+      self._reanchor_references[key] = reference_key
+    return bool(self._reanchor_references)
+
+
+  # Anchors the first sample of a re-anchored key to the counter of the reference key's latest reading, then continues as usual.
+  #   NOTE: the restarted clock is unrelated to the reference's, so their ticks can not be compared,
+  #         the sample is off by the difference of their radio latencies (within a sampling period or so).
+  def _baz(self, key, timestamp) -> int | None:
+    if key not in self._reanchor_references:
+      return self._counter_from_timestamp_fn(key, timestamp)
+    reference_key = self._reanchor_references.pop(key)
+    if reference_key is None or self._previous_timestamps[reference_key] is None:
+      started_keys = [k for k, v in self._previous_timestamps.items() if k != key and v is not None]
+      # Nothing streaming to anchor to, the key keeps its own timeline.
+      if not started_keys:
+        return self._counter_from_timestamp_fn(key, timestamp)
+      reference_key = max(started_keys, key=self._counters.__getitem__)
+    if self._previous_timestamps[key] is None:
+      self._first_timestamps[key] = timestamp
+      self._num_started_keys += 1
+      if self._num_started_keys == len(self._keys):
+        self._counter_from_timestamp_fn = self._bar
+    self._previous_timestamps[key] = timestamp
+    self._counters[key] = self._counters[reference_key]
+    return self._counters[key]
+
+
+  # Vectorized equivalent of calling `_counter_from_timestamp_fn` on each sample in order, for bursts and whole recordings.
+  #   Takes the index of each sample's key (position in `keys`) and its timestamp,
+  #   returns the counters, with -1 for stale first samples of a device that `_foo` would discard.
+  #   Keeps the state consistent with the per-sample routines, so both can be mixed.
+  def counters_from_timestamps(self, key_indices: np.ndarray, timestamps: np.ndarray) -> np.ndarray:
+    key_indices = np.asarray(key_indices, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    counters = np.full(len(timestamps), -1, dtype=np.int64)
+    if not len(timestamps):
+      return counters
+    if not self._num_started_keys:
+      self._start_time = int(timestamps[0])
+    previous_timestamps = np.array([-1 if v is None else v for v in self._previous_timestamps.values()], dtype=np.int64)
+    previous_counters = np.array([0 if v is None else v for v in self._counters.values()], dtype=np.int64)
+    is_key_started = previous_timestamps >= 0
+
+    # Group samples per key, preserving arrival order within each key.
+    order = np.argsort(key_indices, kind="stable")
+    keys_sorted = key_indices[order]
+    timestamps_sorted = timestamps[order]
+    is_group_start = np.empty(len(order), dtype=bool)
+    is_group_start[0] = True
+    np.not_equal(keys_sorted[1:], keys_sorted[:-1], out=is_group_start[1:])
+    group_starts = np.flatnonzero(is_group_start)
+    group_ends = np.r_[group_starts[1:], len(order)] - 1
+    group_ids = np.cumsum(is_group_start) - 1
+
+    # First readings of keys without a reference: same acceptance rule as `_foo`, everything before the first accepted one is stale.
+    offsets_from_start = (timestamps_sorted - self._start_time) % self._timestamp_limit
+    is_first_candidate = ~is_key_started[keys_sorted] & ((timestamps_sorted >= self._start_time) |
+                                                         (offsets_from_start < (self._start_time - timestamps_sorted)))
+    num_accepted = np.cumsum(is_first_candidate)
+    num_accepted_before_group = (num_accepted - is_first_candidate)[group_starts]
+    num_accepted_in_group = num_accepted - num_accepted_before_group[group_ids]
+    is_first = is_first_candidate & (num_accepted_in_group == 1)
+    is_valid = is_key_started[keys_sorted] | (num_accepted_in_group > 0)
+
+    # Monotone routine of `_bar`: rounded tick deltas to the previous reading of the same key, accumulated per key.
+    previous = np.empty_like(timestamps_sorted)
+    previous[1:] = timestamps_sorted[:-1]
+    previous[group_starts] = previous_timestamps[keys_sorted[group_starts]]
+    delta_counters = np.rint(((timestamps_sorted - previous) % self._timestamp_limit) / self._sampling_period).astype(np.int64)
+    delta_counters[is_first] = np.rint(offsets_from_start[is_first] / self._sampling_period).astype(np.int64)
+    delta_counters[~is_valid] = 0
+    cumulative = np.cumsum(delta_counters)
+    cumulative_before_group = (cumulative - delta_counters)[group_starts]
+    counters_sorted = cumulative - cumulative_before_group[group_ids] + np.where(is_key_started, previous_counters, 0)[keys_sorted]
+    counters_sorted[~is_valid] = -1
+    counters[order] = counters_sorted
+
+    # Write back the state of every key seen in this batch.
+    for group_start, group_end in zip(group_starts, group_ends):
+      if not is_valid[group_end]:
+        continue
+      key = self._keys[keys_sorted[group_start]]
+      if not is_key_started[keys_sorted[group_start]]:
+        self._first_timestamps[key] = int(timestamps_sorted[group_start + np.argmax(is_first[group_start:group_end+1])])
+        self._num_started_keys += 1
+      self._previous_timestamps[key] = int(timestamps_sorted[group_end])
+      self._counters[key] = int(counters_sorted[group_end])
+    if self._num_started_keys == len(self._keys):
+      self._counter_from_timestamp_fn = self._bar
+    return counters
+
+
+  # Counters of a burst of samples, None for rejected ones, for bulk data such as recordings or a backlog after a stall.
+  #   Large bursts are cheaper to convert in one vectorized call, small ones one by one.
+  #   Bursts with a key awaiting re-anchoring are converted one by one too.
+  #   NOTE: live bursts are a few packets, callers convert those with `counter_from_timestamp` in their own loop instead,
+  #         the NumPy round trip here costs more than the conversion itself.
+  def counters_from_batch(self, key_indices: Any, timestamps: Any) -> list[int | None]:
+    if (self._reanchor_requests or self._reanchor_references) and self._take_reanchor_requests():
+      return [self._baz(key=self._keys[key_index], timestamp=timestamp)
+              for key_index, timestamp in zip(np.asarray(key_indices).tolist(), np.asarray(timestamps).tolist())]
+    if len(timestamps) < MIN_BATCH_SIZE_VECTORIZED:
+      # NOTE: Python ints, fixed-width NumPy scalars would wrap around in the intermediate differences.
+      #       The routine is looked up once, `_foo` hands samples of started keys to `_bar` if it switches meanwhile.
+      counter_from_timestamp_fn, keys = self._counter_from_timestamp_fn, self._keys
+      return [counter_from_timestamp_fn(keys[key_index], timestamp)
+              for key_index, timestamp in zip(np.asarray(key_indices).tolist(), np.asarray(timestamps).tolist())]
+    counters = self.counters_from_timestamps(key_indices=key_indices, timestamps=timestamps)
+    return [counter if counter >= 0 else None for counter in counters.tolist()]
+
+
+  # Same as `counters_from_batch` for packets with "key" and "timestamp" fields.
+  def counters_from_packets(self, packets: list[dict]) -> list[int | None]:
+    return self.counters_from_batch(key_indices=[self._key_index[packet["key"]] for packet in packets],
+                                    timestamps=[packet["timestamp"] for packet in packets])
+
+
+# Picks `timesteps_before_stale` from how far behind the most advanced key the packets of each key arrive (their lag, in timesteps),
+#   instead of a fixed value: the `quantile` of the lags of the slowest key, within [min_timesteps, max_timesteps].
+#   A packet with lag L is in time with `timesteps_before_stale` above L + 1, so a higher value adds latency to every snapshot
+#   a key is missing from, while a lower one drops more packets as late. Lags are kept in a histogram per key,
+#   packets with lag beyond the bounds included, which forgets with `half_life` packets per key; the value is updated every `update_period` packets.
+class AdaptiveStaleTimeout:
+  def __init__(self,
+               num_keys: int,
+               timesteps_before_stale: int, # NOTE: used until the first update
+               quantile: float = 0.99,
+               min_timesteps: int = 2,
+               max_timesteps: int = 100,
+               half_life: int = 1000,
+               update_period: int = 64):
+    if not 2 <= min_timesteps <= max_timesteps:
+      raise ValueError("Stale timeout bounds must satisfy 2 <= %d <= %d."%(min_timesteps, max_timesteps))
+    self._quantile = quantile
+    self._min_timesteps = min_timesteps
+    self._max_timesteps = max_timesteps
+    self._update_period = update_period
+    self._decay = 0.5 ** (update_period / (half_life * num_keys))
+    # Bin L counts lags of L timesteps, the last one all lags that no timeout within bounds would wait for.
+    self._counts = np.zeros((num_keys, max_timesteps), dtype=np.float64)
+    self._num_added = 0
+    self.timesteps_before_stale = min(max(timesteps_before_stale, min_timesteps), max_timesteps)
+
+
+  @property
+  def quantile(self) -> float:
+    return self._quantile
+
+
+  @property
+  def max_timesteps(self) -> int:
+    return self._max_timesteps
+
+
+  # Adds the lag of a packet, returns whether `timesteps_before_stale` was updated.
+  def add(self, key_index: int, lag: int) -> bool:
+    self._counts[key_index, min(max(lag, 0), self._max_timesteps - 1)] += 1
+    self._num_added += 1
+    if self._num_added % self._update_period:
+      return False
+    self._counts *= self._decay
+    cumulative = np.cumsum(self._counts, axis=1)
+    totals = cumulative[:, -1]
+    is_seen = totals > 0
+    # Smallest lag per key that covers `quantile` of its packets, the slowest key decides.
+    lags = np.argmax(cumulative[is_seen] >= self._quantile * totals[is_seen, None], axis=1)
+    timesteps = int(lags.max()) + 2 if len(lags) else self.timesteps_before_stale
+    timesteps = min(max(timesteps, self._min_timesteps), self._max_timesteps)
+    is_updated = timesteps != self.timesteps_before_stale
+    self.timesteps_before_stale = timesteps
+    return is_updated
+
+
+  # What the current value trades off: timesteps a snapshot waits at most for a missing key, and per key
+  #   the fraction of its recent packets that arrived too late for it, i.e. the expected rate of late packets.
+  def tradeoff(self) -> dict[str, Any]:
+    totals = self._counts.sum(axis=1)
+    num_late = self._counts[:, self.timesteps_before_stale - 1:].sum(axis=1)
+    return {
+      "timesteps_before_stale": self.timesteps_before_stale,
+      "quantile": self._quantile,
+      "max_wait_timesteps": self.timesteps_before_stale - 1,
+      "late_fractions": np.divide(num_late, totals, out=np.zeros_like(totals), where=totals > 0).tolist(),
+    }
+
+
 # Uses dynamic lists for the buffer, approprate for the sample rate of IMUs.
 #   Switch to a defined-length ring buffer to avoid unnecessary memory allocation for higher performance.
+#   Each key holds only the samples it received, with their counters: timesteps without a sample take no memory,
+#   so a counter jumping far ahead (reconnect, timestamp glitch) costs O(1) instead of one None per missing timestep.
+#   Runs of timesteps where no key has a sample are emitted (or skipped, if longer than `max_gap_emitted`) in one step,
+#   queued as a single `_EmptyRun` the reader expands into all-None snapshots one at a time.
 class AlignedFifoBuffer(BufferInterface):
   def __init__(self,
                keys: Iterable,
-               timesteps_before_stale: int): # NOTE: allows yeeting from buffer if some keys have been empty for a while (disconnection or out of range), while others continue producing
-    self._buffer = OrderedDict([(k, deque()) for k in keys])
-    self._output_queue = queue.Queue()
+               timesteps_before_stale: int, # NOTE: allows yeeting from buffer if some keys have been empty for a while (disconnection or out of range), while others continue producing
+               metrics: DataQualityMetrics | None = None, # NOTE: shared registry to count into, a private one if None
+               is_fifo: bool = True, # NOTE: False to only serve `yeet_latest`, without queueing every snapshot
+               max_gap_emitted: int | None = None, # NOTE: longer runs of all-None snapshots are dropped instead of queued, None to emit all
+               stale_timeout: AdaptiveStaleTimeout | None = None): # NOTE: replaces `timesteps_before_stale` by one adapted to the packet lags
+    keys = list(keys)
+    self._keys = keys
+    self._buffer: OrderedDict[Any, deque[tuple[int, dict]]] = OrderedDict([(k, deque()) for k in keys])
+    self._key_index = {k: i for i, k in enumerate(keys)}
+    self._latest_counters = [-1] * len(keys)
+    self._metrics = metrics if metrics is not None else DataQualityMetrics(keys)
+    # Snapshots emitted while plopping are published to the reader together, with one lock and notify per call,
+    #   along with the number of timesteps they span.
+    self._output_queue: deque[dict | _EmptyRun] = deque()
+    self._output_cv = threading.Condition()
+    self._emitted: list[dict | _EmptyRun] = list()
+    self._num_emitted_timesteps = 0
+    # Freshest snapshot for the latest-only reader, replaced on every publish, and the number it replaced unread.
+    self._is_fifo = is_fifo
+    self._latest: dict | None = None
+    self._num_latest_skipped = 0
     self._counter_snapshot = 0 # Updated only on yeet to discard stale sample that arrived too late.
-    self._timesteps_before_stale = timesteps_before_stale
+    self._timesteps_before_stale = stale_timeout.timesteps_before_stale if stale_timeout is not None else timesteps_before_stale
+    self._stale_timeout = stale_timeout
+    self._counter_frontier = -1
+    self._max_gap_emitted = max_gap_emitted
+    # Incrementally maintained on every push/pop to decide on emitting in constant time, regardless of number of keys.
+    #   A key is empty without samples at or after `_counter_snapshot`, stale once its latest is `timesteps_before_stale` ahead.
+    self._num_empty_keys = len(self._buffer)
+    self._num_stale_keys = 0
+
+
+  @property
+  def metrics(self) -> DataQualityMetrics:
+    return self._metrics
 
 
   # Adding packets to the datastructure is asynchronous for each key.
   def plop(self, key: str, data: dict, counter: int):
+    self._metrics.count("received", self._key_index[key])
+    self._plop(key=key, data=data, counter=counter)
+    self._publish()
+
+
+  # Adds a burst of packets, all completed snapshots become available to the reader at once.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    for packet in packets:
+      self._metrics.count("received", self._key_index[packet["key"]])
+      self._plop(**packet)
+    self._publish()
+
+
+  def _plop(self, key: str, data: dict, counter: int) -> None:
     # Add counter into the data payload to retreive on the reader. (Useful for time->counter converted buffer).
     data["counter"] = counter
+    key_index = self._key_index[key]
+    if self._stale_timeout is not None:
+      if self._stale_timeout.add(key_index, self._counter_frontier - counter):
+        self._timesteps_before_stale = self._stale_timeout.timesteps_before_stale
+        self._num_stale_keys = self._count_stale_keys()
+      self._counter_frontier = max(self._counter_frontier, counter)
     # The snapshot had not been read yet, even if measurement is stale (arrived later than specified), 
     #   there's still time to add it.
     if counter >= self._counter_snapshot:
-      # Empty pad if some intermediate timesteps did not recieve a packet for this key.
-      while len(self._buffer[key]) < (counter - self._counter_snapshot):
-        self._buffer[key].append(None)
-      self._buffer[key].append(data)
+      buf = self._buffer[key]
+      depth = self._latest_counters[key_index] - self._counter_snapshot + 1 if buf else 0
+      # Timesteps between the previous sample and this one are implicitly empty for this key.
+      #   A counter not ahead of the latest takes the next timestep.
+      position = max(counter, self._latest_counters[key_index] + 1)
+      buf.append((position, data))
+      self._latest_counters[key_index] = position
+      if not depth:
+        self._num_empty_keys -= 1
+      if depth < self._timesteps_before_stale <= position - self._counter_snapshot + 1:
+        self._num_stale_keys += 1
     else:
-      print("%d packet of %s arrived too late."%(counter, key), flush=True)
+      self._metrics.count("late", key_index)
+      self._metrics.logger.log(("late", key_index), "%d packet of %s arrived too late.", counter, key)
 
-    # If buffer contents are valid, move snapshot into the output Queue.
+    # If buffer contents are valid (every key has data), or some key exceeds the stale period while others are empty,
+    #   move snapshot into the output Queue.
     #   Update frame counter to keep track of removed data to discard stale late arrivals.
-    is_every_key_has_data = all([len(buf) for buf in self._buffer.values()])
-    is_some_key_exceeds_stale_period = any([len(buf) >= self._timesteps_before_stale for buf in self._buffer.values()])
-    is_some_key_empty = any([not len(buf) for buf in self._buffer.values()])
-    if is_every_key_has_data:
-      oldest_packet = {k: buf.popleft() for k, buf in self._buffer.items()}
-      self._put_output_queue(oldest_packet)
-    elif is_some_key_exceeds_stale_period and is_some_key_empty:
-      oldest_packet = {k: (buf.popleft() if len(buf) else None) for k, buf in self._buffer.items()}
-      self._put_output_queue(oldest_packet)
+    #   A run of timesteps no key has a sample for is released at once, also right after the emitted one.
+    if not self._num_empty_keys or self._num_stale_keys:
+      if not self._release_empty_run(is_stale=self._num_empty_keys > 0):
+        self._put_output_queue(self._pop_oldest(is_stale=self._num_empty_keys > 0))
+        if not self._num_empty_keys or self._num_stale_keys:
+          self._release_empty_run(is_stale=self._num_empty_keys > 0)
+
+
+  # Releases the run of empty timesteps at the oldest, if longer than one, returns whether it did.
+  def _release_empty_run(self, is_stale: bool) -> bool:
+    num_empty_timesteps = self._num_empty_timesteps(is_stale=is_stale)
+    if num_empty_timesteps <= 1:
+      return False
+    self._release_empty_timesteps(num_empty_timesteps, is_stale=is_stale)
+    return True
+
+
+  # Number of timesteps from the oldest on where no key has a sample, for as long as the emit condition keeps holding:
+  #   always with every key non-empty or when flushing, else until the stale keys fall within `timesteps_before_stale`.
+  def _num_empty_timesteps(self, is_stale: bool) -> int:
+    heads = [buf[0][0] for buf in self._buffer.values() if buf]
+    if not heads:
+      return 0
+    num_empty_timesteps = min(heads) - self._counter_snapshot
+    if is_stale:
+      num_empty_timesteps = min(num_empty_timesteps, max(self._latest_counters) - self._timesteps_before_stale + 2 - self._counter_snapshot)
+    return max(num_empty_timesteps, 0)
+
+
+  # Emits a run of all-None snapshots as one queue entry, or drops it if longer than `max_gap_emitted`.
+  def _release_empty_timesteps(self, num_timesteps: int, is_stale: bool) -> None:
+    if self._max_gap_emitted is None or num_timesteps <= self._max_gap_emitted:
+      self._counter_snapshot += num_timesteps
+      self._emitted.append(_EmptyRun(num_timesteps))
+      self._num_emitted_timesteps += num_timesteps
+    else:
+      self._counter_snapshot += num_timesteps
+      self._metrics.count_total("skipped_timesteps", num_timesteps)
+    for key_index in range(len(self._buffer)):
+      self._metrics.count("padded", key_index, num_timesteps)
+      if is_stale:
+        self._metrics.count("stale_emits", key_index, num_timesteps)
+    # Non-empty keys got closer to the oldest timestep, count the ones still stale.
+    self._num_stale_keys = self._count_stale_keys()
+
+
+  def _count_stale_keys(self) -> int:
+    return sum(1 for key_index, buf in enumerate(self._buffer.values())
+               if buf and self._latest_counters[key_index] - self._counter_snapshot + 1 >= self._timesteps_before_stale)
+
+
+  # Removes the oldest timestep of every key, keeping the readiness counts up to date.
+  def _pop_oldest(self, is_stale: bool = False) -> dict:
+    oldest_packet = {}
+    for key_index, (k, buf) in enumerate(self._buffer.items()):
+      if buf:
+        depth = self._latest_counters[key_index] - self._counter_snapshot + 1
+        oldest_packet[k] = buf.popleft()[1] if buf[0][0] == self._counter_snapshot else None
+        if depth == 1:
+          self._num_empty_keys += 1
+        if depth == self._timesteps_before_stale:
+          self._num_stale_keys -= 1
+      else:
+        oldest_packet[k] = None
+      if oldest_packet[k] is None:
+        self._metrics.count("padded", key_index)
+        if is_stale:
+          self._metrics.count("stale_emits", key_index)
+    return oldest_packet
 
 
   def _put_output_queue(self, packet: dict) -> None:
     self._counter_snapshot += 1
-    self._output_queue.put(packet)
+    self._emitted.append(packet)
+    self._num_emitted_timesteps += 1
+
+
+  def _publish(self) -> None:
+    if self._emitted:
+      latest = self._emitted[-1]
+      if type(latest) is _EmptyRun:
+        latest = dict.fromkeys(self._keys)
+      with self._output_cv:
+        if self._is_fifo:
+          self._output_queue.extend(self._emitted)
+        self._num_latest_skipped += self._num_emitted_timesteps - (self._latest is None)
+        self._latest = latest
+        self._output_cv.notify_all()
+      self._emitted.clear()
+      self._num_emitted_timesteps = 0
 
 
   # No more new data will be captured, can evict all present data.
   def flush(self) -> None:
-    while (is_any_key_not_empty := any([len(buf) for buf in self._buffer.values()])):
-      oldest_packet = {k: (buf.popleft() if len(buf) else None) for k, buf in self._buffer.items()}
-      self._put_output_queue(oldest_packet)
+    while self._num_empty_keys < len(self._buffer):
+      if not self._release_empty_run(is_stale=False):
+        self._put_output_queue(self._pop_oldest())
+    self._publish()
 
 
   # Getting packets from the datastructure is synchronous for all keys.
   def yeet(self, timeout: float = 10.0) -> Any | None:
-    try:
-      return self._output_queue.get(timeout=timeout)
-    except queue.Empty:
-      print("Timed out on no more snapshots in the output Queue.")
-      return None
+    with self._output_cv:
+      if not self._is_fifo:
+        raise RuntimeError("FIFO delivery is disabled, use `yeet_latest`.")
+      if not self._output_cv.wait_for(lambda: self._output_queue, timeout=timeout):
+        self._metrics.count_total("yeet_timeouts")
+        self._metrics.logger.log("yeet_timeout", "Timed out on no more snapshots in the output Queue.")
+        return None
+      oldest = self._output_queue[0]
+      if type(oldest) is not _EmptyRun:
+        return self._output_queue.popleft()
+      oldest.length -= 1
+      if not oldest.length:
+        self._output_queue.popleft()
+    return dict.fromkeys(self._keys)
+
+
+  # Freshest completed snapshot not read yet and the number of older ones it skipped, for latency-critical readers.
+  #   Independent of `yeet`, both can be read at the same time by different consumers.
+  def yeet_latest(self, timeout: float = 10.0) -> tuple[Any, int] | None:
+    with self._output_cv:
+      if not self._output_cv.wait_for(lambda: self._latest is not None, timeout=timeout):
+        self._metrics.count_total("yeet_timeouts")
+        self._metrics.logger.log("yeet_timeout", "Timed out on no more snapshots in the output Queue.")
+        return None
+      latest, num_skipped = self._latest, self._num_latest_skipped
+      self._latest = None
+      self._num_latest_skipped = 0
+    if num_skipped:
+      self._metrics.count_total("latest_skipped", num_skipped)
+    return latest, num_skipped
+
+
+# Run of `length` consecutive all-None snapshots in the output queue of `AlignedFifoBuffer`, shortened by every `yeet`.
+class _EmptyRun:
+  def __init__(self, length: int):
+    self.length = length
 
 
 
@@ -170,9 +582,18 @@ class TimestampAlignedFifoBuffer(AlignedFifoBuffer):
                keys: Iterable,
                timesteps_before_stale: int, # NOTE: allows yeeting from buffer if some keys have been empty for a while, while others continue producing
                sampling_period: int, # NOTE: sampling period must be in the same units as timestamp limit and timestamps
-               num_bits_timestamp: int): # NOTE:
+               num_bits_timestamp: int, # NOTE:
+               metrics: DataQualityMetrics | None = None,
+               is_fifo: bool = True,
+               max_gap_emitted: int | None = None,
+               stale_timeout: AdaptiveStaleTimeout | None = None):
+    keys = list(keys)
     super().__init__(keys=keys,
-                     timesteps_before_stale=timesteps_before_stale)
+                     timesteps_before_stale=timesteps_before_stale,
+                     metrics=metrics,
+                     is_fifo=is_fifo,
+                     max_gap_emitted=max_gap_emitted,
+                     stale_timeout=stale_timeout)
     self._converter = TimestampToCounterConverter(keys=keys,
                                                   sampling_period=sampling_period,
                                                   num_bits_timestamp=num_bits_timestamp)
@@ -181,6 +602,421 @@ class TimestampAlignedFifoBuffer(AlignedFifoBuffer):
   # Override parent method.
   def plop(self, key: str, data: dict, timestamp: float) -> None:
     # Calculate counter from timestamp and local datastructure to avoid race condition.
-    counter = self._converter._counter_from_timestamp_fn(key, timestamp)
+    counter = self._converter.counter_from_timestamp(key, timestamp)
+    if counter is not None:
+      super().plop(key=key, data=data, counter=counter)
+    else:
+      self._metrics.count("received", self._key_index[key])
+      self._metrics.count("discarded", self._key_index[key])
+
+
+  # Override parent method.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    packets = list(packets)
+    for packet, counter in zip(packets, self._converter.counters_from_packets(packets)):
+      key_index = self._key_index[packet["key"]]
+      self._metrics.count("received", key_index)
+      if counter is not None:
+        self._plop(key=packet["key"], data=packet["data"], counter=counter)
+      else:
+        self._metrics.count("discarded", key_index)
+    self._publish()
+
+
+  # Aligns the next sample of `key` to the running counter again after its device reconnected (see `TimestampToCounterConverter.reanchor`).
+  def reanchor(self, key: Any, reference_key: Any = None) -> None:
+    self._converter.reanchor(key, reference_key)
+
+
+# Preallocated alternative to `AlignedFifoBuffer`: samples are written straight into a fixed-capacity
+#   array of shape (capacity, num_keys, num_channels) at the row indexed by their counter, alongside a validity mask
+#   and the counter of each row, so no per-sample objects are created and memory use is bounded.
+#   Rows that can not be overwritten yet: [_counter_read, _counter_snapshot) are emitted but not yeeted,
+#   [_counter_snapshot, _counter_frontier] are still being filled.
+#   A sample far ahead of the others releases the rows in between in one step, without writing them:
+#   the reader sees them as rows without valid data, or jumps over them if more than `max_gap_emitted`.
+class AlignedRingBuffer(BufferInterface):
+  def __init__(self,
+               keys: Iterable,
+               timesteps_before_stale: int, # NOTE: allows yeeting from buffer if some keys have been empty for a while, while others continue producing
+               num_channels: int | None, # NOTE: None for a scalar or structured `dtype` per key
+               capacity: int = 1024, # NOTE: if the reader lags by more than capacity, oldest unread rows are overwritten
+               dtype: np.dtype = np.float32,
+               metrics: DataQualityMetrics | None = None, # NOTE: shared registry to count into, a private one if None
+               is_fifo: bool = True, # NOTE: False to only serve `yeet_latest`, rows are then reused without tracking a FIFO reader
+               max_gap_emitted: int | None = None, # NOTE: longer runs of rows without data are skipped by the reader, None to read them all
+               stale_timeout: AdaptiveStaleTimeout | None = None): # NOTE: replaces `timesteps_before_stale` by one adapted to the packet lags
+    self._keys = list(keys)
+    self._key_index = {k: i for i, k in enumerate(self._keys)}
+    self._metrics = metrics if metrics is not None else DataQualityMetrics(self._keys)
+    if stale_timeout is not None:
+      timesteps_before_stale = stale_timeout.timesteps_before_stale
+    max_timesteps_before_stale = stale_timeout.max_timesteps if stale_timeout is not None else timesteps_before_stale
+    if max_timesteps_before_stale > capacity:
+      raise ValueError("Ring buffer capacity %d can not hold %d timesteps before stale."%(capacity, max_timesteps_before_stale))
+    num_keys = len(self._keys)
+    self._num_keys = num_keys
+    self._capacity = capacity
+    self._timesteps_before_stale = timesteps_before_stale
+    self._stale_timeout = stale_timeout
+    self._data = np.zeros((capacity, num_keys) + ((num_channels,) if num_channels else ()), dtype=dtype)
+    self._is_valid = np.zeros((capacity, num_keys), dtype=bool)
+    # NOTE: per-row bookkeeping touched on every sample is kept in lists, indexing NumPy scalars costs several times more.
+    self._counters = [-1] * capacity
+    self._no_valid = np.zeros(num_keys, dtype=bool)
+    # Latest counter written per key and the number of keys whose latest sample is on each row,
+    #   to decide in constant time whether every key has reached the oldest pending row.
+    self._latest_counters = [-1] * num_keys
+    self._num_latest_on_row = [0] * capacity
+    self._num_keys_reached = 0
+    # Keys that wrote each row past their previous latest, all of them for a row complete in order, so its mask is not scanned.
+    self._num_advanced_on_row = [0] * capacity
+    self._counter_frontier = -1
+    self._counter_snapshot = 0 # Updated only on emit to discard stale sample that arrived too late.
+    self._counter_read = 0
+    self._counter_emitted = 0
+    self._num_overwritten_unread = 0
+    self._is_fifo = is_fifo
+    self._counter_latest_read = 0 # Next counter the latest-only reader has not seen, independent of `_counter_read`.
+    self._max_gap_emitted = max_gap_emitted
+    self._gaps: deque[tuple[int, int]] = deque() # [start, end) counters of released runs the FIFO reader jumps over.
+    self._emit_times_s = [0.0] * capacity
+    self._output_cv = threading.Condition()
+
+
+  @property
+  def keys(self) -> list:
+    return self._keys
+
+
+  @property
+  def metrics(self) -> DataQualityMetrics:
+    return self._metrics
+
+
+  # `perf_counter` time the row of the counter became visible to the reader, valid until the row is reused.
+  def emit_time(self, counter: int) -> float:
+    return self._emit_times_s[counter % self._capacity]
+
+
+  # Counter after the last row visible to the readers.
+  @property
+  def num_emitted(self) -> int:
+    return self._counter_emitted
+
+
+  # Data and validity of an emitted row without moving any reader, for one of the last `capacity` rows before `num_emitted`.
+  #   NOTE: only safe from the thread that plops, rows are reused by later plops.
+  def peek(self, counter: int, copy: bool = True) -> tuple[np.ndarray, np.ndarray]:
+    return self._read_row(counter, copy)
+
+
+  # Adding packets to the datastructure is asynchronous for each key.
+  def plop(self, key: Any, data: Any, counter: int) -> None:
+    key_index = self._key_index[key]
+    self._metrics.count("received", key_index)
+    self._plop(key_index=key_index, data=data, counter=counter)
+    self._publish()
+
+
+  # Adds a burst of packets, all completed rows become available to the reader at once.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    for packet in packets:
+      key_index = self._key_index[packet["key"]]
+      self._metrics.count("received", key_index)
+      self._plop(key_index=key_index, data=packet["data"], counter=packet["counter"])
+    self._publish()
+
+
+  # Adds a burst of packets given as arrays: index of the key of each packet (position in `keys`), data rows and counters.
+  #   Packets with a None counter are counted as discarded.
+  def plop_array(self, key_indices: np.ndarray, data: np.ndarray, counters: Iterable[int | None]) -> None:
+    key_indices = np.asarray(key_indices)
+    self._metrics.count_many("received", key_indices)
+    for key_index, row, counter in zip(key_indices.tolist(), data, counters):
+      if counter is not None:
+        self._plop(key_index=key_index, data=row, counter=counter)
+      else:
+        self._metrics.count("discarded", key_index)
+    self._publish()
+
+
+  def _plop(self, key_index: int, data: Any, counter: int) -> None:
+    if self._stale_timeout is not None and self._stale_timeout.add(key_index, self._counter_frontier - counter):
+      self._timesteps_before_stale = self._stale_timeout.timesteps_before_stale
+    if counter < self._counter_snapshot:
+      self._metrics.count("late", key_index)
+      self._metrics.logger.log(("late", key_index), "%d packet of %s arrived too late.", counter, self._keys[key_index])
+      return
+    # Rows this sample makes stale are released before writing it, those past every other sample in one step,
+    #   which also keeps the sample within `capacity` rows of the oldest pending one.
+    counter_stale = min(counter, counter - self._timesteps_before_stale + 2)
+    if counter_stale > self._counter_snapshot:
+      self._release_rows(counter_stale)
+    slot = counter % self._capacity
+    if self._counters[slot] != counter:
+      self._claim_row(counter, slot)
+    self._data[slot, key_index] = data
+    self._is_valid[slot, key_index] = True
+    latest = self._latest_counters[key_index]
+    if counter > latest:
+      self._latest_counters[key_index] = counter
+      if latest >= self._counter_snapshot:
+        self._num_latest_on_row[latest % self._capacity] -= 1
+      else:
+        self._num_keys_reached += 1
+      self._num_latest_on_row[slot] += 1
+      self._num_advanced_on_row[slot] += 1
+      if counter > self._counter_frontier:
+        self._counter_frontier = counter
+    # If every key has reached the oldest pending row (data or skipped), or some key is too far ahead,
+    #   release rows to the reader.
+    while self._num_keys_reached == self._num_keys or \
+          (self._counter_frontier - self._counter_snapshot + 1 >= self._timesteps_before_stale):
+      self._emit_row(is_stale=self._num_keys_reached != self._num_keys)
+
+
+  # First write into a row reused from an older counter clears it, callers check that the row holds another counter.
+  def _claim_row(self, counter: int, slot: int) -> None:
+    # The row still holds one the reader has not read, drop it and the older unread rows.
+    #   NOTE: decided by the row overwritten, rows released past a gap were never written and are not lost by jumping over them.
+    previous_counter = self._counters[slot]
+    if self._is_fifo and previous_counter >= self._counter_read:
+      with self._output_cv:
+        if previous_counter >= self._counter_read:
+          self._num_overwritten_unread += previous_counter + 1 - self._counter_read
+          self._counter_read = previous_counter + 1
+    self._counters[slot] = counter
+    self._is_valid[slot] = False
+    self._num_advanced_on_row[slot] = 0
+
+
+  def _emit_row(self, is_stale: bool = False) -> None:
+    slot = self._counter_snapshot % self._capacity
+    if self._counters[slot] != self._counter_snapshot:
+      self._claim_row(self._counter_snapshot, slot)
+    if self._num_advanced_on_row[slot] != self._num_keys:
+      is_missing = ~self._is_valid[slot]
+      self._metrics.count_mask("padded", is_missing)
+      if is_stale:
+        self._metrics.count_mask("stale_emits", is_missing)
+    self._num_keys_reached -= self._num_latest_on_row[slot]
+    self._num_latest_on_row[slot] = 0
+    self._counter_snapshot += 1
+    if self._counter_frontier < self._counter_snapshot - 1:
+      self._counter_frontier = self._counter_snapshot - 1
+
+
+  # Emits the pending rows before `counter`: those up to the frontier as usual, the rest past any sample in one step.
+  def _release_rows(self, counter: int) -> None:
+    while self._counter_snapshot <= self._counter_frontier and self._counter_snapshot < counter:
+      self._emit_row(is_stale=True)
+    num_rows = counter - self._counter_snapshot
+    if num_rows <= 0:
+      return
+    for key_index in range(self._num_keys):
+      self._metrics.count("padded", key_index, num_rows)
+      self._metrics.count("stale_emits", key_index, num_rows)
+    if self._max_gap_emitted is not None and num_rows > self._max_gap_emitted:
+      self._metrics.count_total("skipped_timesteps", num_rows)
+      if self._is_fifo:
+        with self._output_cv:
+          self._gaps.append((self._counter_snapshot, counter))
+    self._counter_snapshot = counter
+    self._counter_frontier = counter - 1
+
+
+  # Makes rows emitted so far visible to the reader.
+  #   NOTE: both counters are only written by the plopping thread, so nothing to publish is checked without the lock.
+  def _publish(self) -> None:
+    if self._counter_emitted == self._counter_snapshot:
+      return
+    with self._output_cv:
+      t_s = perf_counter()
+      for counter in range(max(self._counter_emitted, self._counter_snapshot - self._capacity), self._counter_snapshot):
+        self._emit_times_s[counter % self._capacity] = t_s
+      self._counter_emitted = self._counter_snapshot
+      self._output_cv.notify_all()
+
+
+  # No more new data will be captured, can evict all present data.
+  def flush(self) -> None:
+    while self._counter_snapshot <= self._counter_frontier:
+      self._emit_row()
+    self._publish()
+
+
+  # Getting packets from the datastructure is synchronous for all keys.
+  #   Returns the counter, data of shape (num_keys, num_channels) and validity mask of shape (num_keys,) of the oldest unread row.
+  #   NOTE: with `copy=False` the arrays are views into the ring, valid until the row is reused `capacity` timesteps later.
+  def yeet(self, timeout: float = 10.0, copy: bool = True) -> tuple[int, np.ndarray, np.ndarray] | None:
+    with self._output_cv:
+      if not self._is_fifo:
+        raise RuntimeError("FIFO delivery is disabled, use `yeet_latest`.")
+      if not self._output_cv.wait_for(self._has_unread, timeout=timeout):
+        self._metrics.count_total("yeet_timeouts")
+        self._metrics.logger.log("yeet_timeout", "Timed out on no more snapshots in the output ring.")
+        return None
+      counter = self._counter_read
+      self._counter_read += 1
+      return (counter, *self._read_row(counter, copy))
+
+
+  # Moves the FIFO reader past released runs it should not read, then checks for unread rows. Called under `_output_cv`.
+  def _has_unread(self) -> bool:
+    while self._gaps and self._gaps[0][0] <= self._counter_read:
+      self._counter_read = max(self._counter_read, self._gaps.popleft()[1])
+    return self._counter_read < self._counter_emitted
+
+
+  # Data and validity of an emitted row, rows released without being written have no valid data.
+  def _read_row(self, counter: int, copy: bool) -> tuple[np.ndarray, np.ndarray]:
+    slot = counter % self._capacity
+    is_valid = self._is_valid[slot] if self._counters[slot] == counter else self._no_valid
+    if copy:
+      return self._data[slot].copy(), is_valid.copy()
+    return self._data[slot], is_valid
+
+
+  # Freshest emitted row not read yet by this reader, with the number of rows emitted since the previous call that it skipped.
+  #   Independent of `yeet`, so a control loop can take the latest while a logger drains every row.
+  #   NOTE: with `copy=False` the arrays are views, overwritten once the writer is `capacity` rows further.
+  def yeet_latest(self, timeout: float = 10.0, copy: bool = True) -> tuple[int, np.ndarray, np.ndarray, int] | None:
+    with self._output_cv:
+      if not self._output_cv.wait_for(lambda: self._counter_latest_read < self._counter_emitted, timeout=timeout):
+        self._metrics.count_total("yeet_timeouts")
+        self._metrics.logger.log("yeet_timeout", "Timed out on no more snapshots in the output ring.")
+        return None
+      counter = self._counter_emitted - 1
+      num_skipped = counter - self._counter_latest_read
+      self._counter_latest_read = counter + 1
+      data, is_valid = self._read_row(counter, copy)
+    if num_skipped:
+      self._metrics.count_total("latest_skipped", num_skipped)
+    return counter, data, is_valid, num_skipped
+
+
+class TimestampAlignedRingBuffer(AlignedRingBuffer):
+  def __init__(self,
+               keys: Iterable,
+               timesteps_before_stale: int, # NOTE: allows yeeting from buffer if some keys have been empty for a while, while others continue producing
+               num_channels: int | None,
+               sampling_period: int, # NOTE: sampling period must be in the same units as timestamp limit and timestamps
+               num_bits_timestamp: int,
+               capacity: int = 1024,
+               dtype: np.dtype = np.float32,
+               metrics: DataQualityMetrics | None = None,
+               is_fifo: bool = True,
+               max_gap_emitted: int | None = None,
+               stale_timeout: AdaptiveStaleTimeout | None = None):
+    keys = list(keys)
+    super().__init__(keys=keys,
+                     timesteps_before_stale=timesteps_before_stale,
+                     num_channels=num_channels,
+                     capacity=capacity,
+                     dtype=dtype,
+                     metrics=metrics,
+                     is_fifo=is_fifo,
+                     max_gap_emitted=max_gap_emitted,
+                     stale_timeout=stale_timeout)
+    self._converter = TimestampToCounterConverter(keys=keys,
+                                                  sampling_period=sampling_period,
+                                                  num_bits_timestamp=num_bits_timestamp)
+
+
+  # Override parent method.
+  def plop(self, key: Any, data: Any, timestamp: int) -> None:
+    # Calculate counter from timestamp and local datastructure to avoid race condition.
+    counter = self._converter.counter_from_timestamp(key, timestamp)
     if counter is not None:
       super().plop(key=key, data=data, counter=counter)
+    else:
+      self._metrics.count("received", self._key_index[key])
+      self._metrics.count("discarded", self._key_index[key])
+
+
+  # Override parent method.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    packets = list(packets)
+    for packet, counter in zip(packets, self._converter.counters_from_packets(packets)):
+      key_index = self._key_index[packet["key"]]
+      self._metrics.count("received", key_index)
+      if counter is not None:
+        self._plop(key_index=key_index, data=packet["data"], counter=counter)
+      else:
+        self._metrics.count("discarded", key_index)
+    self._publish()
+
+
+  # Override parent method, takes timestamps instead of counters.
+  #   Live bursts are a few packets, converted one by one in the same pass that plops them,
+  #   only the large ones (e.g. catching up after a stall) are converted with NumPy first.
+  def plop_array(self, key_indices: np.ndarray, data: np.ndarray, timestamps: np.ndarray) -> None:
+    if len(timestamps) >= MIN_BATCH_SIZE_VECTORIZED:
+      super().plop_array(key_indices=key_indices,
+                         data=data,
+                         counters=self._converter.counters_from_batch(key_indices=key_indices, timestamps=timestamps))
+      return
+    key_indices = np.asarray(key_indices)
+    self._metrics.count_many("received", key_indices)
+    # NOTE: Python ints, fixed-width NumPy scalars would wrap around in the intermediate differences.
+    counter_from_timestamp, keys = self._converter.counter_from_timestamp, self._keys
+    for key_index, row, timestamp in zip(key_indices.tolist(), data, np.asarray(timestamps).tolist()):
+      counter = counter_from_timestamp(keys[key_index], timestamp)
+      if counter is not None:
+        self._plop(key_index=key_index, data=row, counter=counter)
+      else:
+        self._metrics.count("discarded", key_index)
+    self._publish()
+
+
+  # Aligns the next sample of `key` to the running counter again after its device reconnected (see `TimestampToCounterConverter.reanchor`).
+  def reanchor(self, key: Any, reference_key: Any = None) -> None:
+    self._converter.reanchor(key, reference_key)
+
+
+# Bounded single-producer/single-consumer ring of packet records in a preallocated structured array.
+#   The producer (SDK callback thread) only advances `_head` and the consumer only advances `_tail`,
+#   each after its own slots are fully written/read, so neither side takes a lock or notifies.
+#   Packets arriving while the ring is full are dropped and counted instead of growing memory.
+#   NOTE: relies on the GIL to make the index updates visible in order, one producer and one consumer thread only.
+class PacketRing:
+  def __init__(self,
+               capacity: int,
+               dtype: np.dtype = IMU_PACKET_DTYPE):
+    self._capacity = capacity
+    self._records = np.zeros(capacity, dtype=dtype)
+    self._head = 0
+    self._tail = 0
+    self._num_overflows = 0
+
+
+  @property
+  def num_overflows(self) -> int:
+    return self._num_overflows
+
+
+  def __len__(self) -> int:
+    return self._head - self._tail
+
+
+  # Producer side: writes the field values, in order of the record dtype, into the next free slot.
+  def push(self, *values: Any) -> bool:
+    head = self._head
+    if head - self._tail >= self._capacity:
+      self._num_overflows += 1
+      return False
+    self._records[head % self._capacity] = values
+    self._head = head + 1
+    return True
+
+
+  # Consumer side: copies out all records written so far, or None if empty.
+  def pop_many(self) -> np.ndarray | None:
+    tail = self._tail
+    head = self._head
+    if head == tail:
+      return None
+    records = self._records[np.arange(tail, head) % self._capacity]
+    self._tail = head
+    return records
@@ -25,12 +25,16 @@
 #
 # ############
 
-from collections import OrderedDict
 import socket
 import threading
-from MovellaHandler import MovellaFacade
 import numpy as np
-from time import perf_counter
+from MovellaHandler import MovellaFacade
+from sharding import ShardedMovellaFacade
+from ahrs import MahonyAHRS
+from recording import SnapshotRecorder
+from sender import SnapshotSender
+from user_settings import movella_backend
+from time import perf_counter, strftime
 
 
 if __name__ == "__main__":
@@ -45,26 +49,82 @@ if __name__ == "__main__":
     "foot_left"   : "40195BFD80C200D1",
   }
   master_device = 'pelvis' # wireless dot relaying messages, must match a key in the `device_mapping`
+  # Joints handled by each worker process, e.g. one per BLE adapter (see `sharding.py`), the first of each is its master.
+  #   None to run all DOTs in this process. E.g. [["pelvis", "knee_right", "foot_right"], ["knee_left", "foot_left"]]
+  shard_joints = None
   sampling_rate_hz = 30 # can be [1, 4, 10, 12, 15, 20, 30, 60] -> use 1Hz to visually test how long network latency is.
   is_get_orientation = False # at 60Hz, Quaternion from DOTs makes packets too large -> dropout in some sensors
+  is_estimate_orientation = False # estimate quaternions on the host from acc/gyr/mag instead (see `ahrs.py`), sent like the DOTs' own
   is_sync_devices = True # hopefully your wireless driver supports the 
 
   prosthesis_ip = '192.168.0.101'   # ? Prosthesis IP or localhost (to simulate receiving)
   prosthesis_port = 51705           # ? your port from LabView
+  wire_format = "legacy"            # "legacy" 180 bytes the LabView loop expects, or opt-in "v1" header with counter, send time, validity and sampleTimeFine (see `protocol.py`), needs `wire_format = "v1"` in the receiver too
+  payload_encoding = "float32"      # "v1" only: "int16" (fixed-point) or "float16" halve the IMU data for bandwidth-limited links, at ~40 us per send for 5 DOTs against ~15 us for "float32"
+  quaternion_encoding = "smallest_three" # "v1" only: sent if `is_get_orientation` or `is_estimate_orientation`, "smallest_three" packs each in 4 bytes for another ~30 us per send
   daq_ip = '192.168.0.100'
   daq_port = 51705
 
+  is_send_latest = False # True to send the freshest snapshot, skipping any backlog after a stall (control), instead of every snapshot in order
+  stale_quantile = None # e.g. 0.99 to wait for a missing DOT only as long as 99% of its recent packets needed, instead of a fixed 10 timesteps
+  is_trace_latency = False # True for periodic p50/p95/p99/max latency per pipeline stage and device, since the SDK callback (see `tracing.py`)
+
+  recording_path = None # e.g. "recording_%s.mvrec"%strftime("%Y%m%d_%H%M%S") to record, read back with `recording.SnapshotReader`
+  shared_memory_name = None # e.g. "movella_dots" for other local processes to read snapshots with `shm.SharedSnapshotReader`, without sharding
+
+  # Only used with `MOVELLA_BACKEND=simulator`, see `MovellaSimulator._DEFAULT_SETTINGS` for all options.
+  simulator_settings = {
+    "seed": 0,
+    "jitter_s": 0.005,
+    "burst_probability": 0.001,
+    "drop_probability": 0.001,
+  }
+
   ###################
   ###### LOGIC ######
   ###################
-  handler = MovellaFacade(device_mapping=device_mapping,
-                          master_device=master_device,
-                          sampling_rate_hz=sampling_rate_hz,
-                          is_get_orientation=is_get_orientation,
-                          is_sync_devices=is_sync_devices,
-                          timesteps_before_stale=10)
-  num_trackers = len(device_mapping)
-  row_id_mapping = OrderedDict([(device_id, row_id) for row_id, device_id in enumerate(device_mapping.values())])
+  # Host orientation estimate, only if the DOTs do not stream their own.
+  is_ahrs = is_estimate_orientation and not is_get_orientation
+  # Latest-only for the prosthesis and FIFO for the recording and the orientation estimate can run at the same time.
+  #   NOTE: the estimate integrates the counter differences as time steps, it needs every snapshot in order.
+  if is_send_latest:
+    delivery = "both" if recording_path is not None or is_ahrs else "latest"
+  else:
+    delivery = "fifo"
+
+  if movella_backend == "simulator":
+    import MovellaSimulator
+    MovellaSimulator.configure(device_ids=list(device_mapping.values()), **simulator_settings)
+
+  # Unsynced DOT clocks never line up on counters, estimate each against the host and resample instead (see `resampling.py`).
+  alignment = "counter" if is_sync_devices else "resample"
+
+  if shard_joints is None:
+    handler = MovellaFacade(device_mapping=device_mapping,
+                            master_device=master_device,
+                            sampling_rate_hz=sampling_rate_hz,
+                            is_get_orientation=is_get_orientation,
+                            is_sync_devices=is_sync_devices,
+                            timesteps_before_stale=10,
+                            stale_quantile=stale_quantile,
+                            max_gap_emitted=sampling_rate_hz, # skip over more than 1 s without any DOT, e.g. all out of range
+                            delivery=delivery,
+                            alignment=alignment,
+                            is_trace_latency=is_trace_latency,
+                            shared_memory_name=shared_memory_name)
+  else:
+    # NOTE: shards only align synced devices on counters, and neither trace latency nor publish to shared memory.
+    if is_trace_latency or shared_memory_name is not None or alignment != "counter":
+      raise ValueError("`shard_joints` can not be combined with `is_trace_latency`, `shared_memory_name` or `is_sync_devices = False`.")
+    handler = ShardedMovellaFacade(device_mapping=device_mapping,
+                                   shards=shard_joints,
+                                   sampling_rate_hz=sampling_rate_hz,
+                                   is_get_orientation=is_get_orientation,
+                                   is_sync_devices=is_sync_devices,
+                                   timesteps_before_stale=10,
+                                   stale_quantile=stale_quantile,
+                                   max_gap_emitted=sampling_rate_hz,
+                                   delivery=delivery)
   
   # Keep reconnecting until success
   while not handler.initialize(): 
@@ -73,44 +133,53 @@ if __name__ == "__main__":
 
   # Create a UDP socket
   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sender = SnapshotSender(sock=sock,
+                          address=(prosthesis_ip, prosthesis_port),
+                          num_trackers=len(device_mapping),
+                          wire_format=wire_format,
+                          encoding=payload_encoding,
+                          quaternion_encoding=quaternion_encoding if wire_format == "v1" and (is_get_orientation or is_estimate_orientation) else None)
+  ahrs = MahonyAHRS(num_trackers=len(device_mapping),
+                    sampling_rate_hz=sampling_rate_hz) if is_ahrs else None
+  # With latest-only sending, the FIFO thread updates the estimate and the sender takes a copy of the newest one.
+  ahrs_lock = threading.Lock()
+  ahrs_quaternions = np.full((len(device_mapping), 4), np.nan, dtype=np.float32)
+  recorder = SnapshotRecorder(path=recording_path,
+                              device_ids=device_mapping.values(),
+                              sampling_rate_hz=sampling_rate_hz) if recording_path is not None else None
 
   def process_data() -> bool:
     # Stamps full-body snapshot with system time of start of processing, not time-of-arrival.
     # NOTE: time-of-arrival available with each packet.
-    # Retrieve the oldest enqueued packet for each sensor.
+    # Retrieve the freshest, or the oldest enqueued, packet for each sensor.
+    snapshot = handler.get_latest_snapshot() if is_send_latest else handler.get_snapshot()
+    if snapshot is not None:
+      if ahrs is None:
+        quaternion = None
+      elif is_send_latest:
+        with ahrs_lock:
+          np.copyto(ahrs_quaternions, ahrs.quaternions)
+        quaternion = ahrs_quaternions
+      else:
+        quaternion = ahrs.update_snapshot(snapshot)
+      sender.send(snapshot, quaternion=quaternion)
+      handler.trace_sent(snapshot)
+      if recorder is not None and not is_send_latest:
+        recorder.write(snapshot)
+      return False
+    elif snapshot is None and not handler._is_more:
+      return True
+
+
+  # Records and estimates orientation from every snapshot in order, next to the latest-only sending.
+  def record_data() -> bool:
     snapshot = handler.get_snapshot()
     if snapshot is not None:
-      # process_time_s: float = perf_counter()
-      acceleration = np.empty((num_trackers, 3), dtype=np.float32)
-      acceleration.fill(np.nan)
-      gyroscope = np.empty((num_trackers, 3), dtype=np.float32)
-      gyroscope.fill(np.nan)
-      magnetometer = np.empty((num_trackers, 3), dtype=np.float32)
-      magnetometer.fill(np.nan)
-      if is_get_orientation:
-        orientation = np.empty((num_trackers, 4), dtype=np.float32)
-        orientation.fill(np.nan)
-      timestamp = np.zeros((num_trackers), np.uint32)
-      toa_s = np.empty((num_trackers), dtype=np.float64)
-      toa_s.fill(np.nan)
-      counter = np.zeros((num_trackers), np.uint32)
-
-      for device, packet in snapshot.items():
-        id = row_id_mapping[device]
-        if packet and packet["acc"].size:
-          acceleration[id] = packet["acc"]
-          gyroscope[id] = packet["gyr"]
-          magnetometer[id] = packet["mag"]
-          if is_get_orientation:
-            orientation[id] = packet["quaternion"]
-          timestamp[id] = packet["timestamp_fine"]
-          toa_s[id] = packet["toa_s"]
-          counter[id] = packet["counter"]
-      
-      # The payload contents are bytes with float32 structured as:
-      payload: bytes = acceleration.tobytes()+gyroscope.tobytes()+magnetometer.tobytes() # 5x3 (tracker dimensions) x3 (acc/gyr/mag) x4 (bytes) = 180 bytes
-      sock.sendto(payload, (prosthesis_ip, prosthesis_port))
-      # print("TOA diff: ", process_time_s-toa_s, " @ %.6f"%process_time_s, flush=True)
+      if ahrs is not None:
+        with ahrs_lock:
+          ahrs.update_snapshot(snapshot)
+      if recorder is not None:
+        recorder.write(snapshot)
       return False
     elif snapshot is None and not handler._is_more:
       return True
@@ -124,13 +193,28 @@ if __name__ == "__main__":
     while not is_continue:
       is_continue = process_data()
 
+  def bar():
+    is_continue = False
+    while not is_continue:
+      is_continue = record_data()
+
   t = threading.Thread(target=foo)
   t.start()
+  t_record = threading.Thread(target=bar) if delivery == "both" else None
+  if t_record is not None:
+    t_record.start()
   is_exit = False
   while not is_exit:
-    is_exit = input("Enter 'q' to exit: ") == 'q'
+    command = input("Enter 'q' to exit, 'm' for data-quality metrics: ")
+    if command == 'm':
+      print(handler.format_metrics(), flush=True)
+    is_exit = command == 'q'
   handler.cleanup()
   t.join()
+  if t_record is not None:
+    t_record.join()
   handler.close()
+  if recorder is not None:
+    recorder.close()
   sock.close()
   print("Experiment ended, thank you for using our system <3", flush=True)
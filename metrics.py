@@ -0,0 +1,165 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+from time import perf_counter
+from typing import Any, Hashable, Iterable
+
+import numpy as np
+
+
+# Per-device data-quality counters:
+#   "received"    - packets handed to the alignment buffer.
+#   "late"        - packets for a timestep already released to the reader, dropped.
+#   "discarded"   - packets rejected by the timestamp converter (duplicate or out-of-order sampleTimeFine).
+#   "padded"      - timesteps released without a packet of the device (None in the FIFO, invalid in the ring).
+#   "stale_emits" - of those, released early because another device ran `timesteps_before_stale` ahead.
+#   "rejected"    - packets with an empty field from the SDK, dropped in its callback.
+#   "disconnects" - connection losses reported by the SDK.
+#   "reconnects"  - devices connected, configured and streaming again after a connection loss mid-session.
+DEVICE_METRICS = ("received", "late", "discarded", "padded", "stale_emits", "rejected", "disconnects", "reconnects")
+
+# Fewer increments are cheaper one by one than with `np.bincount`, as for the 1 to 2 packets of a typical poll.
+MIN_BATCH_SIZE_BINCOUNT = 4
+
+
+# Prints at most one message per key and period, counting the rest, so a flaky radio can not flood stdout from the hot path.
+#   The message is only formatted when printed.
+class RateLimitedLogger:
+  def __init__(self, period_s: float = 5.0):
+    self._period_s = period_s
+    self._next_time_s: dict[Hashable, float] = {}
+    self._num_suppressed: dict[Hashable, int] = {}
+
+
+  def log(self, key: Hashable, message: str, *args: Any) -> None:
+    t_s = perf_counter()
+    if t_s < self._next_time_s.get(key, 0.0):
+      self._num_suppressed[key] += 1
+      return
+    num_suppressed = self._num_suppressed.get(key, 0)
+    self._next_time_s[key] = t_s + self._period_s
+    self._num_suppressed[key] = 0
+    if num_suppressed:
+      print((message%args if args else message) + " (%d similar suppressed)"%num_suppressed, flush=True)
+    else:
+      print(message%args if args else message, flush=True)
+
+
+  @property
+  def num_suppressed(self) -> int:
+    return sum(self._num_suppressed.values())
+
+
+# Registry of per-device counters in a preallocated array, plus named totals not tied to a device (e.g. SDK errors).
+#   Written by the producer threads without locking, `get_snapshot` may be a few increments behind.
+class DataQualityMetrics:
+  def __init__(self,
+               keys: Iterable,
+               rate_window_s: float = 1.0, # NOTE: shortest period the effective rate is averaged over
+               log_period_s: float = 5.0):
+    self._keys = list(keys)
+    self._metric_index = {metric: i for i, metric in enumerate(DEVICE_METRICS)}
+    self._counts = np.zeros((len(DEVICE_METRICS), len(self._keys)), dtype=np.int64)
+    self._totals: dict[str, int] = {}
+    self._rate_window_s = rate_window_s
+    self._rate_start_s = perf_counter()
+    self._rate_start_counts = np.zeros(len(self._keys), dtype=np.int64)
+    self._rates_hz = np.zeros(len(self._keys), dtype=np.float64)
+    self.logger = RateLimitedLogger(period_s=log_period_s)
+
+
+  @property
+  def keys(self) -> list:
+    return self._keys
+
+
+  def count(self, metric: str, key_index: int, n: int = 1) -> None:
+    self._counts[self._metric_index[metric], key_index] += n
+
+
+  # One increment per entry of `key_indices`, repeated indices add up.
+  def count_many(self, metric: str, key_indices: np.ndarray) -> None:
+    counts = self._counts[self._metric_index[metric]]
+    if len(key_indices) < MIN_BATCH_SIZE_BINCOUNT:
+      for key_index in np.asarray(key_indices).tolist():
+        counts[key_index] += 1
+    else:
+      counts += np.bincount(key_indices, minlength=len(self._keys))
+
+
+  # One increment per key where `mask` is True.
+  def count_mask(self, metric: str, mask: np.ndarray) -> None:
+    self._counts[self._metric_index[metric]] += mask
+
+
+  def count_total(self, name: str, n: int = 1) -> None:
+    self._totals[name] = self._totals.get(name, 0) + n
+
+
+  def get_count(self, metric: str, key_index: int) -> int:
+    return int(self._counts[self._metric_index[metric], key_index])
+
+
+  # Packets received per second and device, averaged since the previous update at least `rate_window_s` ago.
+  def get_rates_hz(self) -> np.ndarray:
+    t_s = perf_counter()
+    if t_s - self._rate_start_s >= self._rate_window_s:
+      received = self._counts[self._metric_index["received"]].copy()
+      self._rates_hz[:] = (received - self._rate_start_counts) / (t_s - self._rate_start_s)
+      self._rate_start_counts[:] = received
+      self._rate_start_s = t_s
+    return self._rates_hz
+
+
+  # Counters and effective rate per device, and the totals, as plain Python values.
+  def get_snapshot(self) -> dict[str, Any]:
+    rates_hz = self.get_rates_hz()
+    counts = self._counts.tolist()
+    return {
+      "devices": {
+        key: {**{metric: counts[i][j] for metric, i in self._metric_index.items()}, "rate_hz": float(rates_hz[j])}
+        for j, key in enumerate(self._keys)
+      },
+      "totals": {**self._totals, "suppressed_logs": self.logger.num_suppressed},
+    }
+
+
+
+# One line per device and one with the totals, for a snapshot of `DataQualityMetrics.get_snapshot`,
+#   and one with the adapted stale timeout if the facade added it.
+def format_metrics(snapshot: dict[str, Any]) -> str:
+  lines = ["%s: %s"%(key, ", ".join("%s %.1f"%(k, v) if isinstance(v, float) else "%s %d"%(k, v) for k, v in values.items()))
+           for key, values in snapshot["devices"].items()]
+  lines.append(", ".join("%s %d"%(k, v) for k, v in snapshot["totals"].items()))
+  if "stale_timeout" in snapshot:
+    stale_timeout = snapshot["stale_timeout"]
+    lines.append("stale timeout %d timesteps (p%g of lags, waits up to %.0f ms), late: %s"%(
+      stale_timeout["timesteps_before_stale"],
+      stale_timeout["quantile"] * 100,
+      stale_timeout["max_wait_s"] * 1000,
+      ", ".join("%s %.2f%%"%(k, v * 100) for k, v in stale_timeout["late_fractions"].items())))
+  return "\n".join(lines)
@@ -27,7 +27,9 @@
 
 import socket
 import time
-import struct
+
+from protocol import LinkStatistics, is_valid_from_mask
+from receiver import SnapshotReceiver
 
 
 if __name__ == "__main__":
@@ -38,6 +40,10 @@ if __name__ == "__main__":
   prosthesis_port = 51705           # ? your port from LabView
   daq_ip = '192.168.0.200'
   daq_port = 51705
+  wire_format = "legacy"            # must match `wire_format` in `main.py`, "v1" only once the sender is switched too
+  num_trackers = 5                  # only needed for the "legacy" format, "v1" packets carry it in the header
+  statistics_period_s = 5.0         # how often to print packet loss, reordering and latency
+  is_keep_all = False               # process every queued snapshot, or only the newest one if the loop fell behind
 
   ###################
   ###### LOGIC ######
@@ -45,39 +51,62 @@ if __name__ == "__main__":
   # Create a UDP socket
   sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
   sock.bind((prosthesis_ip, prosthesis_port))
+  link_statistics = LinkStatistics()
+  # Reads into preallocated buffers and drains all queued datagrams per call (see `receiver.py`).
+  receiver = SnapshotReceiver(sock=sock,
+                              wire_format=wire_format,
+                              num_trackers=num_trackers,
+                              is_keep_all=is_keep_all,
+                              link_statistics=link_statistics)
+  next_statistics_time_s = time.time() + statistics_period_s
 
 
   def process_data() -> None:
-    payload_recv = sock.recv(180) # 180 bytes of IMU data and 20 bytes of counter data to keep measure how long it takes to deliver. 
-    
+    global next_statistics_time_s
+    # v1: 32 bytes of header, 4 bytes of sampleTimeFine per tracker, then 180 bytes of IMU data for 5 trackers.
+    if not receiver.receive():
+      return
+    # Loss, reordering and latency of every drained datagram, including skipped ones.
     recv_time_s: float = time.time()
-    # Cast each 12 bytes (3 dimensions of 4 byte-fp32 of 1 tracker) into separate measurements
-    #  NOTE: you can slice/index in LabView into the packed bytes to match your LabView code better
+    if recv_time_s >= next_statistics_time_s and receiver.latest[0] is not None:
+      print(", ".join("%s: %.3f"%(k, v) for k, v in link_statistics.summary().items()), flush=True)
+      next_statistics_time_s = recv_time_s + statistics_period_s
+    for snapshot in receiver.snapshots:
+      process_snapshot(*snapshot)
+
+
+  def process_snapshot(header, sensors, sample_time_fine, quaternions) -> None:
+    if header is not None:
+      is_valid = is_valid_from_mask(header.valid_mask, header.num_trackers)
+
+    # View the sensor block as (3 modalities: acc/gyr/mag, N trackers, 3 axes: x,y,z) float32, without copying.
+    #  NOTE: "int16"/"float16" encodings of the sender are decoded into a preallocated float32 array for all trackers at once,
+    #   `quaternions` is (N trackers, 4: w,x,y,z) float32 if the sender includes them, else None.
+    #  NOTE: you can slice/index in LabView into the packed bytes to match your LabView code better (offsets in `protocol.py`)
     #   i.e. Take X dimension of acceleration of all trackers, or have 45 individual signals with 1x fp32 value (below). 
-    acc_tracker_0 = struct.unpack('fff', payload_recv[0:12])    # x,y,z
-    acc_tracker_1 = struct.unpack('fff', payload_recv[12:24])   # x,y,z
-    acc_tracker_2 = struct.unpack('fff', payload_recv[24:36])   # x,y,z
-    acc_tracker_3 = struct.unpack('fff', payload_recv[36:48])   # x,y,z
-    acc_tracker_4 = struct.unpack('fff', payload_recv[48:60])   # x,y,z
+    acc_tracker_0 = sensors[0, 0] # x,y,z
+    acc_tracker_1 = sensors[0, 1] # x,y,z
+    acc_tracker_2 = sensors[0, 2] # x,y,z
+    acc_tracker_3 = sensors[0, 3] # x,y,z
+    acc_tracker_4 = sensors[0, 4] # x,y,z
 
-    gyr_tracker_0 = struct.unpack('fff', payload_recv[60:72])   # x,y,z
-    gyr_tracker_1 = struct.unpack('fff', payload_recv[72:84])   # x,y,z
-    gyr_tracker_2 = struct.unpack('fff', payload_recv[84:96])   # x,y,z
-    gyr_tracker_3 = struct.unpack('fff', payload_recv[96:108])  # x,y,z
-    gyr_tracker_4 = struct.unpack('fff', payload_recv[108:120]) # x,y,z
+    gyr_tracker_0 = sensors[1, 0] # x,y,z
+    gyr_tracker_1 = sensors[1, 1] # x,y,z
+    gyr_tracker_2 = sensors[1, 2] # x,y,z
+    gyr_tracker_3 = sensors[1, 3] # x,y,z
+    gyr_tracker_4 = sensors[1, 4] # x,y,z
 
-    mag_tracker_0 = struct.unpack('fff', payload_recv[120:132]) # x,y,z
-    mag_tracker_1 = struct.unpack('fff', payload_recv[132:144]) # x,y,z
-    mag_tracker_2 = struct.unpack('fff', payload_recv[144:156]) # x,y,z
-    mag_tracker_3 = struct.unpack('fff', payload_recv[156:168]) # x,y,z
-    mag_tracker_4 = struct.unpack('fff', payload_recv[168:180]) # x,y,z
+    mag_tracker_0 = sensors[2, 0] # x,y,z
+    mag_tracker_1 = sensors[2, 1] # x,y,z
+    mag_tracker_2 = sensors[2, 2] # x,y,z
+    mag_tracker_3 = sensors[2, 3] # x,y,z
+    mag_tracker_4 = sensors[2, 4] # x,y,z
 
     # OR:
-    # Interpret each 4 packed bytes as floats, for a total of 45 times.
-    # flattened_results: tuple[float] = struct.unpack('f'*45, payload_recv)
-    # NOTE: if `is_sync_devices` is False, most values will be None (nan)
-    #   expected because clocks are off:
-    #   (reset device buttons and increase `timesteps_before_stale` on MovellaFacade).
+    # Flattened 45 floats.
+    # flattened_results = sensors.ravel()
+    # NOTE: if `is_sync_devices` is False, `main.py` resamples the DOTs onto the host clock (`alignment="resample"`),
+    #   values are interpolated between samples and aligned to a few ms, the difference of the DOTs' radio delays.
     # NOTE: if `is_sync_devices` is True, all data will be synced and consistent
     #   your BLE driver must support the feature for syncing the DOTs through their SDK.
 
@@ -0,0 +1,399 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+# UDP wire format shared by the sender (`main.py`, `replay.py`) and the receiver (`prosthesis.py`).
+#
+# "legacy": the float32 sensor block only, 36 bytes per tracker (180 bytes for 5 trackers).
+# "v1":     fixed 32-byte header, optional per-tracker sampleTimeFine, the sensor block, optional quaternion block. Little-endian:
+#   offset  size  field
+#        0     2  magic b"MV"
+#        2     1  version (1)
+#        3     1  flags, bit 0: sampleTimeFine block present, bit 1: quaternion block present
+#        4     1  number of trackers N
+#        5     1  encodings, low nibble: sensor block, high nibble: quaternion block (see `ENCODINGS`)
+#        6     2  reserved (0)
+#        8     4  sequence number of the datagram, +1 per datagram sent (uint32, wraps around)
+#       12     4  snapshot counter (uint32, wraps around)
+#       16     8  validity bitmask, bit i set if tracker i has data (uint64)
+#       24     8  host send time, seconds since the epoch (float64)
+#       32    4N  sampleTimeFine of each tracker (uint32), if flag bit 0 is set
+#        .  9N*s  sensor block: [acc|gyr|mag], each with x,y,z of every tracker in order, s bytes per value
+#        .  4N*s  quaternion block: w,x,y,z of every tracker in order, or 4N bytes with "smallest_three", if flag bit 1 is set
+#
+# Encodings, missing trackers are NaN after decoding:
+#   "float32"         - 4 bytes per value, NaN if missing.
+#   "float16"         - 2 bytes per value, NaN if missing, ~3 significant digits.
+#   "int16"           - 2 bytes per value, fixed-point with per-channel full scale (`INT16_FULL_SCALE`), -32768 if missing.
+#   "smallest_three"  - quaternions only, 4 bytes each: index of the largest component (2 bits) and
+#                       the other three in [-1/sqrt(2), 1/sqrt(2)] with 10 bits each, 0xFFFFFFFF if missing.
+
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+
+WIRE_FORMAT_LEGACY = "legacy"
+WIRE_FORMAT_V1 = "v1"
+PROTOCOL_MAGIC = b"MV"
+PROTOCOL_VERSION = 1
+FLAG_SAMPLE_TIME_FINE = 0x01
+FLAG_QUATERNION = 0x02
+HEADER_STRUCT = struct.Struct("<2sBBBBHIIQd")
+MAX_NUM_TRACKERS = 64
+
+ENCODING_FLOAT32 = "float32"
+ENCODING_FLOAT16 = "float16"
+ENCODING_INT16 = "int16"
+ENCODING_SMALLEST_THREE = "smallest_three"
+ENCODINGS = {ENCODING_FLOAT32: 0, ENCODING_FLOAT16: 1, ENCODING_INT16: 2, ENCODING_SMALLEST_THREE: 3}
+_ENCODING_NAMES = {v: k for k, v in ENCODINGS.items()}
+_ENCODING_DTYPES = {ENCODING_FLOAT32: np.dtype("<f4"), ENCODING_FLOAT16: np.dtype("<f2"), ENCODING_INT16: np.dtype("<i2")}
+# Full-scale range of the DOT per channel: acc in m/s^2 (16 g), gyr in deg/s, mag in a.u.; quaternion components are unit.
+INT16_FULL_SCALE = np.array([16 * 9.81, 2000.0, 8.0], dtype=np.float32)[:, None, None]
+INT16_MISSING = -32768
+_INT16_SENSOR_STEPS = (32767 / INT16_FULL_SCALE).astype(np.float32)
+_INT16_SENSOR_UNITS = (INT16_FULL_SCALE / 32767).astype(np.float32)
+_INT16_QUATERNION_STEPS = np.float32(32767)
+_INT16_QUATERNION_UNITS = np.float32(1 / 32767)
+SMALLEST_THREE_MISSING = 0xFFFFFFFF
+
+
+class PacketHeader(NamedTuple):
+  version: int
+  flags: int
+  num_trackers: int
+  encodings: int
+  sequence: int
+  counter: int
+  valid_mask: int
+  send_time_s: float
+
+
+# Byte offsets of the blocks of a packet, to create NumPy views into a (preallocated) packet buffer.
+class PacketLayout:
+  def __init__(self,
+               num_trackers: int,
+               wire_format: str = WIRE_FORMAT_V1,
+               is_sample_time_fine: bool = True, # NOTE: the legacy format only has the float32 sensor block
+               encoding: str = ENCODING_FLOAT32,
+               quaternion_encoding: str | None = None): # NOTE: None to not send quaternions
+    if wire_format not in (WIRE_FORMAT_LEGACY, WIRE_FORMAT_V1):
+      raise ValueError("Unknown wire format %s."%wire_format)
+    if num_trackers > MAX_NUM_TRACKERS:
+      raise ValueError("Validity bitmask holds at most %d trackers."%MAX_NUM_TRACKERS)
+    if encoding not in _ENCODING_DTYPES or (quaternion_encoding is not None and quaternion_encoding not in ENCODINGS):
+      raise ValueError("Unknown encoding %s/%s."%(encoding, quaternion_encoding))
+    is_legacy = wire_format == WIRE_FORMAT_LEGACY
+    if is_legacy and (encoding != ENCODING_FLOAT32 or quaternion_encoding is not None):
+      raise ValueError("The legacy wire format only carries float32 acc/gyr/mag.")
+    self.num_trackers = num_trackers
+    self.wire_format = wire_format
+    self.is_sample_time_fine = is_sample_time_fine and not is_legacy
+    self.encoding = encoding
+    self.quaternion_encoding = quaternion_encoding
+    self.flags = (FLAG_SAMPLE_TIME_FINE if self.is_sample_time_fine else 0) | (FLAG_QUATERNION if quaternion_encoding is not None else 0)
+    self.encodings = ENCODINGS[encoding] | (ENCODINGS[quaternion_encoding] << 4 if quaternion_encoding is not None else 0)
+    self.header_size = 0 if is_legacy else HEADER_STRUCT.size
+    self.sample_time_fine_offset = self.header_size
+    self.sensor_offset = self.sample_time_fine_offset + (4 * num_trackers if self.is_sample_time_fine else 0)
+    self.quaternion_offset = self.sensor_offset + 9 * num_trackers * _ENCODING_DTYPES[encoding].itemsize
+    if quaternion_encoding is None:
+      quaternion_size = 0
+    elif quaternion_encoding == ENCODING_SMALLEST_THREE:
+      quaternion_size = 4 * num_trackers
+    else:
+      quaternion_size = 4 * num_trackers * _ENCODING_DTYPES[quaternion_encoding].itemsize
+    self.size = self.quaternion_offset + quaternion_size
+
+
+  # Layout a received v1 packet was sent with.
+  @staticmethod
+  def from_header(header: "PacketHeader") -> "PacketLayout":
+    try:
+      encoding = _ENCODING_NAMES[header.encodings & 0x0F]
+      quaternion_encoding = _ENCODING_NAMES[header.encodings >> 4] if header.flags & FLAG_QUATERNION else None
+    except KeyError:
+      raise ValueError("Unknown encodings 0x%02X."%header.encodings)
+    return PacketLayout(num_trackers=header.num_trackers,
+                        wire_format=WIRE_FORMAT_V1,
+                        is_sample_time_fine=bool(header.flags & FLAG_SAMPLE_TIME_FINE),
+                        encoding=encoding,
+                        quaternion_encoding=quaternion_encoding)
+
+
+  # (3 modalities, N trackers, 3 axes) view of the encoded sensor block.
+  def sensors(self, buffer) -> np.ndarray:
+    return np.frombuffer(buffer, dtype=_ENCODING_DTYPES[self.encoding], count=9 * self.num_trackers, offset=self.sensor_offset).reshape(3, self.num_trackers, 3)
+
+
+  # (N trackers,) uint32 view of the sampleTimeFine block, None if the layout has none.
+  def sample_time_fine(self, buffer) -> np.ndarray | None:
+    if not self.is_sample_time_fine:
+      return None
+    return np.frombuffer(buffer, dtype="<u4", count=self.num_trackers, offset=self.sample_time_fine_offset)
+
+
+  # (N trackers, 4) view of the encoded quaternion block, (N trackers,) uint32 for "smallest_three", None if the layout has none.
+  def quaternions(self, buffer) -> np.ndarray | None:
+    if self.quaternion_encoding is None:
+      return None
+    if self.quaternion_encoding == ENCODING_SMALLEST_THREE:
+      return np.frombuffer(buffer, dtype="<u4", count=self.num_trackers, offset=self.quaternion_offset)
+    return np.frombuffer(buffer, dtype=_ENCODING_DTYPES[self.quaternion_encoding], count=4 * self.num_trackers, offset=self.quaternion_offset).reshape(self.num_trackers, 4)
+
+
+def pack_header(buffer, layout: PacketLayout, sequence: int, counter: int, valid_mask: int, send_time_s: float) -> None:
+  HEADER_STRUCT.pack_into(buffer, 0,
+                          PROTOCOL_MAGIC, PROTOCOL_VERSION, layout.flags, layout.num_trackers, layout.encodings, 0,
+                          sequence & 0xFFFFFFFF, counter & 0xFFFFFFFF, valid_mask, send_time_s)
+
+
+def unpack_header(buffer) -> PacketHeader:
+  if len(buffer) < HEADER_STRUCT.size:
+    raise ValueError("Packet of %d bytes is too short for a header."%len(buffer))
+  magic, version, flags, num_trackers, encodings, _, sequence, counter, valid_mask, send_time_s = HEADER_STRUCT.unpack_from(buffer, 0)
+  if magic != PROTOCOL_MAGIC:
+    raise ValueError("Packet does not start with the protocol magic.")
+  if version > PROTOCOL_VERSION:
+    raise ValueError("Packet version %d is newer than supported %d."%(version, PROTOCOL_VERSION))
+  return PacketHeader(version, flags, num_trackers, encodings, sequence, counter, valid_mask, send_time_s)
+
+
+# Decodes a received packet into its header (None for legacy) and float32 sensors (3, N, 3), sampleTimeFine (N,)
+#   and quaternions (N, 4) (None if not in the packet). float32 blocks are views into the buffer, without copying.
+def decode(buffer, wire_format: str, num_trackers: int) -> tuple[PacketHeader | None, np.ndarray, np.ndarray | None, np.ndarray | None]:
+  if wire_format == WIRE_FORMAT_LEGACY:
+    header = None
+    layout = PacketLayout(num_trackers=num_trackers, wire_format=WIRE_FORMAT_LEGACY)
+  else:
+    header = unpack_header(buffer)
+    layout = PacketLayout.from_header(header)
+  if len(buffer) < layout.size:
+    raise ValueError("Packet of %d bytes is shorter than its %d-byte layout."%(len(buffer), layout.size))
+  sensors = decode_sensors(layout.sensors(buffer), layout.encoding)
+  quaternions = layout.quaternions(buffer)
+  if quaternions is not None:
+    quaternions = decode_quaternions(quaternions, layout.quaternion_encoding)
+  return header, sensors, layout.sample_time_fine(buffer), quaternions
+
+
+# Encodes float32 (3, N, 3) sensors into the packet's sensor block view, `scratch` is a float32 array of the same shape.
+def encode_sensors(values: np.ndarray, encoded: np.ndarray, encoding: str, scratch: np.ndarray | None = None) -> None:
+  _encode(values, encoded, encoding, _INT16_SENSOR_STEPS, scratch)
+
+
+# Decodes the sensor block view into float32, a view of the block itself for float32.
+def decode_sensors(encoded: np.ndarray, encoding: str, out: np.ndarray | None = None) -> np.ndarray:
+  return _decode(encoded, encoding, _INT16_SENSOR_UNITS, out)
+
+
+# Encodes float32 (N, 4) quaternions (w,x,y,z) into the packet's quaternion block view.
+#   `scratch` is a `SmallestThreeScratch` for "smallest_three", else a float32 array of the same shape.
+def encode_quaternions(values: np.ndarray, encoded: np.ndarray, encoding: str, scratch: "np.ndarray | SmallestThreeScratch | None" = None) -> None:
+  if encoding == ENCODING_SMALLEST_THREE:
+    pack_smallest_three(values, out=encoded, scratch=scratch)
+  else:
+    _encode(values, encoded, encoding, _INT16_QUATERNION_STEPS, scratch)
+
+
+def decode_quaternions(encoded: np.ndarray, encoding: str, out: np.ndarray | None = None) -> np.ndarray:
+  if encoding == ENCODING_SMALLEST_THREE:
+    quaternions = unpack_smallest_three(encoded)
+    if out is None:
+      return quaternions
+    out[:] = quaternions
+    return out
+  return _decode(encoded, encoding, _INT16_QUATERNION_UNITS, out)
+
+
+# `steps` is the number of int16 steps per unit, 32767 / full scale.
+def _encode(values: np.ndarray, encoded: np.ndarray, encoding: str, steps: np.ndarray, scratch: np.ndarray | None) -> None:
+  if encoding != ENCODING_INT16:
+    np.copyto(encoded, values, casting="unsafe")
+    return
+  if scratch is None:
+    scratch = np.empty(values.shape, dtype=np.float32)
+  np.multiply(values, steps, out=scratch)
+  np.rint(scratch, out=scratch)
+  # NaN passes the clip, then fmax turns it, and only it, into the missing value.
+  np.clip(scratch, -32767, 32767, out=scratch)
+  np.fmax(scratch, INT16_MISSING, out=scratch)
+  np.copyto(encoded, scratch, casting="unsafe")
+
+
+# `units` is the value of one int16 step, full scale / 32767.
+def _decode(encoded: np.ndarray, encoding: str, units: np.ndarray, out: np.ndarray | None) -> np.ndarray:
+  if encoding == ENCODING_FLOAT32 and out is None:
+    return encoded
+  if out is None:
+    out = np.empty(encoded.shape, dtype=np.float32)
+  if encoding == ENCODING_INT16:
+    np.multiply(encoded, units, out=out, casting="unsafe")
+    np.copyto(out, np.nan, where=encoded == INT16_MISSING)
+  else:
+    np.copyto(out, encoded, casting="unsafe")
+  return out
+
+
+# Temporaries of `pack_smallest_three` for N quaternions, allocated once, e.g. to pack on every send.
+class SmallestThreeScratch:
+  def __init__(self, num_quaternions: int):
+    self.magnitudes = np.empty((num_quaternions, 4), dtype=np.float32)
+    self.largest = np.empty(num_quaternions, dtype=np.intp)
+    self.largest_indices = np.empty(num_quaternions, dtype=np.intp)
+    self.scales = np.empty((num_quaternions, 1), dtype=np.float32)
+    self.is_missing = np.empty(num_quaternions, dtype=bool)
+    self.other_indices = np.empty((num_quaternions, 3), dtype=np.intp)
+    self.others = np.empty((num_quaternions, 3), dtype=np.float32)
+    self.fields = np.empty((num_quaternions, 4), dtype=np.uint32)
+    self.row_offsets = 4 * np.arange(num_quaternions, dtype=np.intp)
+
+
+# Packs unit quaternions (N, 4) into one uint32 each: q and -q are the same rotation, so the largest component
+#   is made positive and reconstructed from the other three, which are then bounded by 1/sqrt(2).
+#   With a uint32 `out` and a `scratch` for N quaternions, every step writes into them and no array is allocated,
+#   about half the time of allocating the temporaries for 5 trackers.
+def pack_smallest_three(quaternions: np.ndarray, out: np.ndarray | None = None, scratch: SmallestThreeScratch | None = None) -> np.ndarray:
+  quaternions = np.ascontiguousarray(quaternions, dtype=np.float32)
+  if out is None:
+    out = np.empty(len(quaternions), dtype=np.uint32)
+  if scratch is None:
+    scratch = SmallestThreeScratch(len(quaternions))
+  flat = quaternions.reshape(-1)
+  # Largest magnitude per row, NaN rows (missing trackers) pick a NaN component, which flags them.
+  np.abs(quaternions, out=scratch.magnitudes)
+  np.argmax(scratch.magnitudes, axis=1, out=scratch.largest)
+  np.add(scratch.largest, scratch.row_offsets, out=scratch.largest_indices)
+  np.take(flat, scratch.largest_indices, out=scratch.scales[:, 0])
+  np.isnan(scratch.scales[:, 0], out=scratch.is_missing)
+  # The other three components, with the sign of the largest flipped to positive, quantized to 10 bits over [-1/sqrt(2), 1/sqrt(2)].
+  #   fmax/fmin also turn the NaN of missing rows into 0.
+  np.sign(scratch.scales, out=scratch.scales)
+  np.multiply(scratch.scales, _SMALLEST_THREE_SCALE, out=scratch.scales)
+  np.take(_SMALLEST_THREE_OTHERS, scratch.largest, axis=0, out=scratch.other_indices)
+  np.add(scratch.other_indices, scratch.row_offsets[:, None], out=scratch.other_indices)
+  np.take(flat, scratch.other_indices, out=scratch.others)
+  np.multiply(scratch.others, scratch.scales, out=scratch.others)
+  np.add(scratch.others, 511.5, out=scratch.others)
+  np.fmax(scratch.others, 0.0, out=scratch.others)
+  np.fmin(scratch.others, 1023.0, out=scratch.others)
+  np.rint(scratch.others, out=scratch.others)
+  # Index of the largest in the top 2 bits, then the three in 10 bits each.
+  np.copyto(scratch.fields[:, 0], scratch.largest, casting="unsafe")
+  np.copyto(scratch.fields[:, 1:], scratch.others, casting="unsafe")
+  np.matmul(scratch.fields, _SMALLEST_THREE_SHIFTS, out=out)
+  np.copyto(out, SMALLEST_THREE_MISSING, where=scratch.is_missing)
+  return out
+
+
+def unpack_smallest_three(packed: np.ndarray) -> np.ndarray:
+  packed = np.asarray(packed, dtype=np.uint32)
+  largest = (packed >> 30).astype(np.intp)
+  others = np.stack([(packed >> 20) & 0x3FF, (packed >> 10) & 0x3FF, packed & 0x3FF], axis=-1).astype(np.float32) / 511.5 - 1.0
+  others /= np.sqrt(2)
+  quaternions = np.empty((len(packed), 4), dtype=np.float32)
+  rows = np.arange(len(packed))
+  quaternions[rows, largest] = np.sqrt(np.maximum(0.0, 1.0 - (others ** 2).sum(axis=-1)))
+  quaternions[rows[:, None], _SMALLEST_THREE_OTHERS[largest]] = others
+  quaternions[packed == SMALLEST_THREE_MISSING] = np.nan
+  return quaternions
+
+
+# Indices of the three transmitted components for each index of the largest one.
+_SMALLEST_THREE_OTHERS = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]], dtype=np.intp)
+_SMALLEST_THREE_SCALE = np.float32(np.sqrt(2) * 511.5)
+_SMALLEST_THREE_SHIFTS = np.array([1 << 30, 1 << 20, 1 << 10, 1], dtype=np.uint32)
+
+
+# Bit i set if tracker i is valid.
+#   With a uint64 `scratch` of one entry per tracker, e.g. on every send, no array is allocated.
+def validity_mask(is_valid: np.ndarray, scratch: np.ndarray | None = None) -> int:
+  if scratch is None:
+    return int.from_bytes(np.packbits(is_valid, bitorder="little").tobytes(), "little")
+  np.copyto(scratch, is_valid)
+  np.left_shift(scratch, _TRACKER_BITS[:len(scratch)], out=scratch)
+  return int(scratch.sum())
+
+
+_TRACKER_BITS = np.arange(MAX_NUM_TRACKERS, dtype=np.uint64)
+
+
+def is_valid_from_mask(valid_mask: int, num_trackers: int) -> np.ndarray:
+  return ((valid_mask >> np.arange(num_trackers, dtype=np.uint64)) & 1).astype(bool)
+
+
+# Tracks packet loss, reordering and one-way latency of the received sequence numbers.
+#   NOTE: one-way latency compares the sender's and receiver's wall clocks, only meaningful if they are synchronized (NTP/PTP).
+class LinkStatistics:
+  def __init__(self, latency_window: int = 1024):
+    self._expected_sequence: int | None = None
+    self._num_received = 0
+    self._num_lost = 0
+    self._num_reordered = 0
+    self._num_malformed = 0
+    self._latencies_s = np.zeros(latency_window, dtype=np.float64)
+    self._num_latencies = 0
+
+
+  # Sequence numbers wrap around at 32 bits, differences are taken modulo and interpreted as signed.
+  def update(self, header: PacketHeader, recv_time_s: float) -> None:
+    self._num_received += 1
+    if self._expected_sequence is None:
+      self._expected_sequence = (header.sequence + 1) & 0xFFFFFFFF
+    else:
+      gap = ((header.sequence - self._expected_sequence + 2**31) & 0xFFFFFFFF) - 2**31
+      if gap >= 0:
+        # Datagrams skipped are counted lost until they show up late.
+        self._num_lost += gap
+        self._expected_sequence = (header.sequence + 1) & 0xFFFFFFFF
+      else:
+        self._num_reordered += 1
+        self._num_lost = max(0, self._num_lost - 1)
+    self._latencies_s[self._num_latencies % len(self._latencies_s)] = recv_time_s - header.send_time_s
+    self._num_latencies += 1
+
+
+  # Datagrams discarded by the receiver before reaching `update`, e.g. truncated or with a bad header.
+  def count_malformed(self) -> None:
+    self._num_malformed += 1
+
+
+  def summary(self) -> dict[str, float]:
+    latencies_ms = self._latencies_s[:min(self._num_latencies, len(self._latencies_s))] * 1e3
+    summary = {
+      "num_received":   float(self._num_received),
+      "num_lost":       float(self._num_lost),
+      "loss_ratio":     self._num_lost / max(1, self._num_received + self._num_lost),
+      "num_reordered":  float(self._num_reordered),
+      "num_malformed":  float(self._num_malformed),
+    }
+    if len(latencies_ms):
+      summary["latency_p50_ms"] = float(np.percentile(latencies_ms, 50))
+      summary["latency_p99_ms"] = float(np.percentile(latencies_ms, 99))
+      summary["latency_max_ms"] = float(latencies_ms.max())
+    return summary
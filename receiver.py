@@ -0,0 +1,235 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import selectors
+import socket
+import time
+from typing import Any
+
+import numpy as np
+
+from metrics import RateLimitedLogger
+from protocol import (ENCODING_FLOAT32, WIRE_FORMAT_LEGACY, WIRE_FORMAT_V1, LinkStatistics, PacketHeader, PacketLayout,
+                      decode_quaternions, decode_sensors, unpack_header)
+
+ReceivedSnapshot = tuple[PacketHeader | None, np.ndarray, np.ndarray | None, np.ndarray | None]
+
+
+# Receives snapshots of `sender.SnapshotSender` with `recv_into` into preallocated slots, without allocating packet buffers.
+#   Each `receive` waits for the first datagram, up to the timeout the socket had when passed in (None to block),
+#   then drains everything already queued on the socket,
+#   so a receiver that fell behind catches up in one go instead of working through stale snapshots.
+#   Keeps only the newest datagram, or all of them (up to `max_num_datagrams` per call, the rest stay queued).
+#   Sensor blocks are float32 views (3 modalities, N trackers, 3 axes) into the slot, or decoded into a preallocated
+#   float32 array per slot for the quantized encodings.
+class SnapshotReceiver:
+  def __init__(self,
+               sock: socket.socket,
+               wire_format: str = WIRE_FORMAT_LEGACY, # NOTE: must match the sender's, both default to the legacy sensor block
+               num_trackers: int = 5, # NOTE: only used by the legacy format, v1 packets carry it in the header
+               is_keep_all: bool = False,
+               max_num_datagrams: int = 64,
+               max_datagram_size: int = 2048,
+               link_statistics: LinkStatistics | None = None, # NOTE: also counts the malformed datagrams
+               log_period_s: float = 5.0): # NOTE: at most one message per period and kind of malformed datagram
+    self._sock = sock
+    # The socket stays non-blocking, a selector waits for the first datagram instead of switching modes per datagram.
+    self._timeout_s = sock.gettimeout()
+    sock.setblocking(False)
+    self._selector = selectors.DefaultSelector()
+    self._selector.register(sock, selectors.EVENT_READ)
+    self._wire_format = wire_format
+    self._is_keep_all = is_keep_all
+    self._link_statistics = link_statistics
+    # Newest-only alternates between 2 slots, so a malformed datagram never overwrites the last good one.
+    self._num_slots = max_num_datagrams if is_keep_all else 2
+    self._buffer = bytearray(self._num_slots * max_datagram_size)
+    self._slots = [memoryview(self._buffer)[i*max_datagram_size:(i+1)*max_datagram_size] for i in range(self._num_slots)]
+    self._newest_slot = 1
+    # Views into each slot, rebuilt only when the sender changes the layout.
+    self._layout_key: tuple[int, int, int] | None = None
+    self._layout: PacketLayout | None = None
+    self._views: list[tuple[np.ndarray, np.ndarray | None, np.ndarray | None, np.ndarray | None, np.ndarray | None]] = []
+    if wire_format == WIRE_FORMAT_LEGACY:
+      self._set_layout(PacketLayout(num_trackers=num_trackers, wire_format=WIRE_FORMAT_LEGACY))
+    self._received: list[ReceivedSnapshot] = []
+    self._num_datagrams = 0
+    self._num_discarded = 0
+    self._num_skipped = 0
+    self._logger = RateLimitedLogger(period_s=log_period_s)
+
+
+  # Waits until a datagram arrives (or the timeout passes) and drains the socket.
+  #   Returns the number of snapshots kept, accessible with `latest`, `snapshots` and indexing,
+  #   until the next `receive` overwrites them.
+  def receive(self) -> int:
+    self._received.clear()
+    slot = 0 if self._is_keep_all else self._newest_slot ^ 1
+    try:
+      size = self._recv_first(self._slots[slot])
+    except (BlockingIOError, InterruptedError):
+      return 0
+    recv_time_s = time.time()
+    headers: list[PacketHeader | None] = []
+    slots: list[int] = []
+    while True:
+      self._num_datagrams += 1
+      layout = self._layout
+      is_accepted, header = self._accept(slot, size, recv_time_s)
+      if self._layout is not layout and headers:
+        # Views of the snapshots kept so far follow the new layout, drop them.
+        self._num_skipped += len(headers)
+        headers.clear()
+        slots.clear()
+        if self._is_keep_all:
+          self._slots[0][:size] = self._slots[slot][:size]
+          slot = 0
+      if is_accepted and self._is_keep_all:
+        headers.append(header)
+        slots.append(slot)
+        slot += 1
+        if slot == self._num_slots:
+          break
+      elif is_accepted:
+        if headers:
+          self._num_skipped += 1
+          headers[0] = header
+          slots[0] = slot
+        else:
+          headers.append(header)
+          slots.append(slot)
+        self._newest_slot = slot
+        slot ^= 1
+      try:
+        size = self._sock.recv_into(self._slots[slot])
+      except (BlockingIOError, InterruptedError):
+        break
+    for header, slot in zip(headers, slots):
+      self._received.append((header, *self._decode(slot)))
+    return len(self._received)
+
+
+  # (header, sensors, sampleTimeFine, quaternions) of the newest snapshot kept by the last `receive`, None if none.
+  @property
+  def latest(self) -> ReceivedSnapshot | None:
+    return self._received[-1] if self._received else None
+
+
+  # All snapshots kept by the last `receive`, in order of arrival.
+  @property
+  def snapshots(self) -> list[ReceivedSnapshot]:
+    return self._received
+
+
+  def __len__(self) -> int:
+    return len(self._received)
+
+
+  def __getitem__(self, i: int) -> ReceivedSnapshot:
+    return self._received[i]
+
+
+  @property
+  def layout(self) -> PacketLayout | None:
+    return self._layout
+
+
+  # Datagrams read, discarded as malformed, and skipped in favor of a newer one.
+  def get_counts(self) -> dict[str, int]:
+    return {
+      "datagrams": self._num_datagrams,
+      "discarded": self._num_discarded,
+      "skipped": self._num_skipped,
+    }
+
+
+  # Validates the datagram in the slot and updates the link statistics, (False, None) if malformed.
+  #   The layout only changes for a datagram long enough for the new one, so a truncated one can not drop the snapshots kept.
+  def _accept(self, slot: int, size: int, recv_time_s: float) -> tuple[bool, PacketHeader | None]:
+    if self._wire_format == WIRE_FORMAT_LEGACY:
+      if size < self._layout.size:
+        self._discard("short", "Discarded packet of %d bytes, shorter than its %d-byte layout.", size, self._layout.size)
+        return False, None
+      return True, None
+    try:
+      header = unpack_header(self._slots[slot])
+      layout_key = (header.flags, header.num_trackers, header.encodings)
+      layout = self._layout if layout_key == self._layout_key else PacketLayout.from_header(header)
+    except ValueError as e:
+      self._discard("malformed", "Discarded packet: %s", e)
+      return False, None
+    if size < layout.size:
+      self._discard("short", "Discarded packet of %d bytes, shorter than its %d-byte layout.", size, layout.size)
+      return False, None
+    if layout is not self._layout:
+      self._set_layout(layout)
+      self._layout_key = layout_key
+    if self._link_statistics is not None:
+      self._link_statistics.update(header, recv_time_s)
+    return True, header
+
+
+  # Counts a malformed datagram, printing at most one message per kind and period.
+  def _discard(self, kind: str, message: str, *args: Any) -> None:
+    self._num_discarded += 1
+    if self._link_statistics is not None:
+      self._link_statistics.count_malformed()
+    self._logger.log(kind, message, *args)
+
+
+  def _set_layout(self, layout: PacketLayout) -> None:
+    self._layout = layout
+    self._views = []
+    for slot in self._slots:
+      sensors = layout.sensors(slot)
+      quaternions = layout.quaternions(slot)
+      self._views.append((
+        sensors,
+        layout.sample_time_fine(slot),
+        quaternions,
+        None if layout.encoding == ENCODING_FLOAT32 else np.empty(sensors.shape, dtype=np.float32),
+        None if quaternions is None or layout.quaternion_encoding == ENCODING_FLOAT32 else np.empty((layout.num_trackers, 4), dtype=np.float32),
+      ))
+
+
+  def _decode(self, slot: int) -> tuple[np.ndarray, np.ndarray | None, np.ndarray | None]:
+    sensors, sample_time_fine, quaternions, sensors_out, quaternions_out = self._views[slot]
+    if sensors_out is not None:
+      sensors = decode_sensors(sensors, self._layout.encoding, sensors_out)
+    if quaternions_out is not None:
+      quaternions = decode_quaternions(quaternions, self._layout.quaternion_encoding, quaternions_out)
+    return sensors, sample_time_fine, quaternions
+
+
+  # Reads a datagram already queued without waiting, or waits for the next one, BlockingIOError if none within the timeout.
+  def _recv_first(self, slot: memoryview) -> int:
+    try:
+      return self._sock.recv_into(slot)
+    except BlockingIOError:
+      if not self._selector.select(self._timeout_s):
+        raise
+      return self._sock.recv_into(slot)
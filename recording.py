@@ -0,0 +1,240 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import json
+import os
+import queue
+import threading
+from typing import Iterable
+
+import numpy as np
+
+
+# File layout (little-endian):
+#   magic (8 bytes) | header length (uint32) | JSON metadata padded with spaces to `header length`
+#   | fixed-size snapshot records back to back (dtype from `snapshot_record_dtype`) until the end of the file.
+#   A sidecar `<path>.idx` holds (record index, counter, time of arrival) every `index_interval` records,
+#   to locate time and counter ranges of long sessions without touching the records.
+RECORDING_MAGIC = b"MVDOTREC"
+RECORDING_VERSION = 1
+_HEADER_ALIGNMENT = 64
+INDEX_DTYPE = np.dtype([
+  ("record",  np.uint64),
+  ("counter", np.int64),
+  ("toa_s",   np.float64),
+])
+
+
+# One record per aligned snapshot, every field holds all devices in order of the device mapping.
+def snapshot_record_dtype(num_devices: int) -> np.dtype:
+  return np.dtype([
+    ("counter",         np.int64),
+    ("is_valid",        np.bool_,   (num_devices,)),
+    ("timestamp_fine",  np.uint32,  (num_devices,)),
+    ("toa_s",           np.float64, (num_devices,)),
+    ("acc",             np.float32, (num_devices, 3)),
+    ("gyr",             np.float32, (num_devices, 3)),
+    ("mag",             np.float32, (num_devices, 3)),
+    ("quaternion",      np.float32, (num_devices, 4)),
+  ])
+
+
+# Appends every snapshot it is given to a recording file from a background thread,
+#   in bulk writes of up to `batch_size` records, so the acquisition loop only pays for a Queue put.
+class SnapshotRecorder:
+  def __init__(self,
+               path: str,
+               device_ids: Iterable[str],
+               sampling_rate_hz: int,
+               batch_size: int = 256,
+               index_interval: int = 1024,
+               flush_period_s: float = 1.0): # NOTE: max time records wait in memory before written out
+    self._path = path
+    self._device_ids = list(device_ids)
+    self._dtype = snapshot_record_dtype(len(self._device_ids))
+    self._batch = np.zeros(batch_size, dtype=self._dtype)
+    self._index_interval = index_interval
+    self._flush_period_s = flush_period_s
+    self._num_records = 0
+    self._last_toa_s = -np.inf
+    self._snapshot_queue = queue.SimpleQueue()
+    metadata = {
+      "version":          RECORDING_VERSION,
+      "device_ids":       self._device_ids,
+      "sampling_rate_hz": sampling_rate_hz,
+      "index_interval":   index_interval,
+      "dtype":            np.lib.format.dtype_to_descr(self._dtype),
+    }
+    self._file = open(path, "wb")
+    self._index_file = open(path + ".idx", "wb")
+    self._file.write(_encode_header(metadata))
+    self._thread = threading.Thread(target=self._run)
+    self._thread.start()
+
+
+  @property
+  def num_records(self) -> int:
+    return self._num_records
+
+
+  # Snapshot as returned by `MovellaFacade.get_snapshot`: (counter, `IMU_PACKET_DTYPE` records, validity mask).
+  #   NOTE: the arrays must not be modified afterwards, they are written out later by the background thread.
+  def write(self, snapshot: tuple[int, np.ndarray, np.ndarray]) -> None:
+    self._snapshot_queue.put(snapshot)
+
+
+  # Writes out everything still queued and closes the files.
+  def close(self) -> None:
+    self._snapshot_queue.put(None)
+    self._thread.join()
+
+
+  def _run(self) -> None:
+    num_batched = 0
+    is_more = True
+    while is_more:
+      try:
+        snapshot = self._snapshot_queue.get(timeout=self._flush_period_s)
+      except queue.Empty:
+        snapshot = False
+      if snapshot is None:
+        is_more = False
+      elif snapshot is not False:
+        counter, records, is_valid = snapshot
+        row = self._batch[num_batched]
+        row["counter"] = counter
+        row["is_valid"] = is_valid
+        row["timestamp_fine"] = records["timestamp_fine"]
+        row["toa_s"] = records["toa_s"]
+        row["acc"] = records["acc"]
+        row["gyr"] = records["gyr"]
+        row["mag"] = records["mag"]
+        row["quaternion"] = records["quaternion"]
+        num_batched += 1
+      if num_batched and (num_batched == len(self._batch) or snapshot is False or not is_more):
+        self._write_batch(self._batch[:num_batched])
+        num_batched = 0
+    self._file.close()
+    self._index_file.close()
+
+
+  def _write_batch(self, batch: np.ndarray) -> None:
+    first_record = self._num_records
+    self._file.write(batch.tobytes())
+    self._num_records += len(batch)
+    # Index entries for every record number divisible by the interval within this batch.
+    #   Time is the running max of arrival times, so the index stays sorted despite jitter and fully invalid snapshots.
+    toa_s = np.fmax.accumulate(np.r_[self._last_toa_s, _snapshot_toa_s(batch)])[1:]
+    self._last_toa_s = toa_s[-1]
+    records = np.arange(-(-first_record // self._index_interval) * self._index_interval, self._num_records, self._index_interval)
+    if len(records):
+      entries = np.zeros(len(records), dtype=INDEX_DTYPE)
+      entries["record"] = records
+      entries["counter"] = batch["counter"][records - first_record]
+      entries["toa_s"] = toa_s[records - first_record]
+      self._index_file.write(entries.tobytes())
+    self._file.flush()
+    self._index_file.flush()
+
+
+# Exposes a recording as memory-mapped NumPy arrays, only the pages of the slices accessed are read from disk.
+class SnapshotReader:
+  def __init__(self, path: str):
+    with open(path, "rb") as f:
+      magic = f.read(len(RECORDING_MAGIC))
+      if magic != RECORDING_MAGIC:
+        raise ValueError("%s is not a snapshot recording."%path)
+      header_length = int.from_bytes(f.read(4), "little")
+      metadata = json.loads(f.read(header_length))
+    if metadata["version"] > RECORDING_VERSION:
+      raise ValueError("Recording version %d is newer than supported %d."%(metadata["version"], RECORDING_VERSION))
+    self._metadata = metadata
+    self._dtype = np.lib.format.descr_to_dtype([tuple(field) for field in metadata["dtype"]])
+    offset = len(RECORDING_MAGIC) + 4 + header_length
+    # A trailing partial record of an interrupted session is ignored.
+    num_records = (os.path.getsize(path) - offset) // self._dtype.itemsize
+    self._records = np.memmap(path, dtype=self._dtype, mode="r", offset=offset, shape=(num_records,)) \
+      if num_records else np.zeros(0, dtype=self._dtype)
+    index_path = path + ".idx"
+    index = np.fromfile(index_path, dtype=INDEX_DTYPE) if os.path.exists(index_path) else np.zeros(0, dtype=INDEX_DTYPE)
+    self._index = index[index["record"] < num_records]
+
+
+  def __len__(self) -> int:
+    return len(self._records)
+
+
+  @property
+  def records(self) -> np.ndarray:
+    return self._records
+
+
+  @property
+  def device_ids(self) -> list[str]:
+    return self._metadata["device_ids"]
+
+
+  @property
+  def sampling_rate_hz(self) -> int:
+    return self._metadata["sampling_rate_hz"]
+
+
+  # Records with `start <= counter < stop`, as a view.
+  def slice_counter(self, start: int, stop: int) -> np.ndarray:
+    first, last = self._index_bounds(self._index["counter"], start, stop)
+    counters = self._records["counter"][first:last]
+    return self._records[first + np.searchsorted(counters, start):first + np.searchsorted(counters, stop)]
+
+
+  # Records whose latest time of arrival (`perf_counter` seconds on the acquisition host) is within `[start_s, stop_s)`, as a view.
+  def slice_time(self, start_s: float, stop_s: float) -> np.ndarray:
+    first, last = self._index_bounds(self._index["toa_s"], start_s, stop_s)
+    # Running max like the index, snapshots without any valid device inherit the time of the previous one.
+    toa_s = np.fmax.accumulate(np.nan_to_num(_snapshot_toa_s(self._records[first:last]), nan=-np.inf))
+    return self._records[first + np.searchsorted(toa_s, start_s, side="left"):first + np.searchsorted(toa_s, stop_s, side="left")]
+
+
+  # Range of records guaranteed to contain all values in `[start, stop)` of a (mostly) increasing field, from the sparse index.
+  def _index_bounds(self, indexed: np.ndarray, start: float, stop: float) -> tuple[int, int]:
+    i_first = np.searchsorted(indexed, start, side="right") - 1
+    i_last = np.searchsorted(indexed, stop, side="right")
+    first = int(self._index["record"][i_first]) if i_first >= 0 else 0
+    last = int(self._index["record"][i_last]) + 1 if i_last < len(self._index) else len(self._records)
+    return first, last
+
+
+def _encode_header(metadata: dict) -> bytes:
+  encoded = json.dumps(metadata).encode("utf-8")
+  header_length = -(-(len(RECORDING_MAGIC) + 4 + len(encoded)) // _HEADER_ALIGNMENT) * _HEADER_ALIGNMENT - len(RECORDING_MAGIC) - 4
+  return RECORDING_MAGIC + header_length.to_bytes(4, "little") + encoded.ljust(header_length, b" ")
+
+
+# Time of arrival of the last device of each snapshot, NaN if none is valid.
+def _snapshot_toa_s(records: np.ndarray) -> np.ndarray:
+  toa_s = np.where(records["is_valid"], records["toa_s"], -np.inf).max(axis=-1, initial=-np.inf)
+  toa_s[np.isinf(toa_s)] = np.nan
+  return toa_s
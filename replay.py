@@ -0,0 +1,183 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+# Re-streams a recording of `main.py` to the prosthesis in the same UDP wire format, to test the receiving side without wearing the DOTs.
+#   python replay.py recording.mvrec                  # original timing
+#   python replay.py recording.mvrec --speed 4        # 4x faster than recorded
+#   python replay.py recording.mvrec --speed 0        # as fast as possible, to measure the receiver's capacity
+
+import argparse
+import socket
+from time import perf_counter, sleep
+
+import numpy as np
+
+from protocol import ENCODING_FLOAT16, ENCODING_FLOAT32, ENCODING_INT16, ENCODING_SMALLEST_THREE, WIRE_FORMAT_LEGACY, WIRE_FORMAT_V1
+from recording import SnapshotReader
+from sender import SnapshotSender
+
+
+# Sends the records on schedule and keeps the send time of each, to report the achieved rate and jitter.
+class Replayer:
+  def __init__(self,
+               sender: SnapshotSender,
+               records: np.ndarray,
+               schedule_s: np.ndarray | None, # NOTE: send time of each record relative to the first, None for as fast as possible
+               report_period_s: float = 5.0):
+    self._sender = sender
+    self._records = records
+    self._schedule_s = schedule_s
+    self._report_period_s = report_period_s
+    self._t_sent_s = np.zeros(len(records), dtype=np.float64)
+
+
+  def run(self) -> dict[str, float]:
+    t_start_s = perf_counter()
+    t_report_s = t_start_s + self._report_period_s
+    i_report = 0
+    for i, record in enumerate(self._records):
+      if self._schedule_s is not None:
+        _wait_until(t_start_s + self._schedule_s[i])
+      self._sender.send_arrays(counter=int(record["counter"]),
+                               acc=record["acc"],
+                               gyr=record["gyr"],
+                               mag=record["mag"],
+                               is_valid=record["is_valid"],
+                               sample_time_fine=record["timestamp_fine"],
+                               quaternion=record["quaternion"])
+      self._t_sent_s[i] = t_sent_s = perf_counter()
+      if t_sent_s >= t_report_s:
+        _print_report("last %.0fs"%self._report_period_s, self._statistics(i_report, i + 1, t_start_s))
+        t_report_s += self._report_period_s
+        i_report = i + 1
+    statistics = self._statistics(0, len(self._records), t_start_s)
+    _print_report("total", statistics)
+    return statistics
+
+
+  # Achieved rate, inter-packet intervals and lateness against the schedule of records [first, last).
+  def _statistics(self, first: int, last: int, t_start_s: float) -> dict[str, float]:
+    t_sent_s = self._t_sent_s[first:last]
+    statistics = {"num_sent": float(last - first)}
+    if len(t_sent_s) < 2:
+      return statistics
+    intervals_ms = np.diff(t_sent_s) * 1e3
+    statistics["rate_hz"] = (len(t_sent_s) - 1) / (t_sent_s[-1] - t_sent_s[0])
+    statistics["interval_mean_ms"] = float(intervals_ms.mean())
+    statistics["jitter_std_ms"] = float(intervals_ms.std())
+    statistics["interval_p99_ms"] = float(np.percentile(intervals_ms, 99))
+    statistics["interval_max_ms"] = float(intervals_ms.max())
+    if self._schedule_s is not None:
+      lateness_ms = (t_sent_s - t_start_s - self._schedule_s[first:last]) * 1e3
+      statistics["lateness_p99_ms"] = float(np.percentile(lateness_ms, 99))
+      statistics["lateness_max_ms"] = float(lateness_ms.max())
+    return statistics
+
+
+# Sleeps most of the way, then spins for the last millisecond which `sleep` can not resolve reliably.
+def _wait_until(t_s: float) -> None:
+  remaining_s = t_s - perf_counter()
+  if remaining_s > 2e-3:
+    sleep(remaining_s - 1e-3)
+  while perf_counter() < t_s:
+    pass
+
+
+def _print_report(label: str, statistics: dict[str, float]) -> None:
+  print("[%s] "%label + ", ".join("%s: %.3f"%(k, v) for k, v in statistics.items()), flush=True)
+
+
+# Send time of each record relative to the first one, from the recorded counters or times of arrival.
+def _make_schedule(records: np.ndarray, sampling_rate_hz: int, clock: str, speed: float) -> np.ndarray | None:
+  if speed <= 0:
+    return None
+  if clock == "counter":
+    schedule_s = (records["counter"] - records["counter"][0]) / sampling_rate_hz
+  else:
+    # Latest arrival in each snapshot, kept monotone across jitter and fully invalid snapshots.
+    toa_s = np.where(records["is_valid"], records["toa_s"], -np.inf).max(axis=-1, initial=-np.inf)
+    toa_s = np.maximum.accumulate(toa_s)
+    toa_s[np.isinf(toa_s)] = toa_s[np.isfinite(toa_s)][0] if np.isfinite(toa_s).any() else 0.0
+    schedule_s = toa_s - toa_s[0]
+  return schedule_s / speed
+
+
+if __name__ == "__main__":
+  ###########################
+  ###### CONFIGURATION ######
+  ###########################
+  parser = argparse.ArgumentParser(description="Replay a snapshot recording over UDP in the `main.py` wire format.")
+  parser.add_argument("path", help="recording file written by `main.py`")
+  parser.add_argument("--ip", default="192.168.0.101", help="prosthesis IP, or localhost to test locally")
+  parser.add_argument("--port", type=int, default=51705, help="prosthesis UDP port")
+  parser.add_argument("--speed", type=float, default=1.0, help="multiple of the recorded rate, 0 to send as fast as possible")
+  parser.add_argument("--clock", choices=("counter", "toa"), default="counter",
+                      help="timing from snapshot counters (nominal rate) or recorded times of arrival (original jitter)")
+  parser.add_argument("--start", type=int, default=None, help="first snapshot counter to replay")
+  parser.add_argument("--stop", type=int, default=None, help="snapshot counter to stop before")
+  parser.add_argument("--wire-format", choices=(WIRE_FORMAT_V1, WIRE_FORMAT_LEGACY), default=WIRE_FORMAT_LEGACY,
+                      help="packet layout of `protocol.py`, v1 only if the receiver expects it too")
+  parser.add_argument("--encoding", choices=(ENCODING_FLOAT32, ENCODING_FLOAT16, ENCODING_INT16), default=ENCODING_FLOAT32,
+                      help="v1 only, encoding of the acc/gyr/mag block")
+  parser.add_argument("--quaternion-encoding", choices=(ENCODING_FLOAT32, ENCODING_FLOAT16, ENCODING_INT16, ENCODING_SMALLEST_THREE), default=None,
+                      help="v1 only, also send the recorded quaternions in this encoding")
+  parser.add_argument("--report-period", type=float, default=5.0, help="seconds between intermediate reports")
+  args = parser.parse_args()
+
+  ###################
+  ###### LOGIC ######
+  ###################
+  reader = SnapshotReader(args.path)
+  records = reader.records
+  if not len(records):
+    parser.exit(1, "%s holds no snapshots.\n"%args.path)
+  if args.start is not None or args.stop is not None:
+    first_counter, last_counter = int(records["counter"][0]), int(records["counter"][-1])
+    records = reader.slice_counter(args.start if args.start is not None else np.iinfo(np.int64).min,
+                                   args.stop if args.stop is not None else np.iinfo(np.int64).max)
+    if not len(records):
+      parser.exit(1, "No snapshots between --start %s and --stop %s, %s holds counters %d to %d.\n"%(
+                  args.start, args.stop, args.path, first_counter, last_counter))
+  print("Replaying %d snapshots of %d trackers to %s:%d."%(len(records), len(reader.device_ids), args.ip, args.port), flush=True)
+
+  sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  sender = SnapshotSender(sock=sock,
+                          address=(args.ip, args.port),
+                          num_trackers=len(reader.device_ids),
+                          wire_format=args.wire_format,
+                          encoding=args.encoding,
+                          quaternion_encoding=args.quaternion_encoding)
+  replayer = Replayer(sender=sender,
+                      records=records,
+                      schedule_s=_make_schedule(records, reader.sampling_rate_hz, args.clock, args.speed),
+                      report_period_s=args.report_period)
+  try:
+    replayer.run()
+  except KeyboardInterrupt:
+    print("Keyboard interrupt signalled, quitting...", flush=True)
+  finally:
+    sock.close()
@@ -0,0 +1,273 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+from typing import Any, Iterable
+
+import numpy as np
+
+from datastructures import IMU_PACKET_DTYPE, AdaptiveStaleTimeout, AlignedRingBuffer
+from metrics import DataQualityMetrics
+
+
+# Online estimate of the clock of one device against the host, from the `sampleTimeFine` and host time of arrival of its packets:
+#   host_s = device_s + offset_s + drift * device_s, by exponentially weighted least squares that forgets with `half_life_s` of device time.
+#   Arrival times only ever lag the samples, by the BLE delivery delay, so residuals beyond `huber_k` times their mean absolute value
+#   (e.g. a burst of late packets) are down-weighted instead of pulling the estimate.
+class OnlineClockRegression:
+  def __init__(self,
+               half_life_s: float = 30.0,
+               huber_k: float = 3.0,
+               drift_prior_weight: float = 1.0): # NOTE: in weight * s^2, pulls the drift to 0 until the samples span a few seconds
+    self._half_life_s = half_life_s
+    self._huber_k = huber_k
+    self._drift_prior_weight = drift_prior_weight
+    self.reset()
+
+
+  # Forgets everything, e.g. after the device rebooted or reconnected and its clock restarted.
+  def reset(self) -> None:
+    self._device_origin_s: float | None = None
+    self._host_origin_s = 0.0
+    self._x_last = 0.0
+    self._weight = 0.0
+    self._mean_x = 0.0
+    self._mean_y = 0.0
+    self._cov_xx = 0.0
+    self._cov_xy = 0.0
+    self._abs_residual = 0.0
+
+
+  @property
+  def is_started(self) -> bool:
+    return self._device_origin_s is not None
+
+
+  @property
+  def drift(self) -> float:
+    return self._cov_xy / (self._cov_xx + self._drift_prior_weight)
+
+
+  # Offset of host time from device time at device time `device_s`.
+  def offset(self, device_s: float) -> float:
+    x = device_s - self._device_origin_s
+    return self._host_origin_s - self._device_origin_s + self._mean_y + self.drift * (x - self._mean_x)
+
+
+  # Host time of device time `device_s`.
+  def to_host(self, device_s: float) -> float:
+    return device_s + self.offset(device_s)
+
+
+  # Adds a sample: device time (unwrapped) and host time of arrival, both in seconds.
+  def add(self, device_s: float, host_s: float) -> None:
+    if self._device_origin_s is None:
+      self._device_origin_s = device_s
+      self._host_origin_s = host_s
+    # Regress the offset on device time relative to the first sample, both stay small for precision.
+    x = device_s - self._device_origin_s
+    y = host_s - self._host_origin_s - x
+    weight = 1.0
+    decay = 1.0
+    residual = None
+    if self._weight > 0:
+      residual = abs(y - self._mean_y - self.drift * (x - self._mean_x))
+      scale = self._huber_k * self._abs_residual
+      if scale > 0 and residual > scale:
+        weight = scale / residual
+        residual = scale
+      decay = 0.5 ** (max(x - self._x_last, 0.0) / self._half_life_s)
+    self._x_last = x
+    # Weighted Welford update of the means and co-moments, older samples decayed first.
+    self._weight = decay * self._weight + weight
+    self._cov_xx *= decay
+    self._cov_xy *= decay
+    rate = weight / self._weight
+    dx = x - self._mean_x
+    self._mean_x += rate * dx
+    self._mean_y += rate * (y - self._mean_y)
+    self._cov_xx += weight * dx * (x - self._mean_x)
+    self._cov_xy += weight * dx * (y - self._mean_y)
+    if residual is not None:
+      self._abs_residual += rate * (residual - self._abs_residual)
+
+
+# Aligns devices whose clocks are not synced: every sample is mapped to host time by the clock estimate of its device
+#   (`OnlineClockRegression`) and each device is interpolated onto a common grid at the sampling rate, counter k at
+#   the host time of the first sample + k / `sampling_rate_hz`. Acc/gyr/mag are interpolated linearly and quaternions with SLERP,
+#   a grid point is written once the following sample of the device arrived, so at most one sampling period later than counters.
+#   Snapshots are rows of `IMU_PACKET_DTYPE` records with `timestamp_fine` interpolated as well and `toa_s` that of the later sample.
+#   NOTE: devices share the grid up to the difference of their mean BLE delays, a few ms, rather than to the sample.
+class ResampledAlignedRingBuffer(AlignedRingBuffer):
+  def __init__(self,
+               keys: Iterable,
+               timesteps_before_stale: int,
+               sampling_rate_hz: int,
+               ticks_per_s: int = 10000, # NOTE: resolution of the timestamps, as `sampleTimeFine`
+               num_bits_timestamp: int = 32,
+               capacity: int = 1024,
+               metrics: DataQualityMetrics | None = None,
+               is_fifo: bool = True,
+               max_gap_emitted: int | None = None,
+               max_interpolation_gap_s: float | None = None, # NOTE: samples further apart are not interpolated between, None for 2.5 sampling periods
+               clock_half_life_s: float = 30.0,
+               stale_timeout: AdaptiveStaleTimeout | None = None):
+    keys = list(keys)
+    super().__init__(keys=keys,
+                     timesteps_before_stale=timesteps_before_stale,
+                     num_channels=None,
+                     capacity=capacity,
+                     dtype=IMU_PACKET_DTYPE,
+                     metrics=metrics,
+                     is_fifo=is_fifo,
+                     max_gap_emitted=max_gap_emitted,
+                     stale_timeout=stale_timeout)
+    self._period_s = 1 / sampling_rate_hz
+    self._ticks_per_s = ticks_per_s
+    self._timestamp_limit = 2**num_bits_timestamp
+    self._max_interpolation_gap_s = max_interpolation_gap_s if max_interpolation_gap_s is not None else 2.5 * self._period_s
+    self._clocks = [OnlineClockRegression(half_life_s=clock_half_life_s) for _ in keys]
+    # Per key: last raw timestamp, unwrapped ticks and host time of its last sample, and that sample, None until the first or after a reanchor.
+    self._last_timestamps = [0] * len(keys)
+    self._last_ticks = [0] * len(keys)
+    self._last_host_s = [0.0] * len(keys)
+    self._last_records: list[np.void | None] = [None] * len(keys)
+    self._host_origin_s: float | None = None
+
+
+  # Current offset (s) and drift (ppm) of each device clock against the host, None for devices without samples yet.
+  @property
+  def clock_estimates(self) -> dict[Any, tuple[float, float] | None]:
+    return {key: (clock.offset(self._last_ticks[i] / self._ticks_per_s), clock.drift * 1e6) if clock.is_started else None
+            for i, (key, clock) in enumerate(zip(self._keys, self._clocks))}
+
+
+  # Override parent method.
+  def plop(self, key: Any, data: Any, timestamp: int) -> None:
+    self.plop_array(key_indices=[self._key_index[key]], data=np.asarray([data], dtype=IMU_PACKET_DTYPE), timestamps=[timestamp])
+
+
+  # Override parent method.
+  def plop_many(self, packets: Iterable[dict]) -> None:
+    packets = list(packets)
+    self.plop_array(key_indices=[self._key_index[packet["key"]] for packet in packets],
+                    data=np.asarray([packet["data"] for packet in packets], dtype=IMU_PACKET_DTYPE),
+                    timestamps=[packet["timestamp"] for packet in packets])
+
+
+  # Override parent method, with timestamps instead of counters, host times of arrival are taken from the `toa_s` of the records.
+  def plop_array(self, key_indices: np.ndarray, data: np.ndarray, timestamps: Iterable[int]) -> None:
+    key_indices = np.asarray(key_indices)
+    self._metrics.count_many("received", key_indices)
+    # Collect the grid points every sample completes, to interpolate them all at once.
+    point_keys, point_counters, point_alphas, starts, ends = [], [], [], [], []
+    for key_index, record, timestamp in zip(key_indices.tolist(), data, timestamps):
+      host_s = self._to_host(key_index, int(timestamp), float(record["toa_s"]))
+      last_record = self._last_records[key_index]
+      last_host_s = self._last_host_s[key_index]
+      if last_record is not None and host_s <= last_host_s:
+        self._metrics.count("discarded", key_index)
+        continue
+      if self._host_origin_s is None:
+        self._host_origin_s = host_s
+      self._last_host_s[key_index] = host_s
+      self._last_records[key_index] = record.copy()
+      if last_record is None:
+        # Nothing to interpolate from, only the very first sample lands on the grid (at counter 0).
+        if host_s != self._host_origin_s:
+          continue
+        last_host_s = host_s - self._period_s
+        last_record = record
+      elif host_s - last_host_s > self._max_interpolation_gap_s:
+        continue
+      counter_first = max(int(np.floor((last_host_s - self._host_origin_s) / self._period_s)) + 1, 0)
+      counter_last = int(np.floor((host_s - self._host_origin_s) / self._period_s))
+      for counter in range(counter_first, counter_last + 1):
+        point_keys.append(key_index)
+        point_counters.append(counter)
+        point_alphas.append((self._host_origin_s + counter * self._period_s - last_host_s) / (host_s - last_host_s))
+        starts.append(last_record)
+        ends.append(record)
+    if point_keys:
+      rows = _interpolate(np.asarray(starts, dtype=IMU_PACKET_DTYPE),
+                          np.asarray(ends, dtype=IMU_PACKET_DTYPE),
+                          np.asarray(point_alphas),
+                          self._timestamp_limit)
+      for key_index, row, counter in zip(point_keys, rows, point_counters):
+        self._plop(key_index=key_index, data=row, counter=counter)
+    self._publish()
+
+
+  # Unwraps the timestamp of the key and maps it to host time with the clock estimate updated by this sample.
+  def _to_host(self, key_index: int, timestamp: int, toa_s: float) -> float:
+    clock = self._clocks[key_index]
+    if clock.is_started:
+      delta = (timestamp - self._last_timestamps[key_index]) % self._timestamp_limit
+      # A sample older than the last one has a wrapped-around delta close to the limit.
+      if delta > self._timestamp_limit // 2:
+        delta -= self._timestamp_limit
+      self._last_ticks[key_index] += delta
+    else:
+      self._last_ticks[key_index] = timestamp
+    self._last_timestamps[key_index] = timestamp
+    device_s = self._last_ticks[key_index] / self._ticks_per_s
+    clock.add(device_s, toa_s)
+    return clock.to_host(device_s)
+
+
+  # The clock of the key restarted, e.g. after a reconnect: estimate it anew and do not interpolate across.
+  def reanchor(self, key: Any) -> None:
+    key_index = self._key_index[key]
+    self._clocks[key_index].reset()
+    self._last_records[key_index] = None
+
+
+# Records at fraction `alphas` of the way from `starts` to `ends`: linear for the IMU data and timestamps, SLERP for quaternions.
+def _interpolate(starts: np.ndarray, ends: np.ndarray, alphas: np.ndarray, timestamp_limit: int) -> np.ndarray:
+  rows = ends.copy()
+  a = alphas.astype(np.float32)[:, None]
+  for field in ("acc", "gyr", "mag"):
+    rows[field] = starts[field] + a * (ends[field] - starts[field])
+  delta = (ends["timestamp_fine"].astype(np.int64) - starts["timestamp_fine"]) % timestamp_limit
+  rows["timestamp_fine"] = (starts["timestamp_fine"] + np.round(alphas * delta).astype(np.int64)) % timestamp_limit
+  rows["quaternion"] = _slerp(starts["quaternion"], ends["quaternion"], a)
+  return rows
+
+
+# Shortest-path spherical interpolation of unit quaternions (N, 4), normalized lerp where they are nearly equal.
+#   NaN quaternions, e.g. when orientation is not streamed, stay NaN.
+def _slerp(q0: np.ndarray, q1: np.ndarray, a: np.ndarray) -> np.ndarray:
+  with np.errstate(invalid="ignore", divide="ignore"):
+    dot = np.sum(q0 * q1, axis=1, keepdims=True)
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+    theta = np.arccos(np.minimum(dot, 1.0))
+    sin_theta = np.sin(theta)
+    is_close = dot > 0.9995
+    w0 = np.where(is_close, 1 - a, np.sin((1 - a) * theta) / sin_theta)
+    w1 = np.where(is_close, a, np.sin(a * theta) / sin_theta)
+    q = w0 * q0 + w1 * q1
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
@@ -0,0 +1,158 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import socket
+import time
+
+import numpy as np
+
+from protocol import (ENCODING_FLOAT32, ENCODING_SMALLEST_THREE, WIRE_FORMAT_LEGACY, PacketLayout, SmallestThreeScratch, encode_quaternions,
+                      encode_sensors, pack_header, validity_mask)
+
+
+# Sends full-body snapshots to the prosthesis over UDP from a single preallocated packet,
+#   laid out exactly as the wire format of `protocol.py`: optional header and sampleTimeFine block, then
+#   the [acc|gyr|mag] blocks, each holding x,y,z of every tracker in order, then optional quaternions.
+#   5x3 (tracker dimensions) x3 (acc/gyr/mag) x4 (bytes) = 180 bytes for 5 trackers, plus 32+4x5 bytes with the v1 header,
+#   the sensor block halves with the "int16" or "float16" encodings.
+class SnapshotSender:
+  def __init__(self,
+               sock: socket.socket,
+               address: tuple[str, int],
+               num_trackers: int,
+               wire_format: str = WIRE_FORMAT_LEGACY, # NOTE: the sensor block the LabView loop expects, "v1" adds the header (see `protocol.py`)
+               is_send_sample_time_fine: bool = True,
+               encoding: str = ENCODING_FLOAT32,
+               quaternion_encoding: str | None = None): # NOTE: None to not send quaternions
+    self._sock = sock
+    self._address = address
+    self._layout = PacketLayout(num_trackers=num_trackers,
+                                wire_format=wire_format,
+                                is_sample_time_fine=is_send_sample_time_fine,
+                                encoding=encoding,
+                                quaternion_encoding=quaternion_encoding)
+    self._packet = bytearray(self._layout.size)
+    self._packet_view = memoryview(self._packet)
+    self._encoded_payload = self._layout.sensors(self._packet)
+    self._sample_time_fine = self._layout.sample_time_fine(self._packet)
+    self._encoded_quaternions = self._layout.quaternions(self._packet)
+    # float32 staging for quantized encodings, float32 is written into the packet directly.
+    if encoding == ENCODING_FLOAT32:
+      self._payload = self._encoded_payload
+    else:
+      self._payload = np.empty((3, num_trackers, 3), dtype=np.float32)
+    self._scratch = np.empty((3, num_trackers, 3), dtype=np.float32)
+    self._quaternions = np.empty((num_trackers, 4), dtype=np.float32)
+    self._quaternion_scratch = SmallestThreeScratch(num_trackers) if quaternion_encoding == ENCODING_SMALLEST_THREE \
+                               else np.empty((num_trackers, 4), dtype=np.float32)
+    # Missing trackers and the validity bitmask are computed into these on every send, without allocating.
+    self._is_missing = np.empty(num_trackers, dtype=bool)
+    self._is_missing_rows = self._is_missing[:, None]
+    self._valid_mask_scratch = np.empty(num_trackers, dtype=np.uint64)
+    self._sequence = 0
+
+
+  @property
+  def payload(self) -> np.ndarray:
+    return self._payload
+
+
+  @property
+  def layout(self) -> PacketLayout:
+    return self._layout
+
+
+  # Writes the snapshot (counter, `IMU_PACKET_DTYPE` records, validity mask, and the skip count of latest-only delivery if any)
+  #   into the packet in place, trackers without a packet are NaN.
+  #   `quaternion` replaces the streamed orientation of the records, e.g. with the host estimate of `ahrs.MahonyAHRS`.
+  def fill(self, snapshot: tuple[int, np.ndarray, np.ndarray], quaternion: np.ndarray | None = None) -> memoryview:
+    counter, records, is_valid = snapshot[:3]
+    return self.fill_arrays(counter=counter,
+                            acc=records["acc"],
+                            gyr=records["gyr"],
+                            mag=records["mag"],
+                            is_valid=is_valid,
+                            sample_time_fine=records["timestamp_fine"],
+                            quaternion=records["quaternion"] if quaternion is None else quaternion)
+
+
+  # Same from separate (num_trackers, 3) arrays, e.g. fields of a `recording.SnapshotReader` record.
+  def fill_arrays(self,
+                  counter: int,
+                  acc: np.ndarray,
+                  gyr: np.ndarray,
+                  mag: np.ndarray,
+                  is_valid: np.ndarray,
+                  sample_time_fine: np.ndarray | None = None,
+                  quaternion: np.ndarray | None = None) -> memoryview:
+    self._payload[0] = acc
+    self._payload[1] = gyr
+    self._payload[2] = mag
+    np.logical_not(is_valid, out=self._is_missing)
+    np.copyto(self._payload, np.nan, where=self._is_missing_rows)
+    if self._payload is not self._encoded_payload:
+      encode_sensors(self._payload, self._encoded_payload, self._layout.encoding, self._scratch)
+    if self._encoded_quaternions is not None:
+      if quaternion is not None:
+        self._quaternions[:] = quaternion
+      else:
+        self._quaternions.fill(np.nan)
+      np.copyto(self._quaternions, np.nan, where=self._is_missing_rows)
+      encode_quaternions(self._quaternions, self._encoded_quaternions, self._layout.quaternion_encoding, self._quaternion_scratch)
+    if self._layout.header_size:
+      if self._sample_time_fine is not None:
+        if sample_time_fine is not None:
+          self._sample_time_fine[:] = sample_time_fine
+        else:
+          self._sample_time_fine.fill(0)
+      pack_header(self._packet, self._layout,
+                  sequence=self._sequence,
+                  counter=counter,
+                  valid_mask=validity_mask(is_valid, self._valid_mask_scratch),
+                  send_time_s=time.time())
+    return self._packet_view
+
+
+  def send(self, snapshot: tuple[int, np.ndarray, np.ndarray], quaternion: np.ndarray | None = None) -> int:
+    return self._send(self.fill(snapshot, quaternion=quaternion))
+
+
+  def send_arrays(self,
+                  counter: int,
+                  acc: np.ndarray,
+                  gyr: np.ndarray,
+                  mag: np.ndarray,
+                  is_valid: np.ndarray,
+                  sample_time_fine: np.ndarray | None = None,
+                  quaternion: np.ndarray | None = None) -> int:
+    return self._send(self.fill_arrays(counter=counter, acc=acc, gyr=gyr, mag=mag, is_valid=is_valid, sample_time_fine=sample_time_fine, quaternion=quaternion))
+
+
+  def _send(self, packet: memoryview) -> int:
+    num_bytes = self._sock.sendto(packet, self._address)
+    self._sequence += 1
+    return num_bytes
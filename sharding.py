@@ -0,0 +1,458 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import multiprocessing as mp
+import os
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any
+
+import numpy as np
+
+from MovellaHandler import MovellaFacade
+from datastructures import IMU_PACKET_DTYPE, MIN_BATCH_SIZE_VECTORIZED, AdaptiveStaleTimeout, AlignedRingBuffer, TimestampToCounterConverter
+from metrics import DataQualityMetrics, format_metrics
+from user_settings import movella_backend
+
+# Shard-side counters reported to the coordinator, the others are counted by its alignment buffer.
+SHARD_METRICS = ("discarded", "rejected", "disconnects", "reconnects", "overflows")
+
+
+# Estimates the host time of counter 0 of each shard, as the minimum of time of arrival minus counter times the sampling period
+#   over windows of `window_s` (the fastest delivery), and converts it into the counter offset of the shard
+#   against the first shard to complete a window. Shards sync their DOTs to their own master only, so their clocks, and counters,
+#   are unrelated otherwise. The offset of a shard is re-estimated every window and only changed by more than `hysteresis`
+#   periods, to follow the drift between shard clocks without toggling.
+class ShardClockAligner:
+  def __init__(self,
+               num_shards: int,
+               sampling_rate_hz: float,
+               window_s: float = 1.0,
+               hysteresis: float = 0.75):
+    self._sampling_period_s = 1.0 / sampling_rate_hz
+    self._window_s = window_s
+    self._hysteresis = hysteresis
+    self._window_start_s: list[float | None] = [None] * num_shards
+    self._window_t_zero_s = [np.inf] * num_shards
+    self._t_zero_s: list[float | None] = [None] * num_shards
+    self._offsets: list[int | None] = [None] * num_shards
+    self._reference: int | None = None
+
+
+  @property
+  def offsets(self) -> list[int | None]:
+    return list(self._offsets)
+
+
+  # Accounts for a batch of the shard, returns its current counter offset, None until its first window completes.
+  def add(self, shard_index: int, toa_s: np.ndarray, counters: np.ndarray) -> int | None:
+    self._window_t_zero_s[shard_index] = min(self._window_t_zero_s[shard_index],
+                                             float(np.min(toa_s - counters * self._sampling_period_s)))
+    if self._window_start_s[shard_index] is None:
+      self._window_start_s[shard_index] = float(toa_s[0])
+    if toa_s[-1] - self._window_start_s[shard_index] >= self._window_s:
+      self._t_zero_s[shard_index] = self._window_t_zero_s[shard_index]
+      self._window_t_zero_s[shard_index] = np.inf
+      self._window_start_s[shard_index] = None
+      if self._reference is None:
+        self._reference = shard_index
+      if shard_index == self._reference:
+        self._offsets[shard_index] = 0
+      else:
+        offset = (self._t_zero_s[shard_index] - self._t_zero_s[self._reference]) / self._sampling_period_s
+        if self._offsets[shard_index] is None or abs(offset - self._offsets[shard_index]) > self._hysteresis:
+          self._offsets[shard_index] = round(offset)
+    return self._offsets[shard_index]
+
+
+# Ingestion half of `MovellaFacade` in a worker process: its own SDK manager, callbacks, rings and timestamp converter,
+#   forwarding the records of accepted packets with their shard counters to the coordinator instead of aligning them.
+class _ShardFacade(MovellaFacade):
+  def __init__(self,
+               shard_index: int,
+               device_indices: list[int], # NOTE: position of each device of the shard in the coordinator's device mapping
+               out_queue: Any,
+               **kwargs):
+    super().__init__(**kwargs)
+    self._shard_index = shard_index
+    self._coordinator_device_indices = np.asarray(device_indices, dtype=np.uint8)
+    self._out_queue = out_queue
+    self._device_ids = list(self._device_index)
+    self._converter = TimestampToCounterConverter(keys=self._device_ids,
+                                                  sampling_period=self._sampling_period,
+                                                  num_bits_timestamp=32)
+
+
+  # Override parent method: the coordinator aligns, traces and publishes the packets of all shards.
+  def _init_alignment(self, **kwargs) -> None:
+    self._stale_timeout = None
+    self._tracer = None
+    self._shared_writer = None
+
+
+  # Override parent method.
+  def _on_packets(self, records: np.ndarray, t_s: float) -> None:
+    if len(records) >= MIN_BATCH_SIZE_VECTORIZED:
+      counters = self._converter.counters_from_batch(key_indices=records["device"], timestamps=records["timestamp_fine"])
+    else:
+      # Live bursts are a few packets, converted one by one without the NumPy round trip of `counters_from_batch`.
+      counter_from_timestamp, device_ids = self._converter.counter_from_timestamp, self._device_ids
+      counters = [counter_from_timestamp(device_ids[device_index], timestamp)
+                  for device_index, timestamp in zip(records["device"].tolist(), records["timestamp_fine"].tolist())]
+    counters = np.array([-1 if counter is None else counter for counter in counters], dtype=np.int64)
+    self._metrics.count_many("received", records["device"])
+    is_accepted = counters >= 0
+    if not is_accepted.all():
+      self._metrics.count_many("discarded", records["device"][~is_accepted])
+      records = records[is_accepted]
+      counters = counters[is_accepted]
+    if len(records):
+      records["device"] = self._coordinator_device_indices[records["device"]]
+      self._out_queue.put(("records", self._shard_index, records, counters))
+
+
+  # Override parent method.
+  def _flush_packets(self) -> None:
+    pass
+
+
+  # Override parent method.
+  def _reanchor(self, device_id: str) -> None:
+    self._converter.reanchor(device_id)
+
+
+# Entry point of a worker process: sets up and streams its shard until `stop_event`, reporting to `out_queue`:
+#   ("status", shard, is_initialized), ("records", shard, records, counters), ("metrics", shard, snapshot) and ("done", shard).
+def _run_shard(shard_index: int,
+               device_indices: list[int],
+               facade_kwargs: dict[str, Any],
+               simulator_settings: dict[str, Any] | None,
+               out_queue: Any,
+               stop_event: Any,
+               metrics_period_s: float) -> None:
+  if simulator_settings is not None:
+    import MovellaSimulator
+    MovellaSimulator.configure(**simulator_settings)
+  facade = _ShardFacade(shard_index=shard_index, device_indices=device_indices, out_queue=out_queue, **facade_kwargs)
+  is_initialized = facade.initialize()
+  out_queue.put(("status", shard_index, is_initialized))
+  if is_initialized:
+    while not stop_event.wait(metrics_period_s):
+      out_queue.put(("metrics", shard_index, facade.get_metrics()))
+  facade.cleanup()
+  facade.close()
+  out_queue.put(("metrics", shard_index, facade.get_metrics()))
+  out_queue.put(("done", shard_index))
+
+
+# Sets environment variables for the duration of the block, inherited by processes started in it.
+@contextmanager
+def _environment(variables: dict[str, str]):
+  previous = {name: os.environ.get(name) for name in variables}
+  os.environ.update(variables)
+  try:
+    yield
+  finally:
+    for name, value in previous.items():
+      if value is None:
+        os.environ.pop(name, None)
+      else:
+        os.environ[name] = value
+
+
+# Drop-in for `MovellaFacade` spreading the DOTs over worker processes, e.g. one per BLE adapter, so SDK callbacks,
+#   funneling and timestamp conversion of each shard run on their own core and GIL.
+#   Each worker owns the devices of its shard (own `XsDotConnectionManager`, master and sync), converts their timestamps
+#   to counters and streams the compact records to this coordinator, which offsets each shard's counters onto a common
+#   timeline (see `ShardClockAligner`) and aligns all devices in one buffer, served with `get_snapshot`/`get_latest_snapshot`.
+#   Records are held back until every shard has its first offset estimate, `clock_window_s` after its first packet.
+class ShardedMovellaFacade:
+  def __init__(self,
+               device_mapping: dict[str, str], # NOTE: order of the devices in the snapshots, like `MovellaFacade`
+               shards: list[list[str]], # NOTE: joints of each worker, every joint of `device_mapping` in exactly one
+               sampling_rate_hz: int,
+               is_get_orientation: bool,
+               is_sync_devices: bool,
+               master_devices: list[str] | None = None, # NOTE: one joint per shard, syncs the devices of its shard, the first joint of each if None
+               timesteps_before_stale: int = 100,
+               stale_quantile: float | None = None, # NOTE: see `MovellaFacade`, lags here include those of the workers
+               stale_bounds: tuple[int, int] = (2, 100),
+               buffer_capacity: int = 1024,
+               max_gap_emitted: int | None = None,
+               delivery: str = "fifo",
+               shard_environments: list[dict[str, str]] | None = None, # NOTE: environment variables of each worker, e.g. to select its BLE adapter
+               shard_facade_kwargs: dict[str, Any] | None = None, # NOTE: further `MovellaFacade` arguments of every worker, e.g. `setup_attempts`
+               clock_window_s: float = 1.0,
+               metrics_period_s: float = 1.0,
+               status_timeout_s: float | None = None) -> None: # NOTE: time to wait for every shard to stream, None to wait forever
+    if master_devices is None:
+      master_devices = [joints[0] for joints in shards]
+    if len(master_devices) != len(shards):
+      raise ValueError("Expected one master device per shard, got %d for %d shards."%(len(master_devices), len(shards)))
+    if sorted(joint for joints in shards for joint in joints) != sorted(device_mapping):
+      raise ValueError("Every joint of the device mapping must be in exactly one shard.")
+    if delivery not in ("fifo", "latest", "both"):
+      raise ValueError("Unknown delivery %s."%delivery)
+    self._device_mapping = device_mapping
+    self._device_index = OrderedDict([(device_id, i) for i, device_id in enumerate(device_mapping.values())])
+    self._shards = [OrderedDict([(joint, device_mapping[joint]) for joint in joints]) for joints in shards]
+    self._master_devices = master_devices
+    self._sampling_rate_hz = sampling_rate_hz
+    self._is_get_orientation = is_get_orientation
+    self._is_sync_devices = is_sync_devices
+    self._shard_environments = shard_environments if shard_environments is not None else [{} for _ in shards]
+    self._shard_facade_kwargs = shard_facade_kwargs if shard_facade_kwargs is not None else {}
+    self._clock_window_s = clock_window_s
+    self._metrics_period_s = metrics_period_s
+    self._status_timeout_s = status_timeout_s
+    self._metrics = DataQualityMetrics(keys=self._device_index)
+    self._stale_timeout = AdaptiveStaleTimeout(num_keys=len(self._device_index),
+                                               timesteps_before_stale=timesteps_before_stale,
+                                               quantile=stale_quantile,
+                                               min_timesteps=stale_bounds[0],
+                                               max_timesteps=stale_bounds[1]) if stale_quantile is not None else None
+    self._buffer = AlignedRingBuffer(keys=self._device_index,
+                                     timesteps_before_stale=timesteps_before_stale,
+                                     num_channels=None,
+                                     capacity=buffer_capacity,
+                                     dtype=IMU_PACKET_DTYPE,
+                                     metrics=self._metrics,
+                                     is_fifo=delivery != "latest",
+                                     max_gap_emitted=max_gap_emitted,
+                                     stale_timeout=self._stale_timeout)
+    self._processes: list[Any] = []
+    self._merge_thread: threading.Thread | None = None
+    self._clock = ShardClockAligner(num_shards=len(shards), sampling_rate_hz=sampling_rate_hz, window_s=clock_window_s)
+    self._is_more = False
+
+
+  def initialize(self) -> bool:
+    self._is_more = True
+    context = mp.get_context("spawn")
+    self._queue = context.Queue()
+    self._stop_event = context.Event()
+    self._clock = ShardClockAligner(num_shards=len(self._shards),
+                                    sampling_rate_hz=self._sampling_rate_hz,
+                                    window_s=self._clock_window_s)
+    self._pending: list[list[tuple[np.ndarray, np.ndarray]]] = [[] for _ in self._shards]
+    self._shard_status: list[bool | None] = [None] * len(self._shards)
+    self._is_shard_done = [False] * len(self._shards)
+    self._shard_metrics: list[dict[str, Any] | None] = [None] * len(self._shards)
+    self._is_merging = False
+    self._t_first_record_s: float | None = None
+    if movella_backend == "simulator":
+      import MovellaSimulator
+      simulator_settings = MovellaSimulator.get_settings()
+    else:
+      simulator_settings = None
+
+    self._processes = []
+    for shard_index, (shard, master_device, environment) in enumerate(zip(self._shards, self._master_devices, self._shard_environments)):
+      facade_kwargs = {**self._shard_facade_kwargs,
+                       "device_mapping": dict(shard),
+                       "master_device": master_device,
+                       "sampling_rate_hz": self._sampling_rate_hz,
+                       "is_get_orientation": self._is_get_orientation,
+                       "is_sync_devices": self._is_sync_devices,
+                       "is_trace_latency": False}
+      shard_simulator_settings = None
+      if simulator_settings is not None:
+        # Each worker simulates its own devices, with its own random draws.
+        shard_simulator_settings = {**simulator_settings,
+                                    "device_ids": list(shard.values()),
+                                    "seed": simulator_settings["seed"] + shard_index}
+      process = context.Process(target=_run_shard,
+                                name="dot_shard_%d"%shard_index,
+                                kwargs={"shard_index": shard_index,
+                                        "device_indices": [self._device_index[device_id] for device_id in shard.values()],
+                                        "facade_kwargs": facade_kwargs,
+                                        "simulator_settings": shard_simulator_settings,
+                                        "out_queue": self._queue,
+                                        "stop_event": self._stop_event,
+                                        "metrics_period_s": self._metrics_period_s},
+                                daemon=True)
+      with _environment(environment):
+        process.start()
+      self._processes.append(process)
+
+    # Records of shards streaming already are merged while waiting for the others.
+    t_deadline_s = perf_counter() + self._status_timeout_s if self._status_timeout_s is not None else np.inf
+    while None in self._shard_status and perf_counter() < t_deadline_s and self._receive():
+      pass
+    if not all(self._shard_status):
+      print("failed to start shards %s"%", ".join(str(i) for i, is_ok in enumerate(self._shard_status) if not is_ok), flush=True)
+      self._stop_shards()
+      return False
+
+    self._merge_thread = threading.Thread(target=self._merge, name="dot_shard_merge")
+    self._merge_thread.start()
+    return True
+
+
+  # Handles the next message of the workers, if any within `poll_period_s`, returns whether any worker is not done yet.
+  def _receive(self, poll_period_s: float = 1.0) -> bool:
+    try:
+      message = self._queue.get(timeout=poll_period_s)
+    except queue.Empty:
+      # A worker that died without reporting counts as failed and done.
+      for shard_index, process in enumerate(self._processes):
+        if not process.is_alive() and not self._is_shard_done[shard_index]:
+          self._shard_status[shard_index] = bool(self._shard_status[shard_index])
+          self._is_shard_done[shard_index] = True
+      return not all(self._is_shard_done)
+    kind, shard_index = message[:2]
+    if kind == "records":
+      self._merge_records(shard_index, *message[2:])
+    elif kind == "metrics":
+      self._shard_metrics[shard_index] = message[2]
+    elif kind == "status":
+      self._shard_status[shard_index] = message[2]
+    elif kind == "done":
+      self._is_shard_done[shard_index] = True
+    return not all(self._is_shard_done)
+
+
+  # At the start, records of every shard are held back until all are placed on the common timeline (for at most 3 windows),
+  #   then released interleaved by counter, so the first placed shard does not run ahead and make the others' records late.
+  def _merge_records(self, shard_index: int, records: np.ndarray, counters: np.ndarray) -> None:
+    self._clock.add(shard_index, records["toa_s"], counters)
+    self._pending[shard_index].append((records, counters))
+    offsets = self._clock.offsets
+    if not self._is_merging:
+      if self._t_first_record_s is None:
+        self._t_first_record_s = float(records["toa_s"][0])
+      if None in offsets and records["toa_s"][-1] - self._t_first_record_s < 3 * self._clock_window_s:
+        return
+      self._is_merging = True
+    batches = []
+    for i, offset in enumerate(offsets):
+      if offset is not None and self._pending[i]:
+        batches.extend((pending_records, pending_counters + offset) for pending_records, pending_counters in self._pending[i])
+        self._pending[i] = []
+    if len(batches) == 1:
+      records, counters = batches[0]
+    elif batches:
+      records = np.concatenate([batch_records for batch_records, _ in batches])
+      counters = np.concatenate([batch_counters for _, batch_counters in batches])
+      order = np.argsort(counters, kind="stable")
+      records, counters = records[order], counters[order]
+    else:
+      return
+    self._buffer.plop_array(key_indices=records["device"], data=records, counters=counters.tolist())
+
+
+  # Runs until every worker is done, then releases what is left in the buffer.
+  def _merge(self) -> None:
+    while self._receive():
+      pass
+    print("No more packets from the shards, flush buffers into the output Queue.")
+    self._buffer.flush()
+
+
+  # NOTE: keeps reading the queue until the workers are done, they can not exit with data left in its pipe.
+  def _stop_shards(self) -> None:
+    self._stop_event.set()
+    while self._receive():
+      pass
+    for process in self._processes:
+      process.join()
+    self._processes = []
+
+
+  # Oldest aligned snapshot as (counter, records of all devices, validity mask), None if timed out.
+  def get_snapshot(self) -> tuple[int, np.ndarray, np.ndarray] | None:
+    return self._buffer.yeet()
+
+
+  # Freshest aligned snapshot not returned yet, as (counter, records of all devices, validity mask, number of snapshots skipped).
+  def get_latest_snapshot(self) -> tuple[int, np.ndarray, np.ndarray, int] | None:
+    return self._buffer.yeet_latest()
+
+
+  # Latency is not traced across processes.
+  def trace_sent(self, snapshot: tuple[int, np.ndarray, np.ndarray]) -> None:
+    pass
+
+
+  def get_latency_summary(self) -> None:
+    return None
+
+
+  # Counter offset of each shard onto the common timeline, None for shards not placed yet.
+  def get_shard_offsets(self) -> list[int | None]:
+    return self._clock.offsets
+
+
+  # Same as `MovellaFacade.get_metrics`, with the shard-side counters of the latest report of each worker.
+  def get_metrics(self) -> dict[str, Any]:
+    snapshot = self._metrics.get_snapshot()
+    for shard_metrics in self._shard_metrics:
+      if shard_metrics is None:
+        continue
+      for device_id, values in shard_metrics["devices"].items():
+        snapshot["devices"][device_id].update({metric: values[metric] for metric in SHARD_METRICS})
+      for name, value in shard_metrics["totals"].items():
+        snapshot["totals"][name] = snapshot["totals"].get(name, 0) + value
+    if self._stale_timeout is not None:
+      snapshot["stale_timeout"] = self.get_stale_timeout()
+    return snapshot
+
+
+  # Same as `MovellaFacade.get_stale_timeout`.
+  def get_stale_timeout(self) -> dict[str, Any] | None:
+    if self._stale_timeout is None:
+      return None
+    tradeoff = self._stale_timeout.tradeoff()
+    return {
+      "timesteps_before_stale": tradeoff["timesteps_before_stale"],
+      "quantile": tradeoff["quantile"],
+      "max_wait_s": tradeoff["max_wait_timesteps"] / self._sampling_rate_hz,
+      "late_fractions": OrderedDict(zip(self._device_index, tradeoff["late_fractions"])),
+    }
+
+
+  def format_metrics(self) -> str:
+    return format_metrics(self.get_metrics())
+
+
+  # Stops the workers, they stop their DOTs and report what is left.
+  def cleanup(self) -> None:
+    self._is_more = False
+    if self._processes:
+      self._stop_event.set()
+
+
+  def close(self) -> None:
+    if self._merge_thread is not None:
+      self._merge_thread.join()
+      self._merge_thread = None
+    for process in self._processes:
+      process.join()
+    self._processes = []
@@ -0,0 +1,254 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import json
+import os
+import sys
+from multiprocessing import resource_tracker, shared_memory
+from time import perf_counter, sleep
+from typing import Iterable
+
+import numpy as np
+
+from datastructures import IMU_PACKET_DTYPE
+
+
+# Segment layout (native byte order, readers are on the same host):
+#   header (`SHM_HEADER_DTYPE`, 64 bytes) | JSON metadata padded with spaces to a multiple of 64 bytes
+#   | `capacity` frames (dtype from `shared_frame_dtype`), frame k of the session in slot k % capacity.
+#   Each frame is guarded by a sequence lock: its `sequence` is odd while the writer fills frame k (2k+1)
+#   and 2k+2 once it is complete, so a reader that sees the same even value before and after copying
+#   a frame got it intact, and one that sees a higher value knows it was lapped by the writer.
+SHM_MAGIC = b"MVDOTSHM"
+SHM_VERSION = 1
+_HEADER_ALIGNMENT = 64
+SHM_HEADER_DTYPE = np.dtype({
+  "names":    ["magic", "version", "num_devices", "capacity", "metadata_length", "num_published"],
+  "formats":  ["S8",    np.uint32, np.uint32,     np.uint32,  np.uint32,         np.uint64],
+  "offsets":  [0,       8,         12,            16,         20,                24],
+  "itemsize": _HEADER_ALIGNMENT,
+})
+
+
+# One frame per aligned snapshot, with the records of all devices in order of the device mapping.
+def shared_frame_dtype(num_devices: int) -> np.dtype:
+  return np.dtype([
+    ("sequence",        np.uint64),
+    ("counter",         np.int64),
+    ("publish_time_s",  np.float64), # NOTE: `perf_counter` of the writer, comparable across processes on Linux
+    ("is_valid",        np.bool_,         (num_devices,)),
+    ("records",         IMU_PACKET_DTYPE, (num_devices,)),
+  ], align=True)
+
+
+# Publishes aligned snapshots into a named shared-memory ring any number of local processes can read
+#   with `SharedSnapshotReader`, without the writer ever waiting on them. Readers that fall behind by more
+#   than `capacity` frames skip the overwritten ones and are told how many they missed.
+class SharedSnapshotWriter:
+  def __init__(self,
+               name: str, # NOTE: readers attach by this name, fails if a segment with it already exists
+               device_ids: Iterable[str],
+               sampling_rate_hz: int,
+               capacity: int = 256):
+    self._device_ids = list(device_ids)
+    metadata = json.dumps({
+      "version": SHM_VERSION,
+      "device_ids": self._device_ids,
+      "sampling_rate_hz": sampling_rate_hz,
+    }).encode("utf-8")
+    metadata_length = -(-len(metadata) // _HEADER_ALIGNMENT) * _HEADER_ALIGNMENT
+    frame_dtype = shared_frame_dtype(len(self._device_ids))
+    self._shm = shared_memory.SharedMemory(name=name,
+                                           create=True,
+                                           size=_HEADER_ALIGNMENT + metadata_length + capacity * frame_dtype.itemsize)
+    self._header = np.ndarray((), dtype=SHM_HEADER_DTYPE, buffer=self._shm.buf)
+    self._shm.buf[_HEADER_ALIGNMENT:_HEADER_ALIGNMENT + metadata_length] = metadata.ljust(metadata_length, b" ")
+    self._frames = np.ndarray(capacity, dtype=frame_dtype, buffer=self._shm.buf, offset=_HEADER_ALIGNMENT + metadata_length)
+    self._frames.fill(0)
+    self._capacity = capacity
+    self._num_published = 0
+    # Magic last, so a reader attaching meanwhile never sees a half-initialized header as valid.
+    self._header["version"] = SHM_VERSION
+    self._header["num_devices"] = len(self._device_ids)
+    self._header["capacity"] = capacity
+    self._header["metadata_length"] = metadata_length
+    self._header["num_published"] = 0
+    self._header["magic"] = SHM_MAGIC
+
+
+  @property
+  def name(self) -> str:
+    return self._shm.name
+
+
+  @property
+  def num_published(self) -> int:
+    return self._num_published
+
+
+  # Snapshot as returned by `MovellaFacade.get_snapshot`: counter, `IMU_PACKET_DTYPE` records and validity mask.
+  def publish(self, counter: int, records: np.ndarray, is_valid: np.ndarray) -> None:
+    frame = self._frames[self._num_published % self._capacity]
+    frame["sequence"] = 2 * self._num_published + 1
+    frame["counter"] = counter
+    frame["publish_time_s"] = perf_counter()
+    frame["is_valid"] = is_valid
+    frame["records"] = records
+    frame["sequence"] = 2 * self._num_published + 2
+    self._num_published += 1
+    self._header["num_published"] = self._num_published
+
+
+  # Removes the segment, readers still attached keep their mapping until they close it.
+  def close(self) -> None:
+    del self._header, self._frames
+    self._shm.close()
+    self._shm.unlink()
+
+
+# Attaches to the ring of a `SharedSnapshotWriter` by name. Each reader keeps its own position,
+#   so one can drain every frame with `read_next` while another only polls `read_latest`.
+#   NOTE: with `copy=False` the arrays are views into shared memory, check `is_intact` after using them,
+#     since the writer may overwrite the frame at any time.
+class SharedSnapshotReader:
+  def __init__(self,
+               name: str,
+               poll_period_s: float = 0.0005): # NOTE: sleep between checks for new frames while waiting in `read_next`
+    # The writer owns the segment, keep the resource tracker of this process from unlinking it on exit.
+    if sys.version_info >= (3, 13):
+      self._shm = shared_memory.SharedMemory(name=name, create=False, track=False)
+    else:
+      self._shm = shared_memory.SharedMemory(name=name, create=False)
+      # NOTE: readers started by the writer's process share its tracker, which then warns of an unknown name on unlink, harmlessly.
+      if os.name == "posix":
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+    self._header = np.ndarray((), dtype=SHM_HEADER_DTYPE, buffer=self._shm.buf)
+    if self._header["magic"] != SHM_MAGIC:
+      self.close()
+      raise ValueError("%s is not a snapshot ring or is not initialized yet."%name)
+    if self._header["version"] != SHM_VERSION:
+      version = int(self._header["version"])
+      self.close()
+      raise ValueError("Unsupported snapshot ring version %d."%version)
+    metadata_length = int(self._header["metadata_length"])
+    self._metadata = json.loads(bytes(self._shm.buf[_HEADER_ALIGNMENT:_HEADER_ALIGNMENT + metadata_length]))
+    self._capacity = int(self._header["capacity"])
+    self._frames = np.ndarray(self._capacity,
+                              dtype=shared_frame_dtype(int(self._header["num_devices"])),
+                              buffer=self._shm.buf,
+                              offset=_HEADER_ALIGNMENT + metadata_length)
+    self._poll_period_s = poll_period_s
+    # Start from the oldest frame still safe to read.
+    self._next = max(0, int(self._header["num_published"]) - self._capacity + 1)
+    self._last_sequence: tuple[int, int] | None = None
+    self._num_lapped = 0
+
+
+  @property
+  def device_ids(self) -> list[str]:
+    return self._metadata["device_ids"]
+
+
+  @property
+  def sampling_rate_hz(self) -> int:
+    return self._metadata["sampling_rate_hz"]
+
+
+  # Frames this reader missed so far because the writer overwrote them before they were read.
+  @property
+  def num_lapped(self) -> int:
+    return self._num_lapped
+
+
+  # Oldest unread frame, waiting up to `timeout` for one, with the number of frames skipped because
+  #   the writer lapped this reader since the previous call. None on timeout.
+  def read_next(self, timeout: float = 0.0, copy: bool = True) -> tuple[int, np.ndarray, np.ndarray, int] | None:
+    t_end_s = perf_counter() + timeout
+    num_missed = 0
+    while True:
+      num_published = int(self._header["num_published"])
+      if self._next >= num_published:
+        if perf_counter() >= t_end_s:
+          return None
+        sleep(self._poll_period_s)
+        continue
+      # The slot of frame `num_published` may be in the middle of being rewritten, stay one frame clear of it.
+      oldest = num_published - self._capacity + 1
+      if self._next < oldest:
+        num_missed += oldest - self._next
+        self._next = oldest
+      frame = self._read_frame(self._next, copy)
+      if frame is not None:
+        self._next += 1
+        if num_missed:
+          self._num_lapped += num_missed
+        return (*frame, num_missed)
+
+
+  # Freshest complete frame, with the number of frames published since the previous read that it skipped,
+  #   None if none has been published since.
+  def read_latest(self, copy: bool = True) -> tuple[int, np.ndarray, np.ndarray, int] | None:
+    while True:
+      num_published = int(self._header["num_published"])
+      if self._next >= num_published:
+        return None
+      frame = self._read_frame(num_published - 1, copy)
+      if frame is not None:
+        num_skipped = num_published - 1 - self._next
+        self._next = num_published
+        return (*frame, num_skipped)
+
+
+  # Whether the frame last returned was not overwritten since, to validate `copy=False` views after use.
+  def is_intact(self) -> bool:
+    if self._last_sequence is None:
+      return False
+    slot, sequence = self._last_sequence
+    return int(self._frames[slot]["sequence"]) == sequence
+
+
+  # Counter, records and validity of frame `index`, None if the writer got to its slot before or during the read.
+  def _read_frame(self, index: int, copy: bool) -> tuple[int, np.ndarray, np.ndarray] | None:
+    slot = index % self._capacity
+    sequence = 2 * index + 2
+    frame = self._frames[slot]
+    if int(frame["sequence"]) != sequence:
+      return None
+    counter = int(frame["counter"])
+    records = frame["records"].copy() if copy else frame["records"]
+    is_valid = frame["is_valid"].copy() if copy else frame["is_valid"]
+    if int(frame["sequence"]) != sequence:
+      return None
+    self._last_sequence = (slot, sequence)
+    return counter, records, is_valid
+
+
+  # NOTE: views returned with `copy=False` must be released before, or the mapping can not be closed.
+  def close(self) -> None:
+    self._header = None
+    self._frames = None
+    self._shm.close()
@@ -0,0 +1,116 @@
+import os
+from time import perf_counter
+
+import numpy as np
+import pytest
+
+# Before `user_settings` is first imported, it picks the backend.
+os.environ["MOVELLA_BACKEND"] = "simulator"
+
+import MovellaSimulator
+from MovellaHandler import DOT_TICKS_PER_S, MovellaFacade
+
+
+_DEVICE_IDS = ["D%d"%i for i in range(4)]
+_SAMPLING_RATE_HZ = 60
+
+
+@pytest.fixture
+def simulator():
+  yield MovellaSimulator
+  MovellaSimulator.reset()
+
+
+def _facade(**kwargs) -> MovellaFacade:
+  return MovellaFacade(device_mapping={"joint%d"%i: device_id for i, device_id in enumerate(_DEVICE_IDS)},
+                       master_device="joint0",
+                       sampling_rate_hz=_SAMPLING_RATE_HZ,
+                       is_get_orientation=False,
+                       is_sync_devices=True,
+                       timesteps_before_stale=10,
+                       discovery_timeout_s=10.0,
+                       **kwargs)
+
+
+def _collect(facade: MovellaFacade, duration_s: float) -> list[tuple[int, np.ndarray, np.ndarray]]:
+  snapshots = []
+  t_end_s = perf_counter() + duration_s
+  while perf_counter() < t_end_s:
+    snapshot = facade.get_snapshot()
+    if snapshot is not None:
+      counter, records, is_valid = snapshot
+      snapshots.append((counter, records.copy(), is_valid.copy()))
+  return snapshots
+
+
+# Synced devices starting just before the 32-bit wraparound of `sampleTimeFine`, with jitter, bursts and drops:
+#   every timestep comes out once, in order, with the samples of one timestep within one sampling period.
+def test_facade_aligns_synced_simulated_devices_across_wraparound(simulator):
+  simulator.configure(device_ids=_DEVICE_IDS,
+                      seed=3,
+                      speed=4.0,
+                      start_ticks=2**32 - 2 * DOT_TICKS_PER_S,
+                      burst_probability=0.002,
+                      drop_probability=0.01)
+  facade = _facade()
+  try:
+    assert facade.initialize()
+    snapshots = _collect(facade, duration_s=2.5)
+  finally:
+    facade.cleanup()
+    facade.close()
+  counters = [counter for counter, _, _ in snapshots]
+  assert len(counters) > 5 * _SAMPLING_RATE_HZ
+  assert counters == list(range(counters[0], counters[0] + len(counters)))
+  timestamps = np.array([records["timestamp_fine"] for _, records, _ in snapshots], dtype=np.int64)
+  is_valid = np.array([is_valid for _, _, is_valid in snapshots])
+  assert timestamps[is_valid].max() > 2**32 - DOT_TICKS_PER_S and timestamps[is_valid].min() < DOT_TICKS_PER_S
+  assert 0.95 < is_valid.mean() < 1.0
+  for row_timestamps, row_is_valid in zip(timestamps, is_valid):
+    valid_timestamps = row_timestamps[row_is_valid]
+    spread = ((valid_timestamps - valid_timestamps[0] + 2**31) % 2**32) - 2**31
+    assert len(spread) == 0 or spread.max() - spread.min() < DOT_TICKS_PER_S / _SAMPLING_RATE_HZ
+  metrics = facade.get_metrics()["devices"]
+  assert all(device["received"] > 0 for device in metrics.values())
+
+
+# Devices dropping out mid-session are scanned for and reconnected by the supervisor, while the others keep streaming.
+def test_facade_reconnects_devices_lost_while_streaming(simulator):
+  simulator.configure(device_ids=_DEVICE_IDS,
+                      seed=5,
+                      speed=4.0,
+                      disconnect_rate_hz=0.5,
+                      reconnect_delay_s=0.5)
+  facade = _facade(is_reconnect=True)
+  try:
+    assert facade.initialize()
+    snapshots = _collect(facade, duration_s=3.0)
+    metrics = facade.get_metrics()["devices"]
+  finally:
+    facade.cleanup()
+    facade.close()
+  counters = [counter for counter, _, _ in snapshots]
+  assert counters == list(range(counters[0], counters[0] + len(counters)))
+  assert sum(device["disconnects"] for device in metrics.values()) > 0
+  assert sum(device["reconnects"] for device in metrics.values()) > 0
+
+
+# Packets with empty data vectors are counted and dropped in the SDK callback, their timesteps padded like lost ones.
+def test_facade_rejects_empty_packets(simulator):
+  simulator.configure(device_ids=_DEVICE_IDS,
+                      seed=7,
+                      speed=4.0,
+                      empty_probability=0.05)
+  facade = _facade()
+  try:
+    assert facade.initialize()
+    snapshots = _collect(facade, duration_s=1.5)
+    metrics = facade.get_metrics()["devices"]
+  finally:
+    facade.cleanup()
+    facade.close()
+  is_valid = np.array([is_valid for _, _, is_valid in snapshots])
+  assert 0.85 < is_valid.mean() < 1.0
+  assert all(device["rejected"] > 0 for device in metrics.values())
+  for _, records, row_is_valid in snapshots:
+    assert np.isfinite(records["acc"][row_is_valid]).all()
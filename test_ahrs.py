@@ -0,0 +1,98 @@
+import numpy as np
+
+from ahrs import MahonyAHRS
+
+
+_SAMPLING_RATE_HZ = 60
+_GRAVITY = np.array([0.0, 0.0, 9.81])
+# Earth field pointing north (x) and down at about 65 degrees inclination, in a.u.
+_MAGNETIC_FIELD = np.array([0.42, 0.0, -0.9])
+
+
+def _multiply(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+  p0, p1, p2, p3 = p.T
+  q0, q1, q2, q3 = q.T
+  return np.stack([p0*q0 - p1*q1 - p2*q2 - p3*q3,
+                   p0*q1 + p1*q0 + p2*q3 - p3*q2,
+                   p0*q2 - p1*q3 + p2*q0 + p3*q1,
+                   p0*q3 + p1*q2 - p2*q1 + p3*q0], axis=1)
+
+
+# Earth-frame vector `v` seen in the sensor frame of each orientation (N, 4).
+def _to_sensor(q: np.ndarray, v: np.ndarray) -> np.ndarray:
+  conjugate = q * np.array([1.0, -1.0, -1.0, -1.0])
+  return _multiply(_multiply(conjugate, np.broadcast_to(np.r_[0.0, v], q.shape)), q)[:, 1:]
+
+
+def _angle_deg(p: np.ndarray, q: np.ndarray) -> np.ndarray:
+  return np.degrees(2 * np.arccos(np.minimum(np.abs(np.einsum("ij,ij->i", p, q)), 1.0)))
+
+
+# Trackers starting at random orientations and turning at constant rates about random sensor axes,
+#   with the measurements each would report: acc and mag in the sensor frame, gyr in deg/s plus `gyr_bias_deg_s`.
+def _motion(num_trackers: int, num_samples: int, gyr_bias_deg_s: float = 0.0, seed: int = 0):
+  rng = np.random.default_rng(seed)
+  q = rng.normal(size=(num_trackers, 4))
+  q /= np.linalg.norm(q, axis=1, keepdims=True)
+  rates = rng.normal(size=(num_trackers, 3)) * 20.0
+  dt_s = 1 / _SAMPLING_RATE_HZ
+  for _ in range(num_samples):
+    yield q, _to_sensor(q, _GRAVITY), rates + gyr_bias_deg_s, _to_sensor(q, _MAGNETIC_FIELD)
+    half_angles = np.radians(rates) * dt_s / 2
+    norms = np.linalg.norm(half_angles, axis=1, keepdims=True)
+    step = np.hstack([np.cos(norms), np.sin(norms) * half_angles / norms])
+    q = _multiply(q, step)
+
+
+def test_first_reading_sets_the_orientation_from_acc_and_mag():
+  ahrs = MahonyAHRS(num_trackers=8, sampling_rate_hz=_SAMPLING_RATE_HZ)
+  q, acc, gyr, mag = next(_motion(8, 1))
+  estimate = ahrs.update(counter=0, acc=acc, gyr=gyr, mag=mag, is_valid=np.ones(8, dtype=bool))
+  assert (_angle_deg(estimate, q) < 0.1).all()
+
+
+def test_tracks_rotating_trackers_and_outputs_nan_for_missing_ones():
+  ahrs = MahonyAHRS(num_trackers=6, sampling_rate_hz=_SAMPLING_RATE_HZ)
+  is_valid = np.ones(6, dtype=bool)
+  for counter, (q, acc, gyr, mag) in enumerate(_motion(6, 30 * _SAMPLING_RATE_HZ)):
+    # Tracker 5 drops every third snapshot.
+    is_valid[5] = counter % 3 != 0
+    estimate = ahrs.update(counter=counter, acc=acc, gyr=gyr, mag=mag, is_valid=is_valid)
+    if counter % 3 == 0:
+      assert np.isnan(estimate[5]).all()
+  # Euler integration of the gyroscope lags a little behind fast turns, more so over the doubled steps of tracker 5.
+  errors_deg = _angle_deg(estimate.astype(np.float64), q)
+  assert (errors_deg[:5] < 0.5).all() and errors_deg[5] < 2.0
+
+
+def test_integral_gain_compensates_a_gyroscope_bias():
+  errors_deg = {}
+  for ki in [0.0, 0.1]:
+    ahrs = MahonyAHRS(num_trackers=4, sampling_rate_hz=_SAMPLING_RATE_HZ, kp=0.5, ki=ki)
+    for counter, (q, acc, gyr, mag) in enumerate(_motion(4, 30 * _SAMPLING_RATE_HZ, gyr_bias_deg_s=2.0)):
+      estimate = ahrs.update(counter=counter, acc=acc, gyr=gyr, mag=mag, is_valid=np.ones(4, dtype=bool))
+    errors_deg[ki] = _angle_deg(estimate.astype(np.float64), q).max()
+  assert errors_deg[0.1] < 1.0 and errors_deg[0.0] > 3.0
+
+
+def test_heading_is_set_once_the_magnetometer_shows_up():
+  ahrs = MahonyAHRS(num_trackers=3, sampling_rate_hz=_SAMPLING_RATE_HZ)
+  motion = _motion(3, 2)
+  q, acc, gyr, mag = next(motion)
+  estimate = ahrs.update(counter=0, acc=acc, gyr=gyr, mag=np.zeros_like(mag), is_valid=np.ones(3, dtype=bool))
+  # Tilt is right without the magnetometer, heading is arbitrary.
+  np.testing.assert_allclose(_to_sensor(estimate.astype(np.float64), _GRAVITY), acc, atol=1e-3)
+  q, acc, gyr, mag = next(motion)
+  estimate = ahrs.update(counter=1, acc=acc, gyr=gyr, mag=mag, is_valid=np.ones(3, dtype=bool))
+  assert (_angle_deg(estimate.astype(np.float64), q) < 0.1).all()
+
+
+def test_reinitializes_after_a_gap_longer_than_max_gap_s():
+  ahrs = MahonyAHRS(num_trackers=2, sampling_rate_hz=_SAMPLING_RATE_HZ, max_gap_s=1.0)
+  motion = list(_motion(2, 3 * _SAMPLING_RATE_HZ))
+  q, acc, gyr, mag = motion[0]
+  ahrs.update(counter=0, acc=acc, gyr=gyr, mag=mag, is_valid=np.ones(2, dtype=bool))
+  # Two seconds later: integrating the gyroscope over the gap would be meaningless, the orientation is set anew.
+  q, acc, gyr, mag = motion[-1]
+  estimate = ahrs.update(counter=len(motion) - 1, acc=acc, gyr=gyr, mag=mag, is_valid=np.ones(2, dtype=bool))
+  assert (_angle_deg(estimate.astype(np.float64), q) < 0.1).all()
@@ -0,0 +1,20 @@
+import json
+
+from benchmark import SCENARIOS, compare, scenario_result
+
+
+def _results(snapshots_per_s: float) -> dict:
+  workload = SCENARIOS[1] # NOTE: has tuple fields, which JSON turns into lists
+  benchmarks = {"payload_float32": {"snapshots_per_s": snapshots_per_s, "cpu_us_per_snapshot": 1e6 / snapshots_per_s, "num_late": 0}}
+  return {"scenarios": [scenario_result(workload, 1000, benchmarks)]}
+
+
+def test_compare_after_json_round_trip_flags_regression():
+  baseline = json.loads(json.dumps(_results(12142.0)))
+  regressions = compare(baseline, _results(6706.0), tolerance=0.2)
+  assert {metric for _, _, metric, _, _ in regressions} == {"snapshots_per_s", "cpu_us_per_snapshot"}
+
+
+def test_compare_after_json_round_trip_without_change():
+  baseline = json.loads(json.dumps(_results(12142.0)))
+  assert compare(baseline, json.loads(json.dumps(_results(12000.0))), tolerance=0.2) == []
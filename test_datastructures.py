@@ -0,0 +1,240 @@
+import numpy as np
+
+from datastructures import AdaptiveStaleTimeout, AlignedFifoBuffer, AlignedRingBuffer, TimestampToCounterConverter
+from metrics import DataQualityMetrics
+
+
+_SAMPLING_PERIOD = 167 # NOTE: 60 Hz in `sampleTimeFine` ticks
+_TIMESTAMP_LIMIT = 2**32
+
+
+# Interleaved streams of `num_keys` devices starting close to the 32-bit wraparound, with per-device offsets,
+#   jitter of a few ticks, dropped samples and a device that starts before the first sample of the others (stale first readings).
+def _stream(num_keys: int = 5, num_samples: int = 2000, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+  rng = np.random.default_rng(seed)
+  start = _TIMESTAMP_LIMIT - 400 * _SAMPLING_PERIOD
+  key_indices, timestamps = [], []
+  for sample in range(num_samples):
+    order = rng.permutation(num_keys)
+    if sample < 3:
+      order = np.r_[order[order != num_keys - 1], num_keys - 1]
+    for key_index in order:
+      if rng.random() < 0.05 and sample > 0:
+        continue
+      offset = -3 * _SAMPLING_PERIOD if key_index == num_keys - 1 and sample < 3 else 0
+      key_indices.append(key_index)
+      timestamps.append((start + sample * _SAMPLING_PERIOD + offset + int(rng.integers(-20, 21))) % _TIMESTAMP_LIMIT)
+  return np.array(key_indices), np.array(timestamps, dtype=np.int64)
+
+
+def _scalar_counters(keys: list, key_indices: np.ndarray, timestamps: np.ndarray) -> list[int]:
+  converter = TimestampToCounterConverter(keys=keys, sampling_period=_SAMPLING_PERIOD, num_bits_timestamp=32)
+  counters = [converter.counter_from_timestamp(keys[key_index], timestamp) for key_index, timestamp in zip(key_indices.tolist(), timestamps.tolist())]
+  return [-1 if counter is None else counter for counter in counters]
+
+
+def test_vectorized_counters_match_scalar_across_wraparound():
+  keys = ["D%d"%i for i in range(5)]
+  key_indices, timestamps = _stream()
+  assert (timestamps < 1000 * _SAMPLING_PERIOD).any() and (timestamps > _TIMESTAMP_LIMIT - 1000 * _SAMPLING_PERIOD).any()
+  converter = TimestampToCounterConverter(keys=keys, sampling_period=_SAMPLING_PERIOD, num_bits_timestamp=32)
+  counters = converter.counters_from_timestamps(key_indices=key_indices, timestamps=timestamps)
+  assert -1 in counters.tolist()
+  assert counters.tolist() == _scalar_counters(keys, key_indices, timestamps)
+
+
+def test_vectorized_and_scalar_conversion_can_be_mixed():
+  keys = ["D%d"%i for i in range(5)]
+  key_indices, timestamps = _stream(seed=1)
+  converter = TimestampToCounterConverter(keys=keys, sampling_period=_SAMPLING_PERIOD, num_bits_timestamp=32)
+  counters = []
+  for start in range(0, len(timestamps), 300):
+    batch = slice(start, start + 300)
+    if start % 600:
+      counters.extend(converter.counter_from_timestamp(keys[key_index], timestamp)
+                      for key_index, timestamp in zip(key_indices[batch].tolist(), timestamps[batch].tolist()))
+    else:
+      counters.extend(None if counter < 0 else counter
+                      for counter in converter.counters_from_timestamps(key_indices[batch], timestamps[batch]).tolist())
+  assert [-1 if counter is None else counter for counter in counters] == _scalar_counters(keys, key_indices, timestamps)
+
+
+def test_batch_counters_match_scalar_for_any_burst_size():
+  keys = ["D%d"%i for i in range(5)]
+  key_indices, timestamps = _stream(seed=2)
+  converter = TimestampToCounterConverter(keys=keys, sampling_period=_SAMPLING_PERIOD, num_bits_timestamp=32)
+  counters, start = [], 0
+  for size in [1, 2, 3, 700, 5, 300, 1, 4000]:
+    counters.extend(converter.counters_from_batch(key_indices[start:start+size], timestamps[start:start+size]))
+    start += size
+  assert [-1 if counter is None else counter for counter in counters] == _scalar_counters(keys, key_indices, timestamps)[:start]
+
+
+def _ring(capacity: int = 16, timesteps_before_stale: int = 4, max_gap_emitted: int | None = None) -> AlignedRingBuffer:
+  keys = ["A", "B", "C"]
+  return AlignedRingBuffer(keys=keys,
+                           timesteps_before_stale=timesteps_before_stale,
+                           num_channels=2,
+                           capacity=capacity,
+                           metrics=DataQualityMetrics(keys, log_period_s=float("inf")),
+                           max_gap_emitted=max_gap_emitted)
+
+
+def _yeet_all(buffer: AlignedRingBuffer) -> list[tuple[int, np.ndarray, np.ndarray]]:
+  snapshots = []
+  while (snapshot := buffer.yeet(timeout=0)) is not None:
+    snapshots.append(snapshot)
+  return snapshots
+
+
+def _count(buffer: AlignedRingBuffer, metric: str) -> list[int]:
+  return [device[metric] for device in buffer.metrics.get_snapshot()["devices"].values()]
+
+
+def test_ring_emits_complete_rows_in_order():
+  buffer = _ring()
+  for counter in range(5):
+    for key in ["C", "A", "B"]:
+      buffer.plop(key=key, data=[counter, ord(key)], counter=counter)
+  snapshots = _yeet_all(buffer)
+  assert [counter for counter, _, _ in snapshots] == list(range(5))
+  for counter, data, is_valid in snapshots:
+    assert is_valid.all()
+    assert data.tolist() == [[counter, ord("A")], [counter, ord("B")], [counter, ord("C")]]
+  assert _count(buffer, "padded") == [0, 0, 0]
+
+
+def test_ring_releases_rows_of_a_missing_key_once_stale():
+  buffer = _ring(timesteps_before_stale=4)
+  for counter in range(3):
+    buffer.plop(key="A", data=[counter, 0], counter=counter)
+    buffer.plop(key="B", data=[counter, 0], counter=counter)
+  assert _yeet_all(buffer) == []
+  buffer.plop(key="A", data=[3, 0], counter=3)
+  snapshots = _yeet_all(buffer)
+  assert [counter for counter, _, _ in snapshots] == [0]
+  assert snapshots[0][2].tolist() == [True, True, False]
+  assert _count(buffer, "stale_emits") == [0, 0, 1]
+  # The missing key shows up too late for the released row.
+  buffer.plop(key="C", data=[0, 0], counter=0)
+  assert _count(buffer, "late") == [0, 0, 1]
+  buffer.flush()
+  assert [counter for counter, _, _ in _yeet_all(buffer)] == [1, 2, 3]
+
+
+def test_ring_reads_a_short_gap_as_rows_without_data():
+  buffer = _ring(timesteps_before_stale=4)
+  for key in ["A", "B", "C"]:
+    buffer.plop(key=key, data=[0, 0], counter=0)
+  buffer.plop(key="A", data=[10, 0], counter=10)
+  snapshots = _yeet_all(buffer)
+  assert [counter for counter, _, _ in snapshots] == list(range(8))
+  assert all(not is_valid.any() for _, _, is_valid in snapshots[1:])
+  assert _count(buffer, "padded") == [7, 7, 7]
+
+
+def test_ring_reader_jumps_over_gaps_longer_than_max_gap_emitted():
+  buffer = _ring(timesteps_before_stale=4, max_gap_emitted=3)
+  for key in ["A", "B", "C"]:
+    buffer.plop(key=key, data=[0, 0], counter=0)
+  for key in ["A", "B", "C"]:
+    buffer.plop(key=key, data=[100, 0], counter=100)
+  snapshots = _yeet_all(buffer)
+  # Only the rows within `timesteps_before_stale` of the new sample are left to read, without data.
+  assert [counter for counter, _, _ in snapshots] == [0, 98, 99, 100]
+  assert [is_valid.all() for _, _, is_valid in snapshots] == [True, False, False, True]
+  assert buffer.metrics.get_snapshot()["totals"]["skipped_timesteps"] == 97
+
+
+def test_ring_overwrites_the_oldest_unread_rows_when_the_reader_lags():
+  buffer = _ring(capacity=8)
+  for counter in range(20):
+    for key in ["A", "B", "C"]:
+      buffer.plop(key=key, data=[counter, 0], counter=counter)
+  snapshots = _yeet_all(buffer)
+  assert [counter for counter, _, _ in snapshots] == list(range(12, 20))
+  assert [int(data[0, 0]) for _, data, _ in snapshots] == list(range(12, 20))
+
+
+def test_stale_timeout_covers_the_quantile_of_the_slowest_key():
+  rng = np.random.default_rng(0)
+  stale_timeout = AdaptiveStaleTimeout(num_keys=3, timesteps_before_stale=2, quantile=0.99, max_timesteps=32, update_period=16)
+  for _ in range(3000):
+    stale_timeout.add(0, int(rng.integers(0, 2)))
+    stale_timeout.add(1, int(rng.integers(0, 3)))
+    # Key 2 is mostly on time, but 5% of its packets come 6 timesteps late.
+    stale_timeout.add(2, 6 if rng.random() < 0.05 else 0)
+  # A snapshot waits for lags up to `timesteps_before_stale` - 2.
+  assert stale_timeout.timesteps_before_stale == 8
+  assert stale_timeout.tradeoff()["late_fractions"] == [0.0, 0.0, 0.0]
+
+
+def test_stale_timeout_follows_changing_lags_within_bounds():
+  stale_timeout = AdaptiveStaleTimeout(num_keys=1, timesteps_before_stale=50, min_timesteps=3, max_timesteps=20, half_life=200, update_period=8)
+  assert stale_timeout.timesteps_before_stale == 20
+  for _ in range(2000):
+    stale_timeout.add(0, 0)
+  assert stale_timeout.timesteps_before_stale == 3
+  for _ in range(2000):
+    stale_timeout.add(0, 40)
+  assert stale_timeout.timesteps_before_stale == 20
+  # Lags beyond the bound are late however long a snapshot would wait.
+  assert stale_timeout.tradeoff()["late_fractions"][0] > 0.99
+
+
+# Key C delivers every packet 5 timesteps after the others, more than the initial timeout waits for.
+def test_ring_stops_dropping_late_packets_once_the_timeout_adapted():
+  keys = ["A", "B", "C"]
+  stale_timeout = AdaptiveStaleTimeout(num_keys=3, timesteps_before_stale=2, max_timesteps=32, half_life=100, update_period=8)
+  buffer = AlignedRingBuffer(keys=keys,
+                             timesteps_before_stale=2,
+                             num_channels=2,
+                             capacity=64,
+                             metrics=DataQualityMetrics(keys, log_period_s=float("inf")),
+                             stale_timeout=stale_timeout)
+  snapshots = []
+  for counter in range(1000):
+    buffer.plop(key="A", data=[counter, 0], counter=counter)
+    buffer.plop(key="B", data=[counter, 0], counter=counter)
+    if counter >= 5:
+      buffer.plop(key="C", data=[counter - 5, 0], counter=counter - 5)
+    snapshots.extend(_yeet_all(buffer))
+  num_late = _count(buffer, "late")[2]
+  assert 0 < num_late < 50
+  assert stale_timeout.timesteps_before_stale >= 7
+  assert [counter for counter, _, _ in snapshots] == list(range(len(snapshots)))
+  assert all(is_valid.all() for _, _, is_valid in snapshots[100:])
+
+
+def _fifo(max_gap_emitted: int | None = None) -> AlignedFifoBuffer:
+  keys = ["A", "B", "C"]
+  return AlignedFifoBuffer(keys=keys,
+                           timesteps_before_stale=4,
+                           metrics=DataQualityMetrics(keys, log_period_s=float("inf")),
+                           max_gap_emitted=max_gap_emitted)
+
+
+# A counter jump of a million timesteps is queued as a few entries, the reader still gets one all-None snapshot per timestep.
+def test_fifo_queues_a_long_gap_in_constant_memory():
+  buffer = _fifo()
+  for counter in [0, 10**6 + 1]:
+    for key in ["A", "B", "C"]:
+      buffer.plop(key=key, data={"value": counter}, counter=counter)
+  buffer.flush()
+  assert len(buffer._output_queue) <= 4
+  snapshots = []
+  while (snapshot := buffer.yeet(timeout=0)) is not None:
+    snapshots.append(snapshot)
+  assert len(snapshots) == 10**6 + 2
+  assert [snapshot["A"]["counter"] for snapshot in [snapshots[0], snapshots[-1]]] == [0, 10**6 + 1]
+  assert all(snapshot == {"A": None, "B": None, "C": None} for snapshot in snapshots[1:-1])
+  assert buffer.metrics.get_snapshot()["devices"]["A"]["padded"] == 10**6
+
+
+def test_fifo_latest_of_a_gap_is_an_empty_snapshot():
+  buffer = _fifo()
+  for key in ["A", "B", "C"]:
+    buffer.plop(key=key, data={"value": 0}, counter=0)
+  buffer.plop(key="A", data={"value": 10}, counter=10)
+  latest, num_skipped = buffer.yeet_latest(timeout=0)
+  assert latest == {"A": None, "B": None, "C": None} and num_skipped == 7
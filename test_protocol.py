@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from protocol import (ENCODING_FLOAT16, ENCODING_FLOAT32, ENCODING_INT16, ENCODING_SMALLEST_THREE, INT16_FULL_SCALE,
+                      WIRE_FORMAT_LEGACY, WIRE_FORMAT_V1, PacketLayout, decode, encode_quaternions, encode_sensors,
+                      is_valid_from_mask, pack_header, validity_mask)
+
+
+_NUM_TRACKERS = 5
+
+
+def _snapshot(seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+  rng = np.random.default_rng(seed)
+  sensors = (rng.uniform(-1.0, 1.0, size=(3, _NUM_TRACKERS, 3)) * INT16_FULL_SCALE * 0.9).astype(np.float32)
+  quaternions = rng.normal(size=(_NUM_TRACKERS, 4)).astype(np.float32)
+  quaternions /= np.linalg.norm(quaternions, axis=-1, keepdims=True)
+  sample_time_fine = rng.integers(0, 2**32, size=_NUM_TRACKERS, dtype=np.uint32)
+  is_valid = np.array([True, False, True, True, False])
+  sensors[:, ~is_valid] = np.nan
+  quaternions[~is_valid] = np.nan
+  return sensors, quaternions, sample_time_fine, is_valid
+
+
+def _packet(layout: PacketLayout, sensors: np.ndarray, quaternions: np.ndarray, sample_time_fine: np.ndarray, is_valid: np.ndarray) -> bytearray:
+  buffer = bytearray(layout.size)
+  if layout.wire_format == WIRE_FORMAT_V1:
+    pack_header(buffer, layout, sequence=2**32 + 7, counter=42, valid_mask=validity_mask(is_valid), send_time_s=1.5)
+  if layout.is_sample_time_fine:
+    layout.sample_time_fine(buffer)[:] = sample_time_fine
+  encode_sensors(sensors, layout.sensors(buffer), layout.encoding)
+  if layout.quaternion_encoding is not None:
+    encode_quaternions(quaternions, layout.quaternions(buffer), layout.quaternion_encoding)
+  return buffer
+
+
+@pytest.mark.parametrize("encoding, quaternion_encoding, tolerance, quaternion_tolerance", [
+  (ENCODING_FLOAT32, ENCODING_FLOAT32, 0.0, 0.0),
+  (ENCODING_FLOAT16, ENCODING_FLOAT16, 1e-3, 1e-3),
+  (ENCODING_INT16, ENCODING_INT16, 0.5 / 32767, 0.5 / 32767),
+  (ENCODING_INT16, ENCODING_SMALLEST_THREE, 0.5 / 32767, 2e-3),
+])
+def test_v1_round_trip(encoding, quaternion_encoding, tolerance, quaternion_tolerance):
+  sensors, quaternions, sample_time_fine, is_valid = _snapshot()
+  layout = PacketLayout(num_trackers=_NUM_TRACKERS, encoding=encoding, quaternion_encoding=quaternion_encoding)
+  header, decoded_sensors, decoded_sample_time_fine, decoded_quaternions = decode(bytes(_packet(layout, sensors, quaternions, sample_time_fine, is_valid)),
+                                                                                  WIRE_FORMAT_V1, _NUM_TRACKERS)
+  assert (header.sequence, header.counter, header.send_time_s) == (7, 42, 1.5)
+  assert is_valid_from_mask(header.valid_mask, _NUM_TRACKERS).tolist() == is_valid.tolist()
+  assert decoded_sample_time_fine.tolist() == sample_time_fine.tolist()
+  # Missing trackers decode to NaN, valid ones within the quantization step of the encoding (relative to full scale for int16).
+  assert np.isnan(decoded_sensors[:, ~is_valid]).all() and np.isnan(decoded_quaternions[~is_valid]).all()
+  scale = np.broadcast_to(INT16_FULL_SCALE, sensors.shape) if encoding == ENCODING_INT16 else np.abs(sensors)
+  assert (np.abs(decoded_sensors - sensors)[:, is_valid] <= (tolerance * scale)[:, is_valid] * 1.01 + 1e-6).all()
+  # q and -q are the same rotation, "smallest_three" may flip the sign.
+  error = np.minimum(np.abs(decoded_quaternions - quaternions), np.abs(decoded_quaternions + quaternions)) if quaternion_encoding == ENCODING_SMALLEST_THREE \
+          else np.abs(decoded_quaternions - quaternions)
+  assert (error[is_valid] <= quaternion_tolerance + 1e-6).all()
+
+
+def test_int16_clips_out_of_range_values_to_full_scale():
+  sensors, quaternions, sample_time_fine, is_valid = _snapshot()
+  sensors[0, 0, 0] = 10 * INT16_FULL_SCALE[0, 0, 0]
+  layout = PacketLayout(num_trackers=_NUM_TRACKERS, encoding=ENCODING_INT16)
+  _, decoded_sensors, _, _ = decode(_packet(layout, sensors, quaternions, sample_time_fine, is_valid), WIRE_FORMAT_V1, _NUM_TRACKERS)
+  assert decoded_sensors[0, 0, 0] == pytest.approx(INT16_FULL_SCALE[0, 0, 0])
+
+
+def test_legacy_round_trip_has_no_header():
+  sensors, quaternions, sample_time_fine, is_valid = _snapshot()
+  layout = PacketLayout(num_trackers=_NUM_TRACKERS, wire_format=WIRE_FORMAT_LEGACY)
+  buffer = _packet(layout, sensors, quaternions, sample_time_fine, is_valid)
+  assert len(buffer) == 9 * _NUM_TRACKERS * 4
+  header, decoded_sensors, decoded_sample_time_fine, decoded_quaternions = decode(buffer, WIRE_FORMAT_LEGACY, _NUM_TRACKERS)
+  assert header is None and decoded_sample_time_fine is None and decoded_quaternions is None
+  np.testing.assert_array_equal(decoded_sensors, sensors)
+
+
+def test_decode_rejects_truncated_packets():
+  sensors, quaternions, sample_time_fine, is_valid = _snapshot()
+  layout = PacketLayout(num_trackers=_NUM_TRACKERS, encoding=ENCODING_INT16, quaternion_encoding=ENCODING_SMALLEST_THREE)
+  buffer = _packet(layout, sensors, quaternions, sample_time_fine, is_valid)
+  with pytest.raises(ValueError):
+    decode(buffer[:-1], WIRE_FORMAT_V1, _NUM_TRACKERS)
+  with pytest.raises(ValueError):
+    decode(buffer[:10], WIRE_FORMAT_V1, _NUM_TRACKERS)
+
+
+def test_validity_mask_with_scratch_matches_packbits():
+  is_valid = np.random.default_rng(0).random(64) < 0.5
+  scratch = np.empty(64, dtype=np.uint64)
+  assert validity_mask(is_valid, scratch) == validity_mask(is_valid)
+  assert is_valid_from_mask(validity_mask(is_valid), 64).tolist() == is_valid.tolist()
@@ -0,0 +1,132 @@
+import socket
+
+import numpy as np
+import pytest
+
+from protocol import ENCODING_FLOAT32, ENCODING_INT16, ENCODING_SMALLEST_THREE, WIRE_FORMAT_LEGACY, WIRE_FORMAT_V1, LinkStatistics
+from receiver import SnapshotReceiver
+from sender import SnapshotSender
+
+
+_NUM_TRACKERS = 5
+
+
+@pytest.fixture
+def sockets():
+  receiving = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  receiving.bind(("127.0.0.1", 0))
+  receiving.settimeout(1.0)
+  sending = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  yield sending, receiving
+  sending.close()
+  receiving.close()
+
+
+def _sender(sockets, **kwargs) -> SnapshotSender:
+  sending, receiving = sockets
+  return SnapshotSender(sending, receiving.getsockname(), num_trackers=_NUM_TRACKERS, **kwargs)
+
+
+def _send(sender: SnapshotSender, counter: int) -> None:
+  acc = np.full((_NUM_TRACKERS, 3), counter, dtype=np.float32)
+  quaternion = np.tile(np.array([1.0, 0.0, 0.0, 0.0], dtype=np.float32), (_NUM_TRACKERS, 1))
+  is_valid = np.arange(_NUM_TRACKERS) != counter % _NUM_TRACKERS
+  sender.send_arrays(counter=counter, acc=acc, gyr=-acc, mag=acc / 100, is_valid=is_valid,
+                     sample_time_fine=np.full(_NUM_TRACKERS, 100 * counter, dtype=np.uint32), quaternion=quaternion)
+
+
+def test_keep_all_drains_every_queued_snapshot_in_order(sockets):
+  sender = _sender(sockets, wire_format=WIRE_FORMAT_V1)
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1, is_keep_all=True, link_statistics=LinkStatistics())
+  for counter in range(10):
+    _send(sender, counter)
+  assert receiver.receive() == 10
+  assert [header.counter for header, _, _, _ in receiver.snapshots] == list(range(10))
+  for header, sensors, sample_time_fine, quaternions in receiver:
+    assert quaternions is None
+    assert sample_time_fine.tolist() == [100 * header.counter] * _NUM_TRACKERS
+    is_missing = np.arange(_NUM_TRACKERS) == header.counter % _NUM_TRACKERS
+    assert np.isnan(sensors[:, is_missing]).all()
+    assert (sensors[0, ~is_missing] == header.counter).all() and (sensors[1, ~is_missing] == -header.counter).all()
+  assert receiver.get_counts() == {"datagrams": 10, "discarded": 0, "skipped": 0}
+
+
+def test_keep_all_leaves_datagrams_beyond_max_num_datagrams_queued(sockets):
+  sender = _sender(sockets, wire_format=WIRE_FORMAT_V1)
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1, is_keep_all=True, max_num_datagrams=4)
+  for counter in range(6):
+    _send(sender, counter)
+  assert receiver.receive() == 4
+  assert [header.counter for header, _, _, _ in receiver] == [0, 1, 2, 3]
+  assert receiver.receive() == 2
+  assert [header.counter for header, _, _, _ in receiver] == [4, 5]
+
+
+def test_newest_only_skips_stale_snapshots(sockets):
+  sender = _sender(sockets, wire_format=WIRE_FORMAT_V1)
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1)
+  for counter in range(10):
+    _send(sender, counter)
+  assert receiver.receive() == 1
+  header, sensors, _, _ = receiver.latest
+  assert header.counter == 9 and np.nanmax(sensors[0]) == 9
+  assert receiver.get_counts()["skipped"] == 9
+
+
+def test_newest_only_keeps_the_last_good_snapshot_over_malformed_datagrams(sockets):
+  sender = _sender(sockets, wire_format=WIRE_FORMAT_V1)
+  link_statistics = LinkStatistics()
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1, link_statistics=link_statistics)
+  _send(sender, 3)
+  sockets[0].sendto(b"garbage", sockets[1].getsockname())
+  sockets[0].sendto(bytes(sender.fill_arrays(counter=4, acc=np.zeros((_NUM_TRACKERS, 3)), gyr=np.zeros((_NUM_TRACKERS, 3)),
+                                             mag=np.zeros((_NUM_TRACKERS, 3)), is_valid=np.ones(_NUM_TRACKERS, dtype=bool)))[:-1],
+                    sockets[1].getsockname())
+  assert receiver.receive() == 1
+  assert receiver.latest[0].counter == 3 and np.nanmax(receiver.latest[1][0]) == 3
+  assert receiver.get_counts()["discarded"] == 2
+  assert link_statistics.summary()["num_malformed"] == 2
+
+
+def test_layout_switch_drops_the_snapshots_of_the_previous_layout(sockets):
+  float32_sender = _sender(sockets, wire_format=WIRE_FORMAT_V1, encoding=ENCODING_FLOAT32)
+  int16_sender = _sender(sockets, wire_format=WIRE_FORMAT_V1, encoding=ENCODING_INT16, quaternion_encoding=ENCODING_SMALLEST_THREE)
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1, is_keep_all=True)
+  for counter in range(3):
+    _send(float32_sender, counter)
+  assert receiver.receive() == 3
+  assert receiver.layout.encoding == ENCODING_FLOAT32
+  for counter in range(3, 5):
+    _send(float32_sender, counter)
+  for counter in range(5, 7):
+    _send(int16_sender, counter)
+  assert receiver.receive() == 2
+  assert receiver.layout.encoding == ENCODING_INT16
+  assert receiver.get_counts()["skipped"] == 2
+  for header, sensors, _, quaternions in receiver:
+    is_valid = np.arange(_NUM_TRACKERS) != header.counter % _NUM_TRACKERS
+    np.testing.assert_allclose(sensors[0, is_valid], header.counter, atol=0.01)
+    np.testing.assert_allclose(quaternions[is_valid], [[1.0, 0.0, 0.0, 0.0]] * 4, atol=2e-3)
+  # And back, the float32 views are rebuilt.
+  _send(float32_sender, 7)
+  assert receiver.receive() == 1
+  assert receiver[0][0].counter == 7 and receiver.layout.encoding == ENCODING_FLOAT32
+
+
+# Both ends default to the legacy format the LabView loop expects.
+def test_legacy_datagrams_carry_only_the_sensor_block(sockets):
+  sender = _sender(sockets)
+  receiver = SnapshotReceiver(sockets[1], num_trackers=_NUM_TRACKERS, is_keep_all=True)
+  assert sender.layout.wire_format == WIRE_FORMAT_LEGACY and sender.layout.size == 180
+  for counter in range(3):
+    _send(sender, counter)
+  assert receiver.receive() == 3
+  assert [header for header, _, _, _ in receiver] == [None] * 3
+  assert [float(np.nanmax(sensors[0])) for _, sensors, _, _ in receiver] == [0.0, 1.0, 2.0]
+
+
+def test_receive_returns_nothing_on_timeout(sockets):
+  sockets[1].settimeout(0.01)
+  receiver = SnapshotReceiver(sockets[1], wire_format=WIRE_FORMAT_V1)
+  assert receiver.receive() == 0
+  assert receiver.latest is None
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from datastructures import IMU_PACKET_DTYPE
+from recording import INDEX_DTYPE, SnapshotReader, SnapshotRecorder
+
+
+_DEVICE_IDS = ["D0", "D1", "D2"]
+
+
+# Snapshots with counter gaps, arrival-time jitter between devices, and some without any valid device.
+def _snapshots(num_snapshots: int = 3000, seed: int = 0) -> list[tuple[int, np.ndarray, np.ndarray]]:
+  rng = np.random.default_rng(seed)
+  snapshots = []
+  for i in range(num_snapshots):
+    counter = i + 10 * (i // 500)
+    records = np.zeros(len(_DEVICE_IDS), dtype=IMU_PACKET_DTYPE)
+    records["timestamp_fine"] = counter * 167
+    records["toa_s"] = 100.0 + 0.01 * i + rng.uniform(0.0, 0.03, size=len(_DEVICE_IDS))
+    records["acc"] = rng.normal(size=(len(_DEVICE_IDS), 3))
+    records["quaternion"] = [1.0, 0.0, 0.0, 0.0]
+    is_valid = rng.random(len(_DEVICE_IDS)) < 0.8 if i % 97 else np.zeros(len(_DEVICE_IDS), dtype=bool)
+    snapshots.append((counter, records, is_valid))
+  return snapshots
+
+
+@pytest.fixture
+def recording(tmp_path):
+  path = str(tmp_path / "session.mvrec")
+  snapshots = _snapshots()
+  recorder = SnapshotRecorder(path, _DEVICE_IDS, sampling_rate_hz=60, batch_size=64, index_interval=100)
+  for snapshot in snapshots:
+    recorder.write(snapshot)
+  recorder.close()
+  return path, snapshots
+
+
+def test_reader_returns_every_snapshot_written(recording):
+  path, snapshots = recording
+  reader = SnapshotReader(path)
+  assert len(reader) == len(snapshots)
+  assert reader.device_ids == _DEVICE_IDS and reader.sampling_rate_hz == 60
+  assert reader.records["counter"].tolist() == [counter for counter, _, _ in snapshots]
+  for field in ["timestamp_fine", "toa_s", "acc", "quaternion"]:
+    np.testing.assert_array_equal(reader.records[field], np.stack([records[field] for _, records, _ in snapshots]))
+  np.testing.assert_array_equal(reader.records["is_valid"], np.stack([is_valid for _, _, is_valid in snapshots]))
+
+
+def test_index_has_an_entry_every_interval_with_increasing_time(recording):
+  path, snapshots = recording
+  index = np.fromfile(path + ".idx", dtype=INDEX_DTYPE)
+  assert index["record"].tolist() == list(range(0, len(snapshots), 100))
+  assert index["counter"].tolist() == [snapshots[record][0] for record in index["record"]]
+  assert (np.diff(index["toa_s"]) >= 0).all()
+
+
+@pytest.mark.parametrize("start, stop", [(0, 50), (495, 520), (505, 512), (1234, 2345), (3020, 4000), (-10, 10**6), (700, 700)])
+def test_slice_counter_matches_a_full_scan(recording, start, stop):
+  path, _ = recording
+  reader = SnapshotReader(path)
+  counters = reader.records["counter"]
+  assert reader.slice_counter(start, stop)["counter"].tolist() == counters[(counters >= start) & (counters < stop)].tolist()
+
+
+@pytest.mark.parametrize("start_s, stop_s", [(100.0, 100.5), (105.0, 112.345), (129.9, 200.0), (0.0, 1000.0)])
+def test_slice_time_matches_a_full_scan(recording, start_s, stop_s):
+  path, snapshots = recording
+  reader = SnapshotReader(path)
+  toa_s = np.maximum.accumulate([max(records["toa_s"][is_valid], default=-np.inf) for _, records, is_valid in snapshots])
+  expected = reader.records["counter"][(toa_s >= start_s) & (toa_s < stop_s)]
+  assert reader.slice_time(start_s, stop_s)["counter"].tolist() == expected.tolist()
+
+
+def test_reader_ignores_a_trailing_partial_record_and_its_index_entries(recording):
+  path, snapshots = recording
+  record_size = SnapshotReader(path).records.dtype.itemsize
+  with open(path, "r+b") as f:
+    f.seek(0, 2)
+    f.truncate(f.tell() - 1001 * record_size - 1)
+  reader = SnapshotReader(path)
+  assert len(reader) == len(snapshots) - 1002
+  assert reader.slice_counter(0, 10**6)["counter"].tolist() == [counter for counter, _, _ in snapshots[:len(reader)]]
+
+
+def test_reader_rejects_other_files(tmp_path):
+  path = tmp_path / "other.bin"
+  path.write_bytes(b"not a recording")
+  with pytest.raises(ValueError):
+    SnapshotReader(str(path))
@@ -0,0 +1,99 @@
+import numpy as np
+
+from datastructures import IMU_PACKET_DTYPE
+from metrics import DataQualityMetrics
+from resampling import OnlineClockRegression, ResampledAlignedRingBuffer
+
+
+_SAMPLING_RATE_HZ = 60
+_TICKS_PER_S = 10000
+
+
+# Arrival times of a device clock with `drift` and `offset_s` against the host, delayed by 10 ms plus exponential BLE jitter,
+#   and optionally bursts of 30 packets 200 ms late every 1000 samples, after a warm-up.
+def _arrivals(num_samples: int, drift: float = 50e-6, offset_s: float = 1000.0, is_bursts: bool = False, seed: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  rng = np.random.default_rng(seed)
+  device_s = 5000.0 + np.arange(num_samples) / _SAMPLING_RATE_HZ
+  host_s = device_s * (1 + drift) + offset_s
+  delay_s = 0.010 + rng.exponential(0.005, size=num_samples)
+  if is_bursts:
+    delay_s[(np.arange(num_samples) % 1000 >= 500) & (np.arange(num_samples) % 1000 < 530)] += 0.2
+  return device_s, host_s, host_s + delay_s
+
+
+def _fit(device_s: np.ndarray, toa_s: np.ndarray) -> OnlineClockRegression:
+  clock = OnlineClockRegression()
+  for device, toa in zip(device_s.tolist(), toa_s.tolist()):
+    clock.add(device, toa)
+  return clock
+
+
+def test_clock_regression_recovers_drift_and_offset():
+  device_s, host_s, toa_s = _arrivals(300 * _SAMPLING_RATE_HZ)
+  clock = _fit(device_s, toa_s)
+  assert abs(clock.drift - 50e-6) < 5e-6
+  # Host time of the samples, up to the typical BLE delay, which arrival times can not tell apart from the offset.
+  assert 0.010 < clock.to_host(device_s[-1]) - host_s[-1] < 0.020
+
+
+def test_clock_regression_is_not_pulled_by_bursts_of_late_packets():
+  device_s, _, toa_s = _arrivals(300 * _SAMPLING_RATE_HZ)
+  _, _, toa_s_bursts = _arrivals(300 * _SAMPLING_RATE_HZ, is_bursts=True)
+  clock, clock_bursts = _fit(device_s, toa_s), _fit(device_s, toa_s_bursts)
+  assert abs(clock_bursts.drift - clock.drift) < 3e-6
+  assert abs(clock_bursts.to_host(device_s[-1]) - clock.to_host(device_s[-1])) < 0.002
+
+
+def test_clock_regression_reset_forgets_the_previous_clock():
+  device_s, _, toa_s = _arrivals(60 * _SAMPLING_RATE_HZ)
+  clock = _fit(device_s, toa_s)
+  clock.reset()
+  assert not clock.is_started
+  # The device rebooted, its clock restarted from 0 at a different host time.
+  device_s, host_s, toa_s = _arrivals(60 * _SAMPLING_RATE_HZ, offset_s=7000.0, seed=1)
+  for device, toa in zip((device_s - 5000.0).tolist(), toa_s.tolist()):
+    clock.add(device, toa)
+  assert 0.010 < clock.to_host(device_s[-1] - 5000.0) - host_s[-1] < 0.020
+
+
+# Two devices sampling the same signal, with clocks at different offsets (one about to wrap around) and drifts,
+#   resampled onto the host grid must agree up to the difference of their clock estimates.
+def test_resampling_aligns_unsynced_devices_on_the_host_grid():
+  keys = ["A", "B"]
+  buffer = ResampledAlignedRingBuffer(keys=keys,
+                                      timesteps_before_stale=10,
+                                      sampling_rate_hz=_SAMPLING_RATE_HZ,
+                                      ticks_per_s=_TICKS_PER_S,
+                                      capacity=4096,
+                                      metrics=DataQualityMetrics(keys, log_period_s=float("inf")))
+  rng = np.random.default_rng(0)
+  num_samples = 60 * _SAMPLING_RATE_HZ
+  starts_s = [100.0, 100.004]
+  clocks = [(123.4, 30e-6), (2**32 / _TICKS_PER_S - 20.0, -40e-6)]
+  events = []
+  for key, start_s, (device_origin_s, drift) in zip(keys, starts_s, clocks):
+    host_s = start_s + np.arange(num_samples) / _SAMPLING_RATE_HZ
+    toa_s = host_s + 0.010 + rng.exponential(0.003, size=num_samples)
+    ticks = np.round((device_origin_s + (host_s - start_s) / (1 + drift)) * _TICKS_PER_S).astype(np.int64) % 2**32
+    events.extend((toa, key, host, tick) for toa, host, tick in zip(toa_s, host_s, ticks))
+  snapshots = []
+  for toa_s, key, host_s, ticks in sorted(events):
+    record = np.zeros((), dtype=IMU_PACKET_DTYPE)
+    record["toa_s"] = toa_s
+    record["acc"] = np.sin(2 * np.pi * 0.5 * host_s)
+    record["quaternion"] = [np.cos(0.1 * host_s), np.sin(0.1 * host_s), 0.0, 0.0]
+    buffer.plop(key=key, data=record, timestamp=int(ticks))
+    while (snapshot := buffer.yeet(timeout=0)) is not None:
+      snapshots.append(snapshot)
+  counters = [counter for counter, _, _ in snapshots]
+  assert counters == list(range(counters[0], counters[0] + len(counters)))
+  assert len(snapshots) > num_samples - 2 * _SAMPLING_RATE_HZ
+  # Past the first seconds, while the clock estimates settle.
+  rows = [records for _, records, is_valid in snapshots[10 * _SAMPLING_RATE_HZ:] if is_valid.all()]
+  assert len(rows) > 0.95 * (len(snapshots) - 10 * _SAMPLING_RATE_HZ)
+  acc = np.array([records["acc"][:, 0] for records in rows])
+  # 0.5 Hz unit sine, a slope of at most pi/s: 0.03 is about 10 ms.
+  assert np.abs(acc[:, 0] - acc[:, 1]).max() < 0.03
+  quaternions = np.array([records["quaternion"] for records in rows])
+  np.testing.assert_allclose(np.linalg.norm(quaternions, axis=-1), 1.0, atol=1e-5)
+  assert [abs(drift_ppm - clock[1] * 1e6) < 10 for (_, drift_ppm), clock in zip(buffer.clock_estimates.values(), clocks)] == [True, True]
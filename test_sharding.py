@@ -0,0 +1,27 @@
+import os
+import queue
+
+# Before `user_settings` is first imported, it picks the backend.
+os.environ["MOVELLA_BACKEND"] = "simulator"
+
+from sharding import _ShardFacade
+
+
+# A shard only converts and forwards its packets: no alignment buffer, tracer or shared-memory ring of its own,
+#   even with the coordinator's arguments asking for them.
+def test_shard_facade_skips_the_alignment_setup():
+  facade = _ShardFacade(shard_index=1,
+                        device_indices=[2, 3],
+                        out_queue=queue.Queue(),
+                        device_mapping={"joint2": "D2", "joint3": "D3"},
+                        master_device="joint2",
+                        sampling_rate_hz=60,
+                        is_get_orientation=False,
+                        is_sync_devices=True,
+                        is_trace_latency=True,
+                        shared_memory_name="test_sharding_unused")
+  assert not hasattr(facade, "_buffer")
+  assert facade._tracer is None
+  assert facade._shared_writer is None
+  assert facade.get_latency_summary() is None
+  assert list(facade.get_metrics()["devices"]) == ["D2", "D3"]
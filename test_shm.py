@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+
+import numpy as np
+import pytest
+
+from datastructures import IMU_PACKET_DTYPE
+from shm import SharedSnapshotReader, SharedSnapshotWriter
+
+
+_DEVICE_IDS = ["D0", "D1", "D2"]
+
+
+def _publish(writer: SharedSnapshotWriter, counter: int) -> None:
+  records = np.zeros(len(_DEVICE_IDS), dtype=IMU_PACKET_DTYPE)
+  records["timestamp_fine"] = counter
+  records["acc"] = counter
+  writer.publish(counter, records, np.arange(len(_DEVICE_IDS)) != counter % len(_DEVICE_IDS))
+
+
+@pytest.fixture
+def writer(request):
+  writer = SharedSnapshotWriter("test_shm_%d_%s"%(os.getpid(), request.node.name[-16:]), _DEVICE_IDS, sampling_rate_hz=60, capacity=8)
+  yield writer
+  writer.close()
+
+
+def test_read_next_returns_every_frame_in_order(writer):
+  reader = SharedSnapshotReader(writer.name)
+  assert reader.device_ids == _DEVICE_IDS and reader.sampling_rate_hz == 60
+  assert reader.read_next() is None
+  for counter in range(5):
+    _publish(writer, counter)
+  frames = [reader.read_next() for _ in range(5)]
+  assert [(counter, num_missed) for counter, _, _, num_missed in frames] == [(counter, 0) for counter in range(5)]
+  for counter, records, is_valid, _ in frames:
+    assert (records["acc"] == counter).all()
+    assert is_valid.tolist() == (np.arange(len(_DEVICE_IDS)) != counter % len(_DEVICE_IDS)).tolist()
+  assert reader.read_next() is None
+  reader.close()
+
+
+def test_lapped_reader_skips_overwritten_frames_and_counts_them(writer):
+  reader = SharedSnapshotReader(writer.name)
+  for counter in range(20):
+    _publish(writer, counter)
+  # Capacity 8, the slot of the next frame to publish is not read, the oldest readable is 20 - 8 + 1.
+  counter, _, _, num_missed = reader.read_next()
+  assert (counter, num_missed) == (13, 13)
+  assert [reader.read_next()[0] for _ in range(6)] == list(range(14, 20))
+  assert reader.read_next() is None
+  assert reader.num_lapped == 13
+  reader.close()
+
+
+def test_reader_attached_late_starts_from_the_oldest_safe_frame(writer):
+  for counter in range(20):
+    _publish(writer, counter)
+  reader = SharedSnapshotReader(writer.name)
+  assert [reader.read_next()[0] for _ in range(7)] == list(range(13, 20))
+  assert reader.num_lapped == 0
+  reader.close()
+
+
+def test_read_latest_skips_to_the_freshest_frame(writer):
+  reader = SharedSnapshotReader(writer.name)
+  assert reader.read_latest() is None
+  for counter in range(5):
+    _publish(writer, counter)
+  counter, records, _, num_skipped = reader.read_latest()
+  assert (counter, num_skipped, int(records["acc"][0, 0])) == (4, 4, 4)
+  assert reader.read_latest() is None
+  _publish(writer, 5)
+  assert reader.read_next()[0] == 5
+  reader.close()
+
+
+def test_views_are_invalidated_once_the_writer_overwrites_their_frame(writer):
+  reader = SharedSnapshotReader(writer.name)
+  _publish(writer, 0)
+  counter, records, is_valid, _ = reader.read_next(copy=False)
+  assert counter == 0 and reader.is_intact()
+  for counter in range(1, 9):
+    _publish(writer, counter)
+  assert not reader.is_intact()
+  del records, is_valid
+  reader.close()
+
+
+def _publish_all(name: str, num_frames: int, is_attached, is_done) -> None:
+  writer = SharedSnapshotWriter(name, _DEVICE_IDS, sampling_rate_hz=60, capacity=4)
+  try:
+    is_attached.wait()
+    for counter in range(num_frames):
+      _publish(writer, counter)
+    # Keep the segment until the reader is done with it.
+    is_done.wait()
+  finally:
+    writer.close()
+
+
+# A writer in another process laps the reader over and over, every frame read must be intact
+#   and the frames skipped must add up to the counters missing.
+def test_concurrent_writer_never_hands_out_torn_frames():
+  name = "test_shm_%d_concurrent"%os.getpid()
+  num_frames = 20000
+  context = multiprocessing.get_context("spawn")
+  is_attached, is_done = context.Event(), context.Event()
+  process = context.Process(target=_publish_all, args=(name, num_frames, is_attached, is_done))
+  process.start()
+  reader = None
+  try:
+    while reader is None:
+      try:
+        reader = SharedSnapshotReader(name)
+      except (FileNotFoundError, ValueError):
+        pass
+    is_attached.set()
+    previous, num_read = -1, 0
+    while previous < num_frames - 1:
+      frame = reader.read_next(timeout=5.0)
+      assert frame is not None
+      counter, records, is_valid, num_missed = frame
+      assert counter == previous + 1 + num_missed
+      assert (records["acc"] == counter).all() and (records["timestamp_fine"] == counter).all()
+      assert is_valid.tolist() == (np.arange(len(_DEVICE_IDS)) != counter % len(_DEVICE_IDS)).tolist()
+      previous = counter
+      num_read += 1
+    assert reader.num_lapped > 0
+    assert num_read + reader.num_lapped == num_frames
+  finally:
+    if reader is not None:
+      reader.close()
+    is_done.set()
+    process.join(timeout=10)
+  assert process.exitcode == 0
@@ -0,0 +1,195 @@
+############
+#
+# Copyright (c) 2024 Maxim Yudayev and KU Leuven eMedia Lab
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# Created 2024-2025 for the KU Leuven AidWear, AidFOG, and RevalExo projects
+# by Maxim Yudayev [https://yudayev.com].
+#
+# ############
+
+import threading
+from time import perf_counter
+
+import numpy as np
+
+
+# Stages of a packet through the pipeline, latency of each measured from the SDK callback (`DotDataCallback`) of the packet:
+#   "radio"    - time of arrival relative to the device's sampleTimeFine, in excess of the fastest delivery seen (BLE and SDK delay, drift uncorrected).
+#   "dequeue"  - taken from the per-device `PacketRing` by the funnel thread.
+#   "emit"     - row of the packet released by the alignment ring buffer.
+#   "snapshot" - returned by `get_latest_snapshot`, or `get_snapshot` if that is the only reader (FIFO delivery).
+#   "send"     - handed to `sendto`.
+TRACE_STAGES = ("radio", "dequeue", "emit", "snapshot", "send")
+
+
+# Counts latencies into fixed log-spaced bins, one histogram per series, in preallocated arrays.
+#   Quantiles are read from the cumulative counts, accurate to the relative bin width (~12% with 20 bins per decade).
+class LatencyHistogram:
+  def __init__(self,
+               num_series: int,
+               min_s: float = 1e-6,
+               max_s: float = 10.0,
+               bins_per_decade: int = 20):
+    num_edges = int(round(np.log10(max_s / min_s) * bins_per_decade)) + 1
+    self._edges_s = np.logspace(np.log10(min_s), np.log10(max_s), num_edges)
+    # Bin i holds latencies up to edge i, the last bin anything above `max_s`.
+    self._upper_s = np.append(self._edges_s, np.inf)
+    self._counts = np.zeros((num_series, num_edges + 1), dtype=np.int64)
+    self._max_s = np.full(num_series, np.nan, dtype=np.float64)
+
+
+  def record(self, series: np.ndarray, latencies_s: np.ndarray) -> None:
+    if not len(latencies_s):
+      return
+    bins = np.searchsorted(self._edges_s, latencies_s)
+    np.add.at(self._counts, (series, bins), 1)
+    np.fmax.at(self._max_s, series, latencies_s)
+
+
+  def counts(self) -> np.ndarray:
+    return self._counts.sum(axis=1)
+
+
+  # (num_series, len(quantiles)) upper bin edges at the quantiles, NaN for series without samples.
+  def quantiles(self, quantiles: tuple[float, ...]) -> np.ndarray:
+    cumulative = np.cumsum(self._counts, axis=1)
+    totals = cumulative[:, -1:]
+    result = np.full((len(self._counts), len(quantiles)), np.nan)
+    for j, q in enumerate(quantiles):
+      bins = (cumulative < np.ceil(q * totals)).sum(axis=1)
+      result[:, j] = np.minimum(self._upper_s[np.minimum(bins, len(self._upper_s) - 1)], self._max_s)
+    result[totals[:, 0] == 0] = np.nan
+    return result
+
+
+  @property
+  def max_s(self) -> np.ndarray:
+    return self._max_s
+
+
+  def reset(self) -> None:
+    self._counts.fill(0)
+    self._max_s.fill(np.nan)
+
+
+# Per-stage, per-device latency histograms of the pipeline, with one extra series per stage over all devices.
+#   Stages are written by the funnel thread ("radio", "dequeue") and one consumer ("emit", "snapshot", "send"),
+#   under a lock, since both update the histograms and the consumer re-anchors the clock offsets the funnel thread uses.
+class LatencyTracer:
+  def __init__(self,
+               device_ids: list[str],
+               ticks_per_s: float, # NOTE: rate of the sampleTimeFine clock, as assumed by the facade
+               num_bits_timestamp: int = 32,
+               summary_period_s: float | None = 10.0, # NOTE: None to only summarize on demand
+               quantiles: tuple[float, ...] = (0.5, 0.95, 0.99)):
+    self._device_ids = list(device_ids)
+    self._num_devices = len(self._device_ids)
+    self._stage_index = {stage: i for i, stage in enumerate(TRACE_STAGES)}
+    self._histogram = LatencyHistogram(num_series=len(TRACE_STAGES) * (self._num_devices + 1))
+    self._ticks_per_s = ticks_per_s
+    self._wrap_period_s = 2**num_bits_timestamp / ticks_per_s
+    # Host-minus-device clock offset of the fastest delivery, re-anchored every summary to the minimum of the last period
+    #   so the drift between the clocks does not accumulate into the "radio" stage.
+    self._min_offset_s = np.full(self._num_devices, np.inf)
+    self._window_min_offset_s = np.full(self._num_devices, np.inf)
+    self._summary_period_s = summary_period_s
+    self._next_summary_s = perf_counter() + summary_period_s if summary_period_s is not None else np.inf
+    self._quantiles = quantiles
+    self._lock = threading.Lock()
+
+
+  def record(self, stage: str, device_indices: np.ndarray, latencies_s: np.ndarray) -> None:
+    with self._lock:
+      self._record(stage, device_indices, latencies_s)
+
+
+  def _record(self, stage: str, device_indices: np.ndarray, latencies_s: np.ndarray) -> None:
+    offset = self._stage_index[stage] * (self._num_devices + 1)
+    device_indices = np.asarray(device_indices, dtype=np.intp)
+    self._histogram.record(offset + device_indices, latencies_s)
+    self._histogram.record(np.full(len(device_indices), offset + self._num_devices), latencies_s)
+
+
+  # Packets taken from the rings by the funnel thread at `t_s`.
+  def record_dequeue(self, records: np.ndarray, t_s: float) -> None:
+    devices = records["device"]
+    toa_s = records["toa_s"]
+    offsets_s = toa_s - records["timestamp_fine"] / self._ticks_per_s
+    with self._lock:
+      is_unanchored = ~np.isfinite(self._min_offset_s[devices])
+      if is_unanchored.any():
+        np.fmin.at(self._min_offset_s, devices[is_unanchored], offsets_s[is_unanchored])
+      # sampleTimeFine wraps around, the offset then jumps by the wrap period: take the signed difference modulo the period.
+      excess_s = (offsets_s - self._min_offset_s[devices]) % self._wrap_period_s
+      excess_s[excess_s > self._wrap_period_s / 2] -= self._wrap_period_s
+      np.fmin.at(self._window_min_offset_s, devices, self._min_offset_s[devices] + excess_s)
+      self._record("radio", devices, np.maximum(excess_s, 0.0))
+      self._record("dequeue", devices, t_s - toa_s)
+
+
+  # Snapshot emitted by the alignment buffer at `t_emit_s` and returned at `t_s`.
+  def record_snapshot(self, snapshot: tuple[int, np.ndarray, np.ndarray], t_emit_s: float, t_s: float) -> None:
+    _, records, is_valid = snapshot[:3]
+    toa_s = records["toa_s"][is_valid]
+    devices = np.flatnonzero(is_valid)
+    with self._lock:
+      self._record("emit", devices, t_emit_s - toa_s)
+      self._record("snapshot", devices, t_s - toa_s)
+      is_summary = t_s >= self._next_summary_s
+      if is_summary:
+        self._next_summary_s = t_s + self._summary_period_s
+        self._min_offset_s[:] = np.where(np.isfinite(self._window_min_offset_s), self._window_min_offset_s, self._min_offset_s)
+        self._window_min_offset_s.fill(np.inf)
+    if is_summary:
+      print(self.format_summary(), flush=True)
+
+
+  # Snapshot handed to the socket at `t_s`.
+  def record_send(self, snapshot: tuple[int, np.ndarray, np.ndarray], t_s: float) -> None:
+    _, records, is_valid = snapshot[:3]
+    self.record("send", np.flatnonzero(is_valid), t_s - records["toa_s"][is_valid])
+
+
+  # Latencies in ms per stage, per device and over "all" devices since the start.
+  def summary(self) -> dict[str, dict[str, dict[str, float]]]:
+    with self._lock:
+      quantiles_ms = self._histogram.quantiles(self._quantiles) * 1e3
+      max_ms = self._histogram.max_s * 1e3
+      counts = self._histogram.counts()
+    summary = {}
+    for stage, i_stage in self._stage_index.items():
+      summary[stage] = {}
+      for i_device, device_id in enumerate(self._device_ids + ["all"]):
+        i = i_stage * (self._num_devices + 1) + i_device
+        summary[stage][device_id] = {
+          "count": int(counts[i]),
+          **{"p%g_ms"%(q * 100): float(v) for q, v in zip(self._quantiles, quantiles_ms[i])},
+          "max_ms": float(max_ms[i]),
+        }
+    return summary
+
+
+  def format_summary(self) -> str:
+    lines = ["Latency since SDK callback [ms] %s"%"/".join("p%g"%(q * 100) for q in self._quantiles) + "/max:"]
+    for stage, devices in self.summary().items():
+      lines.append("  %-8s %s"%(stage, ", ".join("%s %s"%(device_id, "/".join("%.1f"%v for k, v in values.items() if k != "count"))
+                                                    for device_id, values in devices.items())))
+    return "\n".join(lines)
@@ -28,9 +28,15 @@
 #  
 
 import getpass
+import os
 
 whitelist = list()
 dot_basename = "movella"
 username = getpass.getuser().lower()
 whitelist = {}
 dot_basename = "Movella DOT"
+
+# Backend implementing the Movella DOT SDK interface for `MovellaHandler`:
+#   "sdk"       - `movelladot_pc_sdk`, real DOTs over Bluetooth (Windows).
+#   "simulator" - `MovellaSimulator`, seeded virtual DOTs for running and load-testing the pipeline without hardware.
+movella_backend = os.environ.get("MOVELLA_BACKEND", "sdk").lower()